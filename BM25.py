@@ -6,22 +6,44 @@ Acknowledgements:
 - I collaborated with Inesh Jacob on some of the concepts of this assignment (bm25 logic).
 '''
 
+import atexit
 import math
 import os
-import sys
 import time
-import re
 import heapq
-from indexEngine import tokenize
-from getDoc import fetchDocumentByDocNo
+import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from textAnalysis import tokenize
+from getDoc import fetchDocument, closeRetiredDocStores
+from postingsFile import PostingsReader, DEFAULT_CACHE_POSTINGS
+from segments import readManifest, loadSegmentedIndex, indexGeneration
+from phraseQuery import parsePhrases, matchingDocuments
+from docMetadata import openMetadata
+from collectionStats import loadCollectionStats, DEFAULT_K1, DEFAULT_B
+from indexSnapshot import openSnapshot
+from scoring import BM25Scorer
+from impactIndex import ImpactScorer, hasImpacts
+from topics import readTopics
+from sentenceStore import snippetSentences, openSentenceStore
+from queryCache import QueryResultCache, queryCacheKey, DEFAULT_CACHE_ENTRIES, DEFAULT_TTL_SECONDS
+import instrumentation
+from instrumentation import instruments, formatQuery
 from collections import defaultdict
 
 # Define global variables for the file names of the data structures.
 LEXICON_FILE = "lexicon.txt"
-INVERTED_INDEX_FILE = "inverted_index.txt"
+INVERTED_INDEX_FILE = "inverted_index.bin"
+TEXT_INVERTED_INDEX_FILE = "inverted_index.txt"  # older indexes
 MAPPING_FILE = "mapping.txt"
 DOC_LENGTHS_FILE = "doc-lengths.txt"
 
+# Number of results shown for each query.
+TOP_N = 10
+# Threads that render the results (and their snippets) of a query at the same time (1 renders them one by one).
+SNIPPET_THREADS = 8
+snippetPool = None  # ThreadPoolExecutor for rendering results, started by the first query that needs it
+
 # Dictionary to convert numerical months to full word strings
 MONTHS = {
     '01': 'January',
@@ -56,15 +78,22 @@ def loadLexicon(indexPath):
             lexicon[term] = int(termID)
     return lexicon
 
-def loadInvertedIndex(indexPath):
+def loadInvertedIndex(indexPath, cachePostings=DEFAULT_CACHE_POSTINGS):
     """
-    Load the inverted index from a file.
+    Load the inverted index.
+    New indexes have a binary postings file that is memory mapped and decoded one term at a time,
+    with an LRU cache of up to cachePostings decoded postings.
+    Older indexes only have the text file, which is parsed fully into memory.
     Returns:
-        dict: A dictionary representing the inverted index.
+        dict: A dictionary (or dictionary-like PostingsReader) representing the inverted index.
     """
+    binaryPath = os.path.join(indexPath, INVERTED_INDEX_FILE)
+    if os.path.exists(binaryPath):
+        return PostingsReader(binaryPath, cachePostings)
+
     invertedIndex = {}
     # Open the inverted index file and read line by line.
-    with open(os.path.join(indexPath, INVERTED_INDEX_FILE), 'r') as f:
+    with open(os.path.join(indexPath, TEXT_INVERTED_INDEX_FILE), 'r') as f:
         for line in f:
             # Split the line into term ID and postings string.
             termID_str, postings_str = line.strip().split(":", 1)
@@ -112,7 +141,31 @@ def loadDocLengths(indexPath):
             docLengths[int(docId)] = int(length)
     return docLengths
 
-def bm25Score(docId, queryTerms, k1, b, docLengths, avgDl, N, lexicon, invertedIndex):
+def loadIndex(indexPath, cachePostings=DEFAULT_CACHE_POSTINGS, useSnapshot=True):
+    """
+    Loads everything needed to search an index, across all of its segments if documents were appended.
+    Postings stay on disk until a query needs them. cachePostings bounds how many decoded postings are cached.
+    If the index has an up to date snapshot (indexSnapshot.py) and useSnapshot is True, the lexicon, document
+    lengths, mapping and statistics are mapped from it instead of being parsed from the text files.
+    Returns:
+        tuple: (lexicon, inverted index, docLengths, mapping, collection statistics)
+    """
+    snapshot = openSnapshot(indexPath) if useSnapshot else None
+    if snapshot is not None:
+        return snapshot.lexicon, loadInvertedIndex(indexPath, cachePostings), snapshot.docLengths, snapshot.mapping, snapshot.stats
+    if readManifest(indexPath):
+        # Documents were added later with indexEngine.py --append, so search across all the segments.
+        lexicon, invertedIndex, docLengths, mapping = loadSegmentedIndex(indexPath, cachePostings)
+    else:
+        lexicon = loadLexicon(indexPath)
+        invertedIndex = loadInvertedIndex(indexPath, cachePostings)
+        docLengths = loadDocLengths(indexPath)
+        mapping = loadMapping(indexPath)
+    # N, the average document length and the IDF of every term were worked out when the index was built.
+    stats = loadCollectionStats(indexPath, invertedIndex, docLengths, len(lexicon))
+    return lexicon, invertedIndex, docLengths, mapping, stats
+
+def bm25Score(docId, queryTerms, k1, b, docLengths, avgDl, N, lexicon, invertedIndex, idfs=None):
     """
     Calculate the BM25 score for a document given a query.
     
@@ -126,6 +179,8 @@ def bm25Score(docId, queryTerms, k1, b, docLengths, avgDl, N, lexicon, invertedI
         N (int): The total number of documents.
         lexicon (dict): A dictionary mapping terms to term IDs.
         invertedIndex (dict): The inverted index.
+        idfs (array): Precomputed IDF of each term ID (collectionStats.py). Worked out from the postings if not given,
+            which is only right for an index that has all of its postings: pass stats.idf for a pruned index.
    
     Returns:
         float: The BM25 score for the document.
@@ -133,6 +188,8 @@ def bm25Score(docId, queryTerms, k1, b, docLengths, avgDl, N, lexicon, invertedI
     score = 0.0
     # Get the length of the document.
     dl = docLengths.get(docId, 0)
+    # Calculate the BM25 term frequency component (it only depends on the document).
+    k = k1 * ((1 - b) + b * (dl / avgDl))
     # Calculate the score for each term in the query.
     for term in queryTerms:
         # Get the term ID from the lexicon.
@@ -140,22 +197,29 @@ def bm25Score(docId, queryTerms, k1, b, docLengths, avgDl, N, lexicon, invertedI
         if termId is not None:
             # Get the postings list for the term ID from the inverted index.
             postingsList = invertedIndex.get(termId, [])
-            # Find the count of the term in the document.
-            f_i = next((count for docID, count in postingsList if docID == docId), 0)
-            # Calculate the number of documents containing the term.
-            n_i = len(postingsList)/2
-            # Calculate the inverse document frequency.
-            idf = math.log((N - n_i + 0.5) / (n_i + 0.5))
-            # Calculate the BM25 term frequency component.
-            k = k1 * ((1 - b) + b * (dl / avgDl))
+            # Find the count of the term in the document (bm25 passes each term's postings as a docID -> count dict).
+            if isinstance(postingsList, dict):
+                f_i = postingsList.get(docId, 0)
+            else:
+                f_i = next((count for docID, count in postingsList if docID == docId), 0)
+            if idfs is not None:
+                idf = idfs[termId]
+            else:
+                # Calculate the number of documents containing the term (one posting per document). A pruned index
+                # (staticPruning.py) has fewer postings than that, and only collection-stats.bin has the real df.
+                n_i = len(postingsList)
+                # Calculate the inverse document frequency.
+                idf = math.log((N - n_i + 0.5) / (n_i + 0.5))
             # Calculate the term's contribution to the total score.
             termScore = idf * f_i / (f_i + k)
             score += termScore
     return score
 
-def bm25(query, lexicon, invertedIndex, docLengths, avgDl, N, k1, b):
+def bm25(query, lexicon, invertedIndex, docLengths, avgDl, N, k1, b, idfs=None):
     """
     Calculate BM25 scores for all documents in the corpus with respect to the given query.
+    Quoted phrases in the query (e.g. "los angeles" police) only let through documents containing the phrase,
+    which is checked with the positional postings of an index built with indexEngine.py --positions.
 
     Args:
         query (str): The search query.
@@ -166,12 +230,25 @@ def bm25(query, lexicon, invertedIndex, docLengths, avgDl, N, k1, b):
         N (int): Total number of documents in the corpus.
         k1 (float): BM25 tuning parameter for term frequency saturation.
         b (float): BM25 tuning parameter for document length normalization.
+        idfs (array): Precomputed IDF of each term ID from the collection statistics (optional). Without it, the
+            document frequency is the length of the term's postings list. For an index pruned with staticPruning.py,
+            that is smaller than the df in collection-stats.bin, so pass stats.idf to score like BM25Scorer does.
 
     Returns:
         list: Sorted list of tuples (docID, score) with the highest scoring documents first.
     """
     # Tokenize the query into individual terms.
     queryTerms = tokenize(query)
+    # Documents allowed by the quoted phrases (None if there are no phrases).
+    phraseMatches = matchingDocuments(parsePhrases(query), lexicon.get, invertedIndex)
+
+    # Decode each query term's postings once, into docID -> count. bm25Score looks terms up in this small index
+    # instead of decoding (and scanning) the postings again for every document it scores.
+    queryPostings = {}
+    for term in queryTerms:
+        termId = lexicon.get(term)
+        if termId is not None and termId not in queryPostings:
+            queryPostings[termId] = dict(invertedIndex.get(termId, []))
 
     # Initialize a dictionary to hold document scores.
     scores = defaultdict(float)
@@ -182,12 +259,14 @@ def bm25(query, lexicon, invertedIndex, docLengths, avgDl, N, k1, b):
         termId = lexicon.get(term)
         # Check if the term exists in the corpus.
         if termId is not None:
-            # Retrieve the postings list for the term from the inverted index.
-            postingsList = invertedIndex.get(termId, [])
+            # Retrieve the postings list for the term.
+            postingsList = queryPostings[termId]
             # Calculate scores for each document in the postings list.
-            for docId, _ in postingsList:
+            for docId in postingsList:
+                if phraseMatches is not None and docId not in phraseMatches:
+                    continue
                 # Get the BM25 score for the document with respect to the term.
-                score = bm25Score(docId, queryTerms, k1, b, docLengths, avgDl, N, lexicon, invertedIndex)
+                score = bm25Score(docId, queryTerms, k1, b, docLengths, avgDl, N, lexicon, queryPostings, idfs)
                 # Accumulate scores for each document across all terms in the query.
                 scores[docId] += score
 
@@ -210,38 +289,80 @@ def extractHeadlineAndDate(documentContent, docNo, snippet):
 
     return headline, year, month, day
 
-def displayTopResults(scores, mapping, indexPath, query, topN):
-    for rank, (docId, score) in enumerate(scores[:topN], 1):
-        docNo = mapping.get(docId, "UnknownDOCNO")
-        documentContent = fetchDocumentByDocNo(indexPath, docNo)
-        snippet = generateQueryBiasedSnippet(documentContent, tokenize(query))
+def displayTopResults(scores, mapping, indexPath, query, topN, metadata=None, showSnippets=True, sentences=None):
+    """
+    Prints the top N results. With the metadata table (docMetadata.openMetadata) the headline, date and DOCNO
+    come from it, and the raw document is only read when a snippet is shown and there is no sentence store.
+    """
+    for result in renderTopResults(scores, mapping, indexPath, query, topN, metadata, showSnippets, sentences):
+        print(result)
+
+def renderTopResults(scores, mapping, indexPath, query, topN, metadata=None, showSnippets=True, sentences=None):
+    """
+    The text displayTopResults prints for each of the top N results, so it can be cached.
+    With the sentence store (sentenceStore.openSentenceStore), snippets are scored on term IDs and no document is read.
+    The results are rendered by a pool of threads, so reading documents and decompressing blocks overlap.
+    """
+    global snippetPool
+    queryTerms = tokenize(query)
+    ranked = scores[:topN]
+    if len(ranked) <= 1 or SNIPPET_THREADS <= 1:
+        return [renderResult(rank, docId, mapping, indexPath, queryTerms, metadata, showSnippets, sentences)
+                for rank, (docId, _) in enumerate(ranked, 1)]
+    if snippetPool is None:
+        # Started once and reused, since starting threads for every query costs about as much as a snippet.
+        ## Reference: https://docs.python.org/3/library/concurrent.futures.html#threadpoolexecutor
+        snippetPool = ThreadPoolExecutor(max_workers=SNIPPET_THREADS)
+    # map returns the results in rank order.
+    return list(snippetPool.map(lambda rank: renderResult(rank, ranked[rank - 1][0], mapping, indexPath, queryTerms, metadata, showSnippets, sentences),
+                                range(1, len(ranked) + 1)))
+
+def renderResult(rank, docId, mapping, indexPath, queryTerms, metadata, showSnippets, sentences):
+    """
+    The text shown for one result.
+    """
+    docNo, headline, year, month, day, snippet = resultDetails(docId, mapping, indexPath, queryTerms, metadata, showSnippets, sentences)
+    if showSnippets:
+        return f"{rank}. {headline} ({MONTHS[month]} {day}, {year})\n{snippet} ({docNo})\n"
+    return f"{rank}. {headline} ({MONTHS[month]} {day}, {year}) ({docNo})\n"
+
+def resultDetails(docId, mapping, indexPath, queryTerms, metadata=None, showSnippets=True, sentences=None):
+    """
+    What is shown for one result.
+    Returns:
+        tuple: (DOCNO, headline, year, month, day, snippet ("" without snippets))
+    """
+    record = metadata.get(docId) if metadata is not None else None
+    docNo = record[0] if record is not None else mapping.get(docId, "UnknownDOCNO")
+    snippet = ""
+    documentSentences = None
+    if showSnippets and record is not None and sentences is not None:
+        # The sentences were split and tokenized when the document was indexed.
+        with instruments.phase("snippet"):
+            documentSentences, segment = sentences.sentences(docId)
+            if documentSentences is not None:
+                snippet = summarizeSentences(documentSentences, sentences.queryTermIDs(queryTerms, segment))
+    if (showSnippets and documentSentences is None) or record is None:
+        with instruments.phase("fetch"):
+            documentContent = fetchDocument(indexPath, docId, docNo)
+        if showSnippets:
+            with instruments.phase("snippet"):
+                snippet = generateQueryBiasedSnippet(documentContent, queryTerms)
+
+    if record is not None:
+        _, date, headline = record
+        year, month, day = date.split("-")
+        if not headline:
+            # Use the first 50 characters of the snippet as headline if the headline is not found
+            headline = (snippet[:50] + "..." if len(snippet) > 50 else snippet) if snippet else "(Headline not found)"
+    else:
         headline, year, month, day = extractHeadlineAndDate(documentContent, docNo, snippet)
-        print(f"{rank}. {headline} ({MONTHS[month]} {day}, {year})\n{snippet} ({docNo})\n")
-
-def stripTags(text):
-    # Removing tags
-    # Reference: https://stackoverflow.com/questions/3662142/how-to-remove-tags-from-a-string-in-python-using-regular-expressions-not-in-ht
-    return re.sub(r'<[^>]+>', '', text)
-
-def getTextContent(documentContent):
-    # Extracting text between <TEXT> tags
-    textContent = ""
-    if '<TEXT>' in documentContent and '</TEXT>' in documentContent:
-        textContent = documentContent.split('<TEXT>')[1].split('</TEXT>')[0]
-    return textContent
-
-def splitIntoSentences(text):
-    # Splitting sentences
-    # Reference: https://stackoverflow.com/questions/44099714/how-to-use-re-split-for-commas-and-periods
-    sentences = re.split(r'[.!?]', text)
-    return [sentence.strip() for sentence in sentences if sentence]
+    return docNo, headline, year, month, day, snippet
 
 def processDocumentForSnippets(documentContent):
-    textContent = getTextContent(documentContent)
-    cleanText = stripTags(textContent)
-    sentences = splitIntoSentences(cleanText)
-    # Filtering out sentences less than 5 words
-    return [(sentence, tokenize(sentence)) for sentence in sentences if len(sentence.split()) >= 5]
+    # Getting the <TEXT>, removing its tags, splitting it into sentences and filtering out sentences less than 5 words
+    # (see sentenceStore.py, which does this at indexing time)
+    return [(sentence, tokenize(sentence)) for sentence in snippetSentences(documentContent)]
 
 def calculateSentenceMetrics(sentence, queryTerms):
     # From pseudo-code provided by Professor Smucker in lecture
@@ -271,7 +392,13 @@ def cleanAndJoinSentences(sentences):
 
 # Generating the snippets / summaries
 def generateQueryBiasedSnippet(documentContent, queryTerms):
-    sentences = processDocumentForSnippets(documentContent)
+    return summarizeSentences(processDocumentForSnippets(documentContent), queryTerms)
+
+def summarizeSentences(sentences, queryTerms):
+    """
+    Picks the 2 best sentences for the snippet out of [(sentence, tokens)].
+    The tokens can be strings, or term IDs from the sentence store with queryTerms a set of the query's term IDs.
+    """
     maxHeap = []
     for index, (sentence, tokenizedSentence) in enumerate(sentences):
         # calculating h
@@ -304,15 +431,154 @@ def generateQueryBiasedSnippet(documentContent, queryTerms):
     finalSnippet = cleanAndJoinSentences(summary)
     return finalSnippet
 
+# The scorer used by the batch workers. It is set before the worker processes start, so with the fork start
+# method they share the parent's loaded index instead of each loading their own copy.
+batchScorer = None
+
+def loadBatchScorer(indexPath, cachePostings, k1=DEFAULT_K1, b=DEFAULT_B, instrumentSettings=None):
+    """
+    Pool initializer for platforms that can't fork: each worker loads the index itself.
+    instrumentSettings are the arguments of instruments.configure, if the parent measures its queries.
+    """
+    global batchScorer
+    if instrumentSettings is not None:
+        instruments.configure(*instrumentSettings)
+    lexicon, invertedIndex, docLengths, _, stats = loadIndex(indexPath, cachePostings)
+    batchScorer = BM25Scorer(lexicon, invertedIndex, docLengths, stats, k1, b)
+
+def scoreTopic(args):
+    """
+    Ranks one topic in a batch run.
+    Returns (topicID, [(docID, score)], error message or None, the query's measurement or None if instrumentation is off).
+    """
+    topicID, query, depth = args
+    # The measurement goes back to the parent, which adds up those of all the workers.
+    with instruments.query(aggregate=False):
+        try:
+            ranking, error = batchScorer.topK(query, depth), None
+        except ValueError as e:
+            # Phrase queries on an index without positions.
+            ranking, error = [], str(e)
+    return topicID, ranking, error, instruments.lastQuery if instruments.enabled else None
+
+def runTopics(indexPath, topicsPath, runPath, depth, numWorkers, runTag, cachePostings=DEFAULT_CACHE_POSTINGS, k1=DEFAULT_K1, b=DEFAULT_B):
+    """
+    Batch mode: ranks every topic in a TREC topics file and writes the top depth documents of each
+    to a TREC run file ("topicID Q0 DOCNO rank score runTag" lines).
+    Topics are spread over numWorkers processes that share the loaded index.
+    """
+    global batchScorer
+    lexicon, invertedIndex, docLengths, mapping, stats = loadIndex(indexPath, cachePostings)
+    batchScorer = BM25Scorer(lexicon, invertedIndex, docLengths, stats, k1, b)
+    work = [(topicID, query, depth) for topicID, query in readTopics(topicsPath)]
+
+    start_time = time.time()
+    if numWorkers > 1:
+        ## Reference: https://docs.python.org/3/library/multiprocessing.html#contexts-and-start-methods
+        if "fork" in multiprocessing.get_all_start_methods():
+            pool = multiprocessing.get_context("fork").Pool(numWorkers)
+        else:
+            instrumentSettings = (True, instruments.profiler, instruments.profileDir) if instruments.enabled else None
+            pool = multiprocessing.Pool(numWorkers, initializer=loadBatchScorer, initargs=(indexPath, cachePostings, k1, b, instrumentSettings))
+        with pool:
+            # imap keeps the topics in order. Small chunks keep the workers evenly loaded.
+            rankings = list(pool.imap(scoreTopic, work, chunksize=max(1, len(work) // (numWorkers * 8))))
+    else:
+        rankings = [scoreTopic(item) for item in work]
+
+    with open(runPath, "w") as f:
+        for topicID, ranking, error, measurement in rankings:
+            if error is not None:
+                print(f"Error in topic {topicID}: {error}")
+            if measurement is not None:
+                instruments.addQuery(measurement)
+            for rank, (docId, score) in enumerate(ranking, 1):
+                f.write(f"{topicID} Q0 {mapping[docId]} {rank} {score} {runTag}\n")
+    print(f"Ranked {len(rankings)} topics in {time.time() - start_time:.2f} seconds. The run is in {runPath}.")
+    if numWorkers == 1 and hasattr(invertedIndex, "cacheStats"):
+        cache = invertedIndex.cacheStats()
+        print(f"Postings cache: {cache['hits']} hits, {cache['misses']} misses ({cache['hitRate']:.1%}), {cache['postings']} postings cached.")
+    if instruments.enabled:
+        print(instruments.report())
+
+def openSearchers(indexPath, args):
+    """
+    Loads the index for interactive search.
+    Returns:
+        tuple: (mapping, BM25Scorer, ImpactScorer or None, metadata table or None, sentence store or None)
+    """
+    lexicon, invertedIndex, docLengths, mapping, stats = loadIndex(indexPath, args.postings_cache)
+    # Term-at-a-time scorer (scoring.py). It ranks exactly like bm25, but in one pass over each postings list.
+    scorer = BM25Scorer(lexicon, invertedIndex, docLengths, stats, k1=args.k1, b=args.b)
+    # Score-at-a-time over quantized impacts (impactIndex.py): approximate, but with a ceiling on the work per query.
+    impactScorer = ImpactScorer(indexPath, lexicon, invertedIndex, docLengths) if args.impacts else None
+    # Headlines, dates and DOCNOs for the result page (None for indexes built before the metadata table existed).
+    metadata = openMetadata(indexPath)
+    # Snippet sentences split and tokenized at indexing time (None for indexes built before the sentence store existed).
+    sentences = openSentenceStore(indexPath, lexicon, invertedIndex) if not args.no_snippets else None
+    return mapping, scorer, impactScorer, metadata, sentences
+
+def closeSearchers(scorer, impactScorer, metadata, sentences, indexPath=None):
+    """
+    Closes the files (memory mapped postings, impacts, metadata tables and sentence stores) that openSearchers
+    opened, once the index they were loaded from has been replaced by a newer generation. With indexPath, the
+    document stores that getDoc.fetchDocument opened for segments that are no longer in the index (merged away)
+    are closed too. The other ones are still used by the new generation and stay open.
+    """
+    if hasattr(scorer.invertedIndex, "close"):
+        # Indexes loaded from the text files are plain dictionaries with nothing to close.
+        scorer.invertedIndex.close()
+    for opened in (impactScorer, metadata, sentences):
+        if opened is not None:
+            opened.close()
+    if indexPath is not None:
+        closeRetiredDocStores(indexPath)
+
 def main():
-    indexPath = sys.argv[1]
-    # Load necessary data structures
-    lexicon = loadLexicon(indexPath)
-    invertedIndex = loadInvertedIndex(indexPath)
-    docLengths = loadDocLengths(indexPath)
-    mapping = loadMapping(indexPath)
-    avgDl = sum(docLengths.values()) / len(docLengths)
-    N = len(docLengths)
+    parser = argparse.ArgumentParser(description="Interactive BM25 search: python3 BM25.py <indexPath>")
+    parser.add_argument("indexPath", help="Directory containing the index files")
+    parser.add_argument("--no-snippets", action="store_true", help="Show only the rank, headline, date and DOCNO of each result")
+    parser.add_argument("--impacts", action="store_true", help="Rank with the impact-ordered postings (index built with indexEngine.py --impacts)")
+    parser.add_argument("--postings-budget", type=int, metavar="N", help="With --impacts, stop each query after N postings")
+    parser.add_argument("--postings-cache", type=int, default=DEFAULT_CACHE_POSTINGS, metavar="N", help=f"Decoded postings to keep in the LRU cache (default: {DEFAULT_CACHE_POSTINGS}, 0 turns it off)")
+    parser.add_argument("--result-cache", type=int, default=DEFAULT_CACHE_ENTRIES, metavar="N", help=f"Recent queries whose results are cached (default: {DEFAULT_CACHE_ENTRIES}, 0 turns it off)")
+    parser.add_argument("--result-cache-ttl", type=float, default=DEFAULT_TTL_SECONDS, metavar="SECONDS", help=f"How long cached results are kept (default: {DEFAULT_TTL_SECONDS})")
+    parser.add_argument("--k1", type=float, default=DEFAULT_K1, help=f"BM25 k1 (default: {DEFAULT_K1}, see parameterSweep.py for tuning it)")
+    parser.add_argument("--b", type=float, default=DEFAULT_B, help=f"BM25 b (default: {DEFAULT_B})")
+    parser.add_argument("--topics", help="Batch mode: rank every topic of this TREC topics file instead of asking for queries")
+    parser.add_argument("--run", help="With --topics, the TREC run file to write")
+    parser.add_argument("--depth", type=int, default=1000, help="With --topics, results per topic (default: 1000)")
+    parser.add_argument("--workers", type=int, default=1, help="With --topics, number of worker processes (default: 1)")
+    parser.add_argument("--run-tag", default="yabadeerBM25", help="With --topics, the run tag in the last column (default: yabadeerBM25)")
+    instrumentation.addArguments(parser)
+    args = parser.parse_args()
+    if args.profile_dir and not args.profile:
+        parser.error("--profile-dir needs --profile.")
+    if instrumentation.configureFromArguments(args) and args.metrics:
+        # Written however the program ends (quitting, end of input or Ctrl+C).
+        atexit.register(instruments.writeMetrics, args.metrics, args.metrics_format)
+    if os.path.exists(os.path.join(args.indexPath, "shards.txt")):
+        parser.error("this index is split into shards. Search it with: python3 shards.py search <indexPath>")
+    if args.impacts and not hasImpacts(args.indexPath):
+        parser.error("this index has no impact-ordered postings. Rebuild it with indexEngine.py --impacts.")
+    if args.postings_budget is not None and (not args.impacts or args.postings_budget < 1):
+        parser.error("--postings-budget must be at least 1 and needs --impacts.")
+    if args.impacts and (args.k1 != DEFAULT_K1 or args.b != DEFAULT_B):
+        parser.error(f"the impacts were quantized for k1 = {DEFAULT_K1} and b = {DEFAULT_B}, so --impacts can't use other values.")
+
+    if args.topics:
+        if not args.run:
+            parser.error("--topics needs --run <output file>.")
+        if args.depth < 1 or args.workers < 1:
+            parser.error("--depth and --workers must be at least 1.")
+        runTopics(args.indexPath, args.topics, args.run, args.depth, args.workers, args.run_tag, args.postings_cache, args.k1, args.b)
+        return
+
+    indexPath = args.indexPath
+    # Results of recent queries (queryCache.py): a repeated query skips scoring and snippet generation.
+    resultCache = QueryResultCache(args.result_cache, args.result_cache_ttl)
+    showSnippets = not args.no_snippets
+    scorer = None
 
     while True:
         # User input
@@ -320,15 +586,46 @@ def main():
         if query.lower() == 'q': # Quitting condition
             break
 
-        # Timing the retrieval. ChatGPT informed me of the library to use
-        start_time = time.time()
-        scores = bm25(query, lexicon, invertedIndex, docLengths, avgDl, N, k1=1.2, b=0.75)
-        retrieval_time = time.time() - start_time
+        # (Re)load the index the first time, and whenever segments were appended or merged since it was loaded.
+        # That also drops the cached results, and closes the files of the index that was loaded before.
+        if resultCache.setGeneration(indexGeneration(indexPath)):
+            if scorer is not None:
+                closeSearchers(scorer, impactScorer, metadata, sentences, indexPath)
+            mapping, scorer, impactScorer, metadata, sentences = openSearchers(indexPath, args)
 
-        # Printing out the top N (N = 10) results to the terminal
-        displayTopResults(scores, mapping, indexPath, query, 10)
+        # Timing the retrieval. ChatGPT informed me of the library to use
+        # With --instrument, the phases of the retrieval and of the rendering are measured too.
+        with instruments.query():
+            start_time = time.time()
+            cacheKey = queryCacheKey(query, scorer.k1, scorer.b, TOP_N, showSnippets, args.impacts, args.postings_budget)
+            cached = resultCache.get(cacheKey)
+            if cached is not None:
+                scores, rendered = cached
+                instruments.count("resultCacheHits")
+            else:
+                try:
+                    # Only the results that are shown are needed, so let the scorer skip documents that can't make the top 10.
+                    if impactScorer is not None:
+                        scores = impactScorer.topK(query, TOP_N, args.postings_budget)
+                    else:
+                        scores = scorer.topK(query, TOP_N)
+                except ValueError as e:
+                    # Phrase queries on an index without positions.
+                    print(f"Error: {e}")
+                    continue
+            retrieval_time = time.time() - start_time
+
+            # Printing out the top N (N = 10) results to the terminal
+            if cached is None:
+                with instruments.phase("render"):
+                    rendered = renderTopResults(scores, mapping, indexPath, query, TOP_N, metadata, showSnippets, sentences)
+                resultCache.put(cacheKey, (scores, rendered))
+        for result in rendered:
+            print(result)
 
         print(f"Retrieval took {retrieval_time:.2f} seconds.")
+        if instruments.enabled:
+            print(f"Measured: {formatQuery(instruments.lastQuery)}")
 
         while True:
             # New query or quit
@@ -343,7 +640,8 @@ def main():
                 if 1 <= rank <= len(scores):
                     docId = scores[rank - 1][0]
                     docNo = mapping[docId]
-                    document_content = fetchDocumentByDocNo(indexPath, docNo)
+                    with instruments.phase("fetch"):
+                        document_content = fetchDocument(indexPath, docId, docNo)
                     print(document_content)
                 else:
                     print("Invalid rank number. Please try again.")
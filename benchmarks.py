@@ -0,0 +1,667 @@
+'''
+Benchmarks for the search engine.
+
+Usage:
+    python3 benchmarks.py tokenizer [--input <path_to_latimes.gz>] [--docs N] [--repeat R]
+    python3 benchmarks.py scoring <indexPath> [--queries <file with one query per line>] [--repeat R] [--top N]
+    python3 benchmarks.py impacts <indexPath> [--queries <file>] [--repeat R] [--top N] [--budgets 1000,10000]
+    python3 benchmarks.py boolean <indexPath> [--queries <file>] [--repeat R]
+    python3 benchmarks.py corpus <output.gz> [--docs N] [--seed S] [--vocabulary V] [--doc-words W]
+    python3 benchmarks.py suite [--docs N | --input <path_to_latimes.gz>] [--queries N] [--repeat R] [--output results.json]
+    python3 benchmarks.py compare <old.json> <new.json> [--threshold 0.1]
+    python3 benchmarks.py startup <indexPath> [--repeat R]
+
+The suite builds an index of a synthetic collection (see syntheticCorpus.py) or of a given one with indexEngine.py,
+and measures build throughput and peak memory, index load time and query latency percentiles. Its JSON results
+record the commit they were measured on, so results from two commits can be compared with the compare command.
+
+Acknowledgements:
+- Reference for timeit: https://docs.python.org/3/library/timeit.html
+- Reference for os.wait4 (resource usage of a finished child process): https://docs.python.org/3/library/os.html#os.wait4
+- Nearest-rank percentiles: https://en.wikipedia.org/wiki/Percentile#The_nearest-rank_method
+'''
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from textAnalysis import tokenize, removeTags
+from syntheticCorpus import DEFAULT_VOCABULARY, DEFAULT_DOC_WORDS
+
+# Sample text with tags, punctuation, digits and some non-ASCII letters, used when no collection is given.
+SAMPLE_DOCUMENT = (
+    "<HEADLINE>\n<P>\nCOUNCIL OKS $1.2-BILLION BUDGET; O'NEIL ABSTAINS\n</P>\n</HEADLINE>\n"
+    "<TEXT>\n<P>\nThe Los Angeles City Council on Tuesday approved a 1989-90 budget of $1.2 billion, "
+    "after three hours of debate over police & fire funding (see Page 3). Café owners in Echo Park "
+    "said the naïve plan > last year's <B>draft</B>.\n</P>\n<P>\nMayor Tom Bradley is expected to sign it.\n</P>\n</TEXT>\n"
+)
+
+
+def legacyTokenize(text):
+    """
+    The original character-by-character tokenizer from indexEngine.py, kept here to compare against.
+    """
+    tokens = []
+    text = text.lower()
+    start = 0  # Starting index of a potential token
+
+    for i in range(len(text)):
+        if not text[i].isalnum():  # If the character is not alphanumeric
+            if start != i:  # If there's a potential token between start and i
+                token = text[start:i]
+                tokens.append(token)
+            start = i + 1  # Update the starting index for the next potential token
+
+    # Handles the case where the last token extends to the end of the text
+    if start < len(text):
+        tokens.append(text[start:])
+
+    return tokens
+
+
+def legacyRemoveTags(content):
+    """
+    The original character-by-character tag stripper from indexEngine.py, kept here to compare against.
+    """
+    result = []
+    inside_tag = False
+    for char in content:
+        if char == '<':
+            inside_tag = True
+        elif char == '>':
+            inside_tag = False
+        elif not inside_tag:
+            result.append(char)
+    return ''.join(result)
+
+
+def loadDocuments(inputPath, numDocs):
+    """
+    The first numDocs <DOC> blocks of a collection, or copies of the sample document if there is no collection.
+    """
+    if inputPath is None:
+        return [SAMPLE_DOCUMENT] * numDocs
+    from indexEngine import readDocuments
+    return list(itertools.islice(readDocuments(inputPath), numDocs))
+
+
+def timeBest(function, repeat):
+    # Best of the repeats, since the slower ones are mostly noise from the rest of the machine.
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def benchmarkTokenizer(documents, repeat):
+    """
+    Times the original and the regular expression versions of tag removal and tokenization on the same documents,
+    after checking that they produce identical output.
+    """
+    for document in documents:
+        if legacyRemoveTags(document) != removeTags(document):
+            raise AssertionError("removeTags does not match the original implementation.")
+        if legacyTokenize(legacyRemoveTags(document)) != tokenize(removeTags(document)):
+            raise AssertionError("tokenize does not match the original implementation.")
+
+    cleaned = [removeTags(document) for document in documents]
+    totalMB = sum(len(document) for document in documents) / 1e6
+    timings = [
+        ("removeTags (original)", timeBest(lambda: [legacyRemoveTags(d) for d in documents], repeat)),
+        ("removeTags", timeBest(lambda: [removeTags(d) for d in documents], repeat)),
+        ("tokenize (original)", timeBest(lambda: [legacyTokenize(d) for d in cleaned], repeat)),
+        ("tokenize", timeBest(lambda: [tokenize(d) for d in cleaned], repeat)),
+    ]
+    print(f"{len(documents)} documents, {totalMB:.2f} MB, best of {repeat}")
+    for name, seconds in timings:
+        print(f"{name:<22} {seconds * 1000:>10.1f} ms {totalMB / seconds:>10.1f} MB/s")
+
+
+# Queries used when no query file is given: rare words, common words and a repeated word. The last three have
+# several common words, which topK can't prune (it has to fall back on scoring everything, and mustn't be slower).
+SAMPLE_QUERIES = [
+    "earthquake",
+    "police city",
+    "the tax budget",
+    "soviet union talks",
+    "los angeles los",
+    "drug war in the city",
+    "police city the",
+    "said the police",
+    "earthquake in the city of los angeles",
+]
+
+
+def loadQueries(queriesPath):
+    if queriesPath is None:
+        return SAMPLE_QUERIES
+    with open(queriesPath, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def benchmarkScoring(indexPath, queries, repeat, topN):
+    """
+    Times BM25.bm25 against the term-at-a-time BM25Scorer and its pruned top N retrieval on the same queries,
+    after checking that they return the same ranking. The last column is topK's time over BM25Scorer's, which
+    should never be much above 1 (pruning that can't pay off falls back on scoring everything).
+    """
+    from BM25 import loadIndex, bm25
+    from scoring import BM25Scorer
+
+    lexicon, invertedIndex, docLengths, _, stats = loadIndex(indexPath)
+    scorer = BM25Scorer(lexicon, invertedIndex, docLengths, stats)
+
+    def original(query):
+        return bm25(query, lexicon, invertedIndex, docLengths, stats.avgDl, stats.N, 1.2, 0.75, stats.idf)
+
+    print(f"{'query':<28} {'bm25':>12} {'BM25Scorer':>12} {f'topK({topN})':>12} {'topK/scorer':>12}")
+    slower = 0
+    for query in queries:
+        ranking = original(query)
+        if ranking != scorer.score(query):
+            raise AssertionError(f"BM25Scorer does not rank {query!r} the same as bm25.")
+        if ranking[:topN] != scorer.topK(query, topN):
+            raise AssertionError(f"BM25Scorer.topK does not return the top {topN} of bm25 for {query!r}.")
+        originalSeconds = timeBest(lambda: original(query), repeat)
+        scorerSeconds = timeBest(lambda: scorer.score(query), repeat)
+        topKSeconds = timeBest(lambda: scorer.topK(query, topN), repeat)
+        ratio = topKSeconds / scorerSeconds
+        # Allow for timing noise.
+        if ratio > 1.1:
+            slower += 1
+        print(f"{query[:28]:<28} {originalSeconds * 1000:>9.1f} ms {scorerSeconds * 1000:>9.1f} ms {topKSeconds * 1000:>9.1f} ms "
+              f"{ratio:>12.2f}")
+    print(f"topK was more than 10% slower than BM25Scorer on {slower} of {len(queries)} queries")
+
+
+def checkImpactRanking(query, impactScorer, scorer, topN):
+    """
+    Checks that without a budget, the impact top N is BM25's top N up to the rounding of the impacts: every
+    contribution is rounded by at most half of 1 / scale, so the score at each rank of the two rankings can only
+    differ by the rounding error of two documents' sums (times the number of query term occurrences).
+    """
+    exactScores = dict(scorer.score(query))
+    exact = scorer.topK(query, topN)
+    ranking = impactScorer.topK(query, topN)
+    tokens = tokenize(query)
+    roundingError = len(tokens) * len(set(tokens)) * 0.5 / impactScorer.readers[0].scale
+    if len(ranking) != len(exact) or any(abs(exactScores[docId] - exactScore) > 2 * roundingError + 1e-9
+                                         for (docId, _), (_, exactScore) in zip(ranking, exact)):
+        raise AssertionError(f"The impact top {topN} of {query!r} is not BM25's up to the rounding of the impacts.")
+
+
+def benchmarkImpacts(indexPath, queries, repeat, topN, budgets):
+    """
+    Times score-at-a-time retrieval from the impact-ordered postings at several postings budgets, and how many
+    of its top N are also in the exact BM25 top N, after checking that without a budget it ranks like BM25.
+    """
+    from BM25 import loadIndex
+    from scoring import BM25Scorer
+    from impactIndex import ImpactScorer
+    from segments import readManifest
+
+    lexicon, invertedIndex, docLengths, _, stats = loadIndex(indexPath)
+    scorer = BM25Scorer(lexicon, invertedIndex, docLengths, stats)
+    impactScorer = ImpactScorer(indexPath, lexicon, invertedIndex, docLengths)
+    if not readManifest(indexPath):
+        # Appended segments have impacts worked out with their own statistics, so they only rank roughly like BM25.
+        for query in queries:
+            checkImpactRanking(query, impactScorer, scorer, topN)
+
+    exactTop = {query: {docId for docId, _ in scorer.topK(query, topN)} for query in queries}
+    exactSeconds = sum(timeBest(lambda: scorer.topK(query, topN), repeat) for query in queries)
+    print(f"{'budget':<12} {'mean latency':>14} {'max latency':>13} {f'overlap@{topN}':>12}")
+    print(f"{'exact topK':<12} {exactSeconds / len(queries) * 1000:>11.1f} ms {'':>13} {1:>12.3f}")
+    for budget in budgets:
+        latencies = []
+        overlap = 0
+        for query in queries:
+            latencies.append(timeBest(lambda: impactScorer.topK(query, topN, budget), repeat))
+            found = {docId for docId, _ in impactScorer.topK(query, topN, budget)}
+            overlap += len(found & exactTop[query]) / max(len(exactTop[query]), 1)
+        name = "all" if budget is None else str(budget)
+        print(f"{name:<12} {sum(latencies) / len(latencies) * 1000:>11.1f} ms {max(latencies) * 1000:>10.1f} ms {overlap / len(queries):>12.3f}")
+
+
+def legacyBooleanAND(query, lexicon, invertedIndex):
+    """
+    The original booleanAND.booleanANDRetrieval (a linear lexicon scan per token and Python sets intersected in
+    query order), kept here to compare against. lexicon maps termIDs to terms.
+    """
+    docSets = []
+    for token in tokenize(query):
+        termID = None
+        for i, j in lexicon.items():
+            if j == token:
+                termID = i
+                break
+        if termID is not None:
+            if termID in invertedIndex:
+                docSets.append(set([doc[0] for doc in invertedIndex[termID]]))
+    if not docSets:
+        return []
+    resultSet = docSets[0]
+    for docSet in docSets[1:]:
+        resultSet = resultSet.intersection(docSet)
+    return list(resultSet)
+
+
+def benchmarkBoolean(indexPath, queries, repeat):
+    """
+    Times the original Boolean AND retrieval against BooleanEngine on the same queries, after checking that they
+    find the same documents and that the engine returns them in docID order.
+    """
+    import booleanAND
+
+    engine, _ = booleanAND.loadBooleanEngine(indexPath)
+    # The original took termID -> term, and a dictionary with every postings list in it.
+    lexicon = {termId: term for term, termId in engine.lexicon.items()}
+    invertedIndex = {termId: engine.invertedIndex.get(termId, []) for termId in engine.lexicon.values()
+                     if engine.documentFrequency(termId)}
+    print(f"{'query':<28} {'results':>8} {'original':>12} {'engine':>12} {'cold':>12}")
+    for query in queries:
+        found = booleanAND.booleanEngineRetrieval(query, engine)
+        if sorted(legacyBooleanAND(query, lexicon, invertedIndex)) != found:
+            raise AssertionError(f"BooleanEngine does not find the same documents as the original for {query!r}.")
+        if booleanAND.booleanANDRetrieval(query, lexicon, invertedIndex) != found:
+            raise AssertionError(f"booleanANDRetrieval with the original arguments does not find the same documents for {query!r}.")
+        originalSeconds = timeBest(lambda: legacyBooleanAND(query, lexicon, invertedIndex), repeat)
+        engineSeconds = timeBest(lambda: booleanAND.booleanEngineRetrieval(query, engine), repeat)
+
+        def cold():
+            # Without the cached docID arrays and bitmaps.
+            engine.cache.clear()
+            engine.cachedDocIds = 0
+            booleanAND.booleanEngineRetrieval(query, engine)
+        coldSeconds = timeBest(cold, repeat)
+        print(f"{query[:28]:<28} {len(found):>8} {originalSeconds * 1000:>9.2f} ms {engineSeconds * 1000:>9.2f} ms {coldSeconds * 1000:>9.2f} ms")
+
+
+RESULTS_VERSION = 1
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(sortedValues, p):
+    """
+    The nearest-rank p-th percentile of an already sorted list.
+    """
+    rank = max(1, -(-len(sortedValues) * p // 100))  # ceil(n * p / 100)
+    return sortedValues[int(rank) - 1]
+
+
+def latencySummary(latencies):
+    """
+    Count, mean, p50, p95, p99 and max of a list of latencies in seconds, in milliseconds.
+    """
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "meanMs": sum(latencies) / len(latencies) * 1000,
+        "p50Ms": percentile(latencies, 50) * 1000,
+        "p95Ms": percentile(latencies, 95) * 1000,
+        "p99Ms": percentile(latencies, 99) * 1000,
+        "maxMs": latencies[-1] * 1000,
+    }
+
+
+def directorySize(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def gitCommit():
+    """
+    The commit the code was measured at (with "-dirty" if there are uncommitted changes), or None outside a git checkout.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=HERE, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if status.strip() else "")
+
+
+def buildIndexProcess(inputPath, indexPath, extraArgs):
+    """
+    Runs indexEngine.py in its own process, so its peak memory can be measured on its own.
+    Returns:
+        tuple: (wall seconds, peak resident set size in bytes, or None where os.wait4 is not available)
+    """
+    command = [sys.executable, os.path.join(HERE, "indexEngine.py"), inputPath, indexPath] + extraArgs
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    if hasattr(os, "wait4"):
+        # ru_maxrss of the child (and of the worker processes it waited for) is in kilobytes on Linux and bytes on macOS.
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        peakRss = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    else:
+        process.wait()
+        peakRss = None
+    seconds = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError(f"indexEngine.py failed with exit code {process.returncode}: {' '.join(command)}")
+    return seconds, peakRss
+
+
+def benchmarkLatency(function, queries, repeat):
+    """
+    Runs every query once to warm up the postings cache and the page cache, then times each query on its own,
+    repeat times over.
+    """
+    for query in queries:
+        function(query)
+    latencies = []
+    for _ in range(repeat):
+        for query in queries:
+            start = time.perf_counter()
+            function(query)
+            latencies.append(time.perf_counter() - start)
+    return latencySummary(latencies)
+
+
+def runSuite(args):
+    """
+    Builds, loads and queries an index, and returns the measurements as a dictionary.
+    """
+    from BM25 import loadIndex
+    from scoring import BM25Scorer
+    import booleanAND
+    from syntheticCorpus import writeCollection, collectionQueries
+    from indexSnapshot import writeSnapshot
+
+    workDir = args.keep or tempfile.mkdtemp(prefix="benchmark-")
+    os.makedirs(workDir, exist_ok=True)
+    indexPath = os.path.join(workDir, "index")
+    if os.path.exists(indexPath):
+        shutil.rmtree(indexPath)
+    try:
+        # The collection: a synthetic one (the same bytes for the same seed and sizes), or the given one.
+        if args.input:
+            collectionPath = args.input
+            corpus = {"input": os.path.basename(args.input)}
+        else:
+            collectionPath = os.path.join(workDir, "collection.gz")
+            start = time.perf_counter()
+            uncompressedBytes = writeCollection(collectionPath, args.docs, args.seed, args.vocabulary, args.doc_words)
+            corpus = {"synthetic": True, "docs": args.docs, "seed": args.seed, "vocabulary": args.vocabulary,
+                      "docWords": args.doc_words, "uncompressedBytes": uncompressedBytes,
+                      "generateSeconds": time.perf_counter() - start}
+        corpus["compressedBytes"] = os.path.getsize(collectionPath)
+        print(f"Collection: {collectionPath} ({corpus['compressedBytes'] / 1e6:.1f} MB compressed)", file=sys.stderr)
+
+        # Building the index.
+        extraArgs = ["--workers", str(args.workers)]
+        if args.memory_budget is not None:
+            extraArgs += ["--memory-budget", str(args.memory_budget)]
+        buildSeconds, peakRss = buildIndexProcess(collectionPath, indexPath, extraArgs)
+        indexBytes = directorySize(indexPath)
+
+        # Loading it, as BM25.py and booleanAND.py do.
+        start = time.perf_counter()
+        lexicon, invertedIndex, docLengths, _, stats = loadIndex(indexPath, useSnapshot=False)
+        scorer = BM25Scorer(lexicon, invertedIndex, docLengths, stats)
+        bm25LoadSeconds = time.perf_counter() - start
+        # The same from the index snapshot (indexSnapshot.py).
+        start = time.perf_counter()
+        writeSnapshot(indexPath)
+        snapshotWriteSeconds = time.perf_counter() - start
+        start = time.perf_counter()
+        snapshotIndex = loadIndex(indexPath)
+        BM25Scorer(snapshotIndex[0], snapshotIndex[1], snapshotIndex[2], snapshotIndex[4])
+        snapshotLoadSeconds = time.perf_counter() - start
+        start = time.perf_counter()
+        booleanEngine, _ = booleanAND.loadBooleanEngine(indexPath)
+        booleanLoadSeconds = time.perf_counter() - start
+
+        numDocs = len(docLengths)
+        inputBytes = corpus.get("uncompressedBytes", corpus["compressedBytes"])
+        build = {"seconds": buildSeconds, "docsPerSecond": numDocs / buildSeconds,
+                 "megabytesPerSecond": inputBytes / 1e6 / buildSeconds,
+                 "peakRssMB": None if peakRss is None else peakRss / 1e6,
+                 "indexBytes": indexBytes, "snapshotSeconds": snapshotWriteSeconds,
+                 "numDocs": numDocs, "numTerms": len(lexicon)}
+        print(f"Built {numDocs} documents in {buildSeconds:.1f} s", file=sys.stderr)
+
+        # Query latency.
+        if args.queries_file:
+            queries = loadQueries(args.queries_file)
+        else:
+            queries = collectionQueries(args.queries, args.seed, args.vocabulary)
+        queryResults = {
+            "bm25Top10": benchmarkLatency(lambda query: scorer.topK(query, 10), queries, args.repeat),
+            "bm25Top1000": benchmarkLatency(lambda query: scorer.topK(query, 1000), queries, args.repeat),
+            "booleanAND": benchmarkLatency(lambda query: booleanAND.booleanEngineRetrieval(query, booleanEngine), queries, args.repeat),
+        }
+    finally:
+        if not args.keep:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    return {
+        "version": RESULTS_VERSION,
+        "commit": gitCommit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "parameters": {"workers": args.workers, "memoryBudgetMB": args.memory_budget, "repeat": args.repeat,
+                       "numQueries": len(queries), "queriesFile": args.queries_file},
+        "corpus": corpus,
+        "build": build,
+        "load": {"bm25Seconds": bm25LoadSeconds, "bm25SnapshotSeconds": snapshotLoadSeconds, "booleanANDSeconds": booleanLoadSeconds},
+        "queries": queryResults,
+    }
+
+
+def printSuite(results):
+    build = results["build"]
+    peak = "n/a" if build["peakRssMB"] is None else f"{build['peakRssMB']:.0f} MB"
+    print(f"commit {results['commit']}, {build['numDocs']} documents, {build['numTerms']} terms")
+    print(f"build   {build['seconds']:.1f} s, {build['docsPerSecond']:.0f} docs/s, {build['megabytesPerSecond']:.2f} MB/s, "
+          f"peak RSS {peak}, index {build['indexBytes'] / 1e6:.1f} MB")
+    print(f"load    bm25 {results['load']['bm25Seconds'] * 1000:.0f} ms (from the snapshot {results['load']['bm25SnapshotSeconds'] * 1000:.1f} ms), "
+          f"booleanAND {results['load']['booleanANDSeconds'] * 1000:.0f} ms")
+    print(f"{'queries':<12} {'mean':>10} {'p50':>10} {'p95':>10} {'p99':>10} {'max':>10}")
+    for name, summary in results["queries"].items():
+        print(f"{name:<12} " + " ".join(f"{summary[key]:>7.2f} ms" for key in ("meanMs", "p50Ms", "p95Ms", "p99Ms", "maxMs")))
+
+
+def flattenMeasurements(results):
+    """
+    The numbers to compare between two runs, as {"section.name": value}. Only build, load and query measurements
+    are compared (not the sizes of the corpus or the parameters).
+    """
+    flat = {}
+    for section in ("build", "load", "queries"):
+        for key, value in results.get(section, {}).items():
+            if isinstance(value, dict):
+                for innerKey, innerValue in value.items():
+                    if innerKey != "count":
+                        flat[f"{section}.{key}.{innerKey}"] = innerValue
+            elif key not in ("numDocs", "numTerms"):
+                flat[f"{section}.{key}"] = value
+    return flat
+
+
+def compareResults(old, new, threshold):
+    """
+    Prints every measurement of two suite results side by side and returns the names of those that got worse by
+    more than threshold (a fraction). Throughput is worse when it goes down, everything else when it goes up.
+    """
+    for key in ("corpus", "parameters"):
+        # The time taken to generate the collection doesn't change what was measured.
+        oldSettings = {name: value for name, value in old.get(key, {}).items() if name != "generateSeconds"}
+        newSettings = {name: value for name, value in new.get(key, {}).items() if name != "generateSeconds"}
+        if oldSettings != newSettings:
+            print(f"Warning: the two runs have different {key}, so they may not be comparable.")
+    oldValues, newValues = flattenMeasurements(old), flattenMeasurements(new)
+    regressions = []
+    print(f"{'measurement':<32} {old.get('commit') or 'old':>14.14} {new.get('commit') or 'new':>14.14} {'change':>9}")
+    for name, oldValue in oldValues.items():
+        newValue = newValues.get(name)
+        if oldValue is None or newValue is None:
+            continue
+        change = (newValue - oldValue) / oldValue if oldValue else 0.0
+        higherIsBetter = name.endswith("PerSecond")
+        worse = -change if higherIsBetter else change
+        flag = ""
+        if worse > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<32} {oldValue:>14.3f} {newValue:>14.3f} {change:>+8.1%}{flag}")
+    return regressions
+
+
+# Run in a new Python process to time a cold start: imports, loading the index and answering a first query.
+STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+from BM25 import loadIndex
+from scoring import BM25Scorer
+lexicon, invertedIndex, docLengths, mapping, stats = loadIndex(sys.argv[1], useSnapshot=sys.argv[2] == "snapshot")
+BM25Scorer(lexicon, invertedIndex, docLengths, stats).topK("police", 10)
+print(time.perf_counter() - start)
+"""
+
+
+def benchmarkStartup(indexPath, repeat):
+    """
+    Times loading an index from its text files and from its snapshot (indexSnapshot.py, written first if it is
+    missing or out of date), step by step in this process and from the start of a new process to a first answer.
+    """
+    import BM25
+    from collectionStats import loadCollectionStats
+    from scoring import BM25Scorer
+    from indexSnapshot import Snapshot, openSnapshot, writeSnapshot, SNAPSHOT_FILE
+
+    if openSnapshot(indexPath) is None:
+        seconds = timeBest(lambda: writeSnapshot(indexPath), 1)
+        print(f"Wrote the snapshot in {seconds:.2f} s.")
+    snapshotPath = os.path.join(indexPath, SNAPSHOT_FILE)
+
+    lexicon, invertedIndex, docLengths, _, stats = BM25.loadIndex(indexPath, useSnapshot=False)
+    snapshot = Snapshot(snapshotPath)
+    timings = [
+        ("loadLexicon", timeBest(lambda: BM25.loadLexicon(indexPath), repeat)),
+        ("loadInvertedIndex", timeBest(lambda: BM25.loadInvertedIndex(indexPath), repeat)),
+        ("loadDocLengths", timeBest(lambda: BM25.loadDocLengths(indexPath), repeat)),
+        ("loadMapping", timeBest(lambda: BM25.loadMapping(indexPath), repeat)),
+        ("loadCollectionStats", timeBest(lambda: loadCollectionStats(indexPath, invertedIndex, docLengths, len(lexicon)), repeat)),
+        ("BM25Scorer", timeBest(lambda: BM25Scorer(lexicon, invertedIndex, docLengths, stats), repeat)),
+        ("loadIndex (text files)", timeBest(lambda: BM25.loadIndex(indexPath, useSnapshot=False), repeat)),
+        ("Snapshot", timeBest(lambda: Snapshot(snapshotPath), repeat)),
+        ("Snapshot (no checksum)", timeBest(lambda: Snapshot(snapshotPath, verify=False), repeat)),
+        ("BM25Scorer (snapshot)", timeBest(lambda: BM25Scorer(snapshot.lexicon, invertedIndex, snapshot.docLengths, snapshot.stats), repeat)),
+        ("loadIndex (snapshot)", timeBest(lambda: BM25.loadIndex(indexPath), repeat)),
+    ]
+    print(f"{len(docLengths)} documents, {len(lexicon)} terms, snapshot {os.path.getsize(snapshotPath) / 1e6:.1f} MB, best of {repeat}")
+    for name, seconds in timings:
+        print(f"{name:<42} {seconds * 1000:>10.1f} ms")
+
+    # A cold start: a new interpreter that imports the code, loads the index and answers one query.
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [HERE, os.environ.get("PYTHONPATH")])))
+    for mode in ("text", "snapshot"):
+        best = min(float(subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, indexPath, mode], env=environment,
+                                        capture_output=True, text=True, check=True).stdout.split()[-1])
+                   for _ in range(repeat))
+        print(f"{f'new process to first answer ({mode})':<42} {best * 1000:>10.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the search engine")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    tokenizerParser = subparsers.add_parser("tokenizer", help="Compare the tokenizer and tag stripper with the original versions")
+    tokenizerParser.add_argument("--input", help="Gzip collection to take documents from (default: a built-in sample document)")
+    tokenizerParser.add_argument("--docs", type=int, default=2000, help="Number of documents (default: 2000)")
+    tokenizerParser.add_argument("--repeat", type=int, default=5, help="Number of timing repeats (default: 5)")
+
+    scoringParser = subparsers.add_parser("scoring", help="Compare BM25.bm25 with the term-at-a-time scorer and its top N retrieval")
+    scoringParser.add_argument("indexPath", help="Directory containing the index files")
+    scoringParser.add_argument("--queries", help="File with one query per line (default: a few built-in queries)")
+    scoringParser.add_argument("--repeat", type=int, default=3, help="Number of timing repeats (default: 3)")
+    scoringParser.add_argument("--top", type=int, default=10, help="Number of results for topK (default: 10)")
+
+    impactsParser = subparsers.add_parser("impacts", help="Latency and overlap with exact BM25 of impact-ordered retrieval at several postings budgets")
+    impactsParser.add_argument("indexPath", help="Directory containing an index built with indexEngine.py --impacts")
+    impactsParser.add_argument("--queries", help="File with one query per line (default: a few built-in queries)")
+    impactsParser.add_argument("--repeat", type=int, default=3, help="Number of timing repeats (default: 3)")
+    impactsParser.add_argument("--top", type=int, default=10, help="Number of results (default: 10)")
+    impactsParser.add_argument("--budgets", default="1000,10000,100000", help="Comma separated postings budgets (default: 1000,10000,100000)")
+
+    booleanParser = subparsers.add_parser("boolean", help="Compare the original Boolean AND retrieval with BooleanEngine")
+    booleanParser.add_argument("indexPath", help="Directory containing the index files")
+    booleanParser.add_argument("--queries", help="File with one query per line (default: a few built-in queries)")
+    booleanParser.add_argument("--repeat", type=int, default=3, help="Number of timing repeats (default: 3)")
+
+    corpusParser = subparsers.add_parser("corpus", help="Write a synthetic LA Times style collection")
+    corpusParser.add_argument("outputPath", help="Gzip file to write")
+    corpusParser.add_argument("--docs", type=int, default=10000, help="Number of documents (default: 10000)")
+    corpusParser.add_argument("--seed", type=int, default=1, help="Random seed; the same seed and sizes give the same file (default: 1)")
+    corpusParser.add_argument("--vocabulary", type=int, default=DEFAULT_VOCABULARY, help=f"Number of distinct words (default: {DEFAULT_VOCABULARY})")
+    corpusParser.add_argument("--doc-words", type=int, default=DEFAULT_DOC_WORDS, help=f"Average number of words per document (default: {DEFAULT_DOC_WORDS})")
+
+    suiteParser = subparsers.add_parser("suite", help="Build, load and query an index and write the measurements as JSON")
+    suiteParser.add_argument("--input", help="Gzip collection to index (default: a synthetic one)")
+    suiteParser.add_argument("--docs", type=int, default=20000, help="Number of synthetic documents (default: 20000)")
+    suiteParser.add_argument("--seed", type=int, default=1, help="Random seed of the synthetic collection and queries (default: 1)")
+    suiteParser.add_argument("--vocabulary", type=int, default=DEFAULT_VOCABULARY, help=f"Number of distinct synthetic words (default: {DEFAULT_VOCABULARY})")
+    suiteParser.add_argument("--doc-words", type=int, default=DEFAULT_DOC_WORDS, help=f"Average words per synthetic document (default: {DEFAULT_DOC_WORDS})")
+    suiteParser.add_argument("--queries", type=int, default=200, help="Number of synthetic queries (default: 200)")
+    suiteParser.add_argument("--queries-file", help="File with one query per line, instead of synthetic queries")
+    suiteParser.add_argument("--repeat", type=int, default=3, help="Times every query is timed, after one warm-up run (default: 3)")
+    suiteParser.add_argument("--workers", type=int, default=1, help="indexEngine.py --workers (default: 1)")
+    suiteParser.add_argument("--memory-budget", type=int, metavar="MB", help="indexEngine.py --memory-budget")
+    suiteParser.add_argument("--output", help="JSON file to write the results to")
+    suiteParser.add_argument("--keep", metavar="DIR", help="Build in DIR and keep the collection and index (default: a temporary directory)")
+
+    compareParser = subparsers.add_parser("compare", help="Compare two suite results and exit with status 1 if anything regressed")
+    compareParser.add_argument("old", help="JSON results of the baseline")
+    compareParser.add_argument("new", help="JSON results to check")
+    compareParser.add_argument("--threshold", type=float, default=0.1, help="Relative change counted as a regression (default: 0.1)")
+
+    startupParser = subparsers.add_parser("startup", help="Time loading an index from its text files and from its snapshot")
+    startupParser.add_argument("indexPath", help="Directory containing the index files (its snapshot is written if it is missing)")
+    startupParser.add_argument("--repeat", type=int, default=3, help="Number of timing repeats (default: 3)")
+
+    args = parser.parse_args()
+    if args.command == "tokenizer":
+        benchmarkTokenizer(loadDocuments(args.input, args.docs), args.repeat)
+    elif args.command == "scoring":
+        benchmarkScoring(args.indexPath, loadQueries(args.queries), args.repeat, args.top)
+    elif args.command == "impacts":
+        budgets = [int(budget) for budget in args.budgets.split(",")] + [None]
+        benchmarkImpacts(args.indexPath, loadQueries(args.queries), args.repeat, args.top, budgets)
+    elif args.command == "boolean":
+        benchmarkBoolean(args.indexPath, loadQueries(args.queries), args.repeat)
+    elif args.command == "corpus":
+        from syntheticCorpus import writeCollection
+        totalBytes = writeCollection(args.outputPath, args.docs, args.seed, args.vocabulary, args.doc_words)
+        print(f"Wrote {args.docs} documents ({totalBytes / 1e6:.1f} MB uncompressed) to {args.outputPath}")
+    elif args.command == "suite":
+        if min(args.docs, args.queries, args.repeat, args.workers, args.vocabulary, args.doc_words) < 1:
+            parser.error("--docs, --queries, --repeat, --workers, --vocabulary and --doc-words must be at least 1")
+        results = runSuite(args)
+        printSuite(results)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+                f.write("\n")
+    elif args.command == "startup":
+        benchmarkStartup(args.indexPath, args.repeat)
+    elif args.command == "compare":
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        regressions = compareResults(old, new, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} measurements regressed by more than {args.threshold:.0%}.")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
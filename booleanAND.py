@@ -1,31 +1,67 @@
 '''
+Boolean AND retrieval: the documents that contain every word of the query, in docID order.
+
+Usage:
+    python3 booleanAND.py <index_path> <topics_file> <output_file> [--exclude 416,423] [--language [--explain]]
+
+BooleanEngine looks terms up in a hash table (the lexicon dictionary, term -> termID) and intersects their docID
+lists rarest first, so the candidates shrink as fast as possible and the work is bounded by the rarest list:
+- docIDs are decoded once per term into an array and kept in an LRU cache;
+- a list that is much longer than the candidates is searched by galloping (exponential search, then binary search
+  from where the last candidate was found) instead of being walked;
+- terms in a large share of the documents also get a bitmap, and candidates are checked against the bitmaps with
+  one bit test each (several bitmaps are ANDed together first).
+The document frequencies come from the postings file's table, so ordering the terms decodes nothing.
+With --language the titles are read as queries with AND, OR, NOT and parentheses, planned by booleanQuery.py.
+
 Acknowledgements:
 - Used Chat GPT to explain certain concepts such as using the sys and os packages.
 - Used Stack Overflow, Geeks for Geeks, and Campuswire for help with syntax as well as some design influence.
 - Will provide URLs for all links that are worth crediting and referencing.
 - I have collaborated with Inesh Jacob and Vyomesh Iyengar on the logic of this program.
+- Rarest-first intersection and skipping through postings are from the query processing lecture and chapter 2.3
+  of Introduction to Information Retrieval (Manning, Raghavan, Schutze).
+- Galloping search is from Bentley and Yao, "An almost optimal algorithm for unbounded searching" (1976), as used
+  for list intersection by Demaine, Lopez-Ortiz and Munro, "Adaptive set intersection, unions, and differences" (2000).
+- Reference for bisect: https://docs.python.org/3/library/bisect.html
 '''
 
 import os
-import sys
+import heapq
+import argparse
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from textAnalysis import tokenize
+from postingsFile import PostingsReader, DEFAULT_CACHE_POSTINGS
+from segments import readManifest, loadSegmentedIndex
+from phraseQuery import parsePhrases, matchingDocuments
+from topics import readTopics
 
 # Global Variables - mainly file names and exempt search topics.
 LEXICON_FILE = "lexicon.txt"
-INVERTED_INDEX_FILE = "inverted_index.txt"
+INVERTED_INDEX_FILE = "inverted_index.bin"
+TEXT_INVERTED_INDEX_FILE = "inverted_index.txt"  # older indexes
 MAPPING_FILE = "mapping.txt"
 DOC_LENGTHS_FILE = "doc_lengths.txt"
 EXCLUDED_TOPICS = {"416", "423", "437", "444", "447"}
+RUN_TAG = "yabadeerAND"
+
+# A term in at least this share of the documents also gets a bitmap: it then takes no more room than its docIDs would.
+BITMAP_DENSITY = 1 / 32
+# A list this many times longer than the candidates is searched by galloping instead of being walked.
+GALLOP_RATIO = 4
 
 
 def loadLexicon(indexPath):
     """
-    Load the lexicon from the lexicon file.
+    Load the lexicon from the lexicon file, as a hash table from each term to its termID.
     """
     lexicon = {}
     with open(os.path.join(indexPath, LEXICON_FILE), 'r') as f:
         for line in f:
             termID, term = line.strip().split(":")
-            lexicon[int(termID)] = term
+            lexicon[term] = int(termID)
     return lexicon
 
 def loadInvertedIndex(indexPath):
@@ -33,9 +69,14 @@ def loadInvertedIndex(indexPath):
     Load the inverted index from the file.
     This was a bit challenging due to the format of my inverted_index.txt file structure:
     termID: docID:count, docID:count, docID:count, ...
+    Indexes built now have the binary postings file instead, which is memory mapped and decoded lazily.
     """
+    binaryPath = os.path.join(indexPath, INVERTED_INDEX_FILE)
+    if os.path.exists(binaryPath):
+        return PostingsReader(binaryPath)
+
     invertedIndex = {}
-    with open(os.path.join(indexPath, INVERTED_INDEX_FILE), 'r') as f:
+    with open(os.path.join(indexPath, TEXT_INVERTED_INDEX_FILE), 'r') as f:
         for line in f:
             # Split only once on the first colon for termID.
             termID_str, postings_str = line.strip().split(":", 1)
@@ -60,60 +101,304 @@ def loadMapping(indexPath):
     return mapping
 
 
-def tokenize(text):
+def gallop(docIds, docId, position, size):
     """
-    Tokenizes the given text by downcasing all characters and treating sequences of alphanumerics as tokens.
-    Using mainly the pseudocode from the lectures.
-    This function is the same one as seen in the indexEngine.py program.
+    The position of the first entry of docIds (sorted) from position on that is at least docId.
+    The step doubles until it passes docId, then a binary search finds it, so only about log(distance) entries are looked at.
     """
-    tokens = []
-    text = text.lower()
-    start = 0  # Starting index of a potential token
+    if position >= size or docIds[position] >= docId:
+        return position
+    step = 1
+    end = position + 1
+    while end < size and docIds[end] < docId:
+        position = end + 1
+        step *= 2
+        end = position + step
+    return bisect_left(docIds, docId, position, min(end, size))
 
-    for i in range(len(text)):
-        if not text[i].isalnum():  # If the character is not alphanumeric
-            if start != i:  # If there's a potential token between start and i
-                token = text[start:i]
-                tokens.append(token)
-            start = i + 1  # Update the starting index for the next potential token
+def gallopIntersect(candidates, docIds):
+    """
+    The candidates (sorted) that are also in docIds (sorted, usually much longer), in order.
+    Each search starts where the previous candidate's ended, so docIds is crossed once at most.
+    """
+    result = []
+    position = 0
+    size = len(docIds)
+    for docId in candidates:
+        position = gallop(docIds, docId, position, size)
+        if position >= size:
+            break
+        if docIds[position] == docId:
+            result.append(docId)
+            position += 1
+    return result
 
-    # Handles the case where the last token extends to the end of the text
-    if start < len(text):
-        tokens.append(text[start:])
+def gallopDifference(candidates, docIds):
+    """
+    The candidates (sorted) that are not in docIds (sorted, usually much longer), in order.
+    """
+    result = []
+    position = 0
+    size = len(docIds)
+    for docId in candidates:
+        position = gallop(docIds, docId, position, size)
+        if position < size and docIds[position] == docId:
+            position += 1
+        else:
+            result.append(docId)
+    return result
 
-    return tokens
+def mergeIntersect(candidates, docIds):
+    """
+    The candidates that are also in docIds, by walking both sorted lists once. Best when they are about the same length.
+    """
+    result = []
+    i = j = 0
+    numCandidates, size = len(candidates), len(docIds)
+    while i < numCandidates and j < size:
+        candidate, docId = candidates[i], docIds[j]
+        if candidate == docId:
+            result.append(candidate)
+            i += 1
+            j += 1
+        elif candidate < docId:
+            i += 1
+        else:
+            j += 1
+    return result
 
-def booleanANDRetrieval(query, lexicon, invertedIndex):
+def mergeDifference(candidates, docIds):
+    """
+    The candidates that are not in docIds, by walking both sorted lists once.
+    """
+    result = []
+    j = 0
+    size = len(docIds)
+    for candidate in candidates:
+        while j < size and docIds[j] < candidate:
+            j += 1
+        if j < size and docIds[j] == candidate:
+            j += 1
+        else:
+            result.append(candidate)
+    return result
+
+def mergeUnion(lists):
+    """
+    The docIDs in any of the sorted lists, in order and without repeats (a k-way merge).
+    """
+    ## Reference: https://docs.python.org/3/library/heapq.html#heapq.merge
+    result = []
+    previous = -1
+    for docId in heapq.merge(*lists):
+        if docId != previous:
+            result.append(docId)
+            previous = docId
+    return result
+
+def bitmapIntersect(candidates, bitmap):
+    """
+    The candidates whose bit is set in the bitmap (bit d of byte d // 8 stands for docID d).
+    """
+    return [docId for docId in candidates if bitmap[docId >> 3] >> (docId & 7) & 1]
+
+def bitmapDifference(candidates, bitmap):
+    """
+    The candidates whose bit is not set in the bitmap.
+    """
+    return [docId for docId in candidates if not bitmap[docId >> 3] >> (docId & 7) & 1]
+
+def bitmapDocIds(bitmap):
+    """
+    The docIDs whose bits are set, in order. Empty bytes are skipped without looking at their bits.
+    """
+    docIds = []
+    for index, byte in enumerate(bitmap):
+        if byte:
+            for bit in range(8):
+                if byte >> bit & 1:
+                    docIds.append((index << 3) | bit)
+    return docIds
+
+def orBitmaps(bitmaps):
+    """
+    The bitwise OR of bitmaps of the same size.
+    """
+    combined = 0
+    for bitmap in bitmaps:
+        combined |= int.from_bytes(bitmap, "little")
+    return combined.to_bytes(len(bitmaps[0]), "little")
+
+def andBitmaps(bitmaps):
+    """
+    The bitwise AND of bitmaps of the same size, done on them as big integers (one C loop over the bytes).
+    """
+    combined = int.from_bytes(bitmaps[0], "little")
+    for bitmap in bitmaps[1:]:
+        combined &= int.from_bytes(bitmap, "little")
+    return combined.to_bytes(len(bitmaps[0]), "little")
+
+
+class BooleanEngine:
+    """
+    Boolean retrieval over one loaded index. Make one and reuse it: the docID arrays and bitmaps of recent terms are
+    cached, up to cacheDocIds docIDs (a bitmap counts as the number of docIDs that would take the same room).
+    """
+
+    def __init__(self, lexicon, invertedIndex, maxDocId, cacheDocIds=DEFAULT_CACHE_POSTINGS):
+        """
+        Args:
+            lexicon (dict): Mapping of terms to term IDs.
+            invertedIndex: Mapping of term IDs to postings lists sorted by docID (PostingsReader, MultiSegmentPostings or dict).
+            maxDocId (int): The largest internal ID in the index, which sets the size of the bitmaps. None if it
+                isn't known, and then no term gets a bitmap.
+        """
+        self.lexicon = lexicon
+        self.invertedIndex = invertedIndex
+        if maxDocId is None:
+            self.bitmapBytes = 0
+            self.bitmapMinDf = float("inf")
+        else:
+            self.bitmapBytes = (maxDocId >> 3) + 1
+            self.bitmapMinDf = max(1, int((maxDocId + 1) * BITMAP_DENSITY))
+        self.cacheDocIds = cacheDocIds
+        ## Reference: https://docs.python.org/3/library/collections.html#collections.OrderedDict
+        self.cache = OrderedDict()  # (kind, termID) -> (docID array or bitmap, size), least recently used first
+        self.cachedDocIds = 0
+
+    def documentFrequency(self, termId):
+        if hasattr(self.invertedIndex, "documentFrequency"):
+            return self.invertedIndex.documentFrequency(termId)
+        return len(self.invertedIndex.get(termId, []))
+
+    def cached(self, key, size, build):
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.cache.move_to_end(key)
+            return entry[0]
+        value = build()
+        if size <= self.cacheDocIds:
+            self.cache[key] = (value, size)
+            self.cachedDocIds += size
+            while self.cachedDocIds > self.cacheDocIds:
+                _, (_, evictedSize) = self.cache.popitem(last=False)
+                self.cachedDocIds -= evictedSize
+        return value
+
+    def docIds(self, termId):
+        """
+        The term's docIDs, in increasing order.
+        """
+        return self.cached(("docIds", termId), self.documentFrequency(termId),
+                           lambda: array("I", [posting[0] for posting in self.invertedIndex.get(termId, [])]))
+
+    def bitmap(self, termId):
+        """
+        The term's docIDs as a bitmap, or None if the term isn't common enough for one to pay off.
+        """
+        if self.documentFrequency(termId) < self.bitmapMinDf:
+            return None
+
+        def build():
+            bitmap = bytearray(self.bitmapBytes)
+            for docId in self.docIds(termId):
+                bitmap[docId >> 3] |= 1 << (docId & 7)
+            return bytes(bitmap)
+        return self.cached(("bitmap", termId), self.bitmapBytes // 4, build)
+
+    def termIds(self, query):
+        """
+        The termIDs of the query's tokens. Tokens that aren't in the lexicon are left out.
+        """
+        termIds = []
+        for token in tokenize(query):
+            termId = self.lexicon.get(token)
+            if termId is not None and termId not in termIds:
+                termIds.append(termId)
+        return termIds
+
+    def intersect(self, termIds):
+        """
+        The docIDs of the documents containing every term, in increasing order.
+        """
+        if not termIds:
+            return []
+        order = sorted(termIds, key=self.documentFrequency)
+        candidates = self.docIds(order[0])
+        bitmaps = []
+        for termId in order[1:]:
+            if not candidates:
+                return []
+            bitmap = self.bitmap(termId)
+            if bitmap is not None:
+                # Common terms come last in rarest-first order, so the candidates are as few as they will get.
+                bitmaps.append(bitmap)
+                continue
+            docIds = self.docIds(termId)
+            if len(docIds) > GALLOP_RATIO * len(candidates):
+                candidates = gallopIntersect(candidates, docIds)
+            else:
+                candidates = mergeIntersect(candidates, docIds)
+        if bitmaps and candidates:
+            candidates = bitmapIntersect(candidates, bitmaps[0] if len(bitmaps) == 1 else andBitmaps(bitmaps))
+        return list(candidates)
+
+    def search(self, query):
+        """
+        The docIDs of the documents containing all of the query's words, and its quoted phrases as phrases
+        (checked with positional postings), in increasing order.
+        """
+        docIds = self.intersect(self.termIds(query))
+        phrases = parsePhrases(query)
+        if phrases and docIds:
+            matches = matchingDocuments(phrases, self.lexicon.get, self.invertedIndex)
+            docIds = [docId for docId in docIds if docId in matches]
+        return docIds
+
+
+def loadBooleanEngine(indexPath, cachePostings=DEFAULT_CACHE_POSTINGS):
+    """
+    Loads an index (across all of its segments if documents were appended) for Boolean retrieval.
+    Returns:
+        tuple: (BooleanEngine, mapping {docID: DOCNO})
+    """
+    if readManifest(indexPath):
+        # Documents were added later with indexEngine.py --append, so search across all the segments.
+        lexicon, invertedIndex, _, mapping = loadSegmentedIndex(indexPath, cachePostings)
+    else:
+        lexicon = loadLexicon(indexPath)
+        invertedIndex = loadInvertedIndex(indexPath)
+        mapping = loadMapping(indexPath)
+    return BooleanEngine(lexicon, invertedIndex, max(mapping, default=0)), mapping
+
+def booleanEngineRetrieval(query, engine):
     """
     Retrieve documents that contain all of the query's words using Boolean AND retrieval.
     Using logic described in class.
+    Quoted phrases (e.g. "los angeles") must also appear as phrases, checked with positional postings.
+    Returns the docIDs in increasing order, so runs come out the same every time.
+    """
+    return engine.search(query)
+
+# (lexicon, inverted index, BooleanEngine) of the last booleanANDRetrieval call, so its engine and cache are reused.
+lastEngine = None
+
+def booleanANDRetrieval(query, lexicon, invertedIndex):
     """
-    
-    # Tokenizing each query.
-    tokenizedQuery = tokenize(query)
-    
-    docSets = []
-    # some minor help from chatGPT to debug the logic here
-    for token in tokenizedQuery:
-        termID = None
-        for i, j in lexicon.items():
-            # Checking if token is in the lexicon.
-            if j == token:
-                termID = i
-                break
-        if termID is not None:
-            if termID in invertedIndex:
-                docSets.append(set([doc[0] for doc in invertedIndex[termID]]))  # Extracting only docIDs.
-    if not docSets:
-        # If docSets is empty.
-        return []
-    resultSet = docSets[0]
-    for docSet in docSets[1:]:
-        # Calling intersection
-        # Stack overflow: https://stackoverflow.com/questions/2541752/best-way-to-find-the-intersection-of-multiple-sets
-        # W3Schools: https://www.w3schools.com/python/ref_set_intersection.asp
-        resultSet = resultSet.intersection(docSet)
-    return list(resultSet)
+    Boolean AND retrieval for callers that load the lexicon and inverted index themselves (the original interface).
+    A BooleanEngine is made for them on the first call and reused for as long as they are called with the same
+    lexicon and inverted index. It doesn't know the largest docID, so it makes no bitmaps: use loadBooleanEngine and
+    booleanEngineRetrieval for those.
+    lexicon can map terms to termIDs (loadLexicon) or termIDs to terms (what loadLexicon used to return).
+    Returns the docIDs in increasing order.
+    """
+    global lastEngine
+    if lastEngine is None or lastEngine[0] is not lexicon or lastEngine[1] is not invertedIndex:
+        termIds = lexicon
+        if lexicon and isinstance(next(iter(lexicon)), int):
+            termIds = {term: termId for termId, term in lexicon.items()}
+        lastEngine = (lexicon, invertedIndex, BooleanEngine(termIds, invertedIndex, None))
+    return booleanEngineRetrieval(query, lastEngine[2])
 
 def extractQueriesFromTopics(inputFile, outputFile):
     """
@@ -121,60 +406,61 @@ def extractQueriesFromTopics(inputFile, outputFile):
     inputFile: The path to the topics.401-450.txt file.
     outputFile: The path to save the extracted queries.
     """
-    with open(inputFile, 'r') as f:
-        lines = f.readlines()
-
+    # The topics parser is shared with BM25.py's batch mode.
     with open(outputFile, 'w') as f:
-        i = 0
-        while i < len(lines):
-            # Check if the line contains the string "Number:"
-            if "Number:" in lines[i]:
-                # Ensure the line contains a colon before attempting to split
-                if ":" in lines[i]:
-                    topicID = lines[i].split(":")[1].strip()
-                    f.write(topicID + "\n")
-                i += 1
-                # Ensure the line contains the string "title" before attempting to extract the query
-                if "<title>" in lines[i]:
-                    query = lines[i].split("<title>")[1].split("</title>")[0].strip()
-                    f.write(query + "\n")
-            i += 1
-
-def main():
-    # Check command-line arguments.
-    if len(sys.argv) != 4:
-        print("Usage: python3 booleanAND <index_path> <queries_file> <output_file>")
-        sys.exit(1)
+        for topicID, query in readTopics(inputFile):
+            f.write(topicID + "\n")
+            f.write(query + "\n")
 
-    indexPath, queriesFile, outputFile = sys.argv[1], sys.argv[2], sys.argv[3]
+def writeRunLines(outf, topicID, docIDs, docIDToDOCNO, runTag=RUN_TAG):
+    """
+    Writes one topic's results in the TREC format. Every result matches, so the scores just count down.
+    """
+    for rank, docID in enumerate(docIDs, 1):
+        docno = docIDToDOCNO[docID]  # Convert docID to docno.
+        score = len(docIDs) - rank
+        # Output in the TREC format required.
+        outf.write(f"{topicID} Q0 {docno} {rank} {score} {runTag}\n")
 
-    # Load lexicon and inverted index.
-    lexicon = loadLexicon(indexPath)
-    invertedIndex = loadInvertedIndex(indexPath)
+def main():
+    parser = argparse.ArgumentParser(description="Boolean AND retrieval: python3 booleanAND.py <index_path> <topics_file> <output_file>")
+    parser.add_argument("indexPath", help="Directory containing the index files")
+    parser.add_argument("topicsFile", help="TREC topics file (e.g. topics.401-450.txt). Each topic's title is the query")
+    parser.add_argument("outputFile", help="The TREC run file to write")
+    parser.add_argument("--exclude", default=",".join(sorted(EXCLUDED_TOPICS)), help="Comma separated topic numbers to skip (default: the topics without judgements, %(default)s)")
+    parser.add_argument("--language", action="store_true", help="Read the titles as Boolean queries with AND, OR, NOT and parentheses (see booleanQuery.py)")
+    parser.add_argument("--explain", action="store_true", help="With --language, print each topic's query plan with its estimated and actual costs")
+    args = parser.parse_args()
+    if args.explain and not args.language:
+        parser.error("--explain needs --language")
 
-    # Extract the queries.
-    extractQueriesFromTopics("topics.1-5.txt", queriesFile)
-    
-    # Load the mapping.
-    docIDToDOCNO = loadMapping(indexPath)
+    # Load the hashed lexicon, the inverted index and the mapping.
+    engine, docIDToDOCNO = loadBooleanEngine(args.indexPath)
+    planner = None
+    if args.language:
+        # Imported here since booleanQuery.py builds on this module.
+        from booleanQuery import QueryPlanner, explain
+        planner = QueryPlanner(engine, sorted(docIDToDOCNO))
+    excluded = {topicID.strip() for topicID in args.exclude.split(",") if topicID.strip()}
 
     # Process each query and write results to the output file.
-    with open(queriesFile, 'r') as qf, open(outputFile, 'w') as outf:
-        while True:
-            topicID = qf.readline().strip()
-            # Run until you run out of queries.
-            if not topicID:
-                break
-            if topicID in EXCLUDED_TOPICS:
-                qf.readline()  # Skip the query line for the excluded topic.
-                continue  # Skip to the next iteration.
-            query = qf.readline().strip()
-            docIDs = booleanANDRetrieval(query, lexicon, invertedIndex)
-            for rank, docID in enumerate(docIDs, 1):
-                docno = docIDToDOCNO[docID]  # Convert docID to docno.
-                score = len(docIDs) - rank
-                # Output in the TREC format required.
-                outf.write(f"{topicID} Q0 {docno} {rank} {score} yabadeerAND\n")
+    with open(args.outputFile, 'w') as outf:
+        for topicID, query in readTopics(args.topicsFile):
+            if topicID in excluded:
+                continue  # Skip to the next topic.
+            try:
+                if planner:
+                    docIDs, plan = planner.search(query)
+                    if args.explain:
+                        print(f"Topic {topicID}: {query}")
+                        print("\n".join(explain(plan, "    ")))
+                else:
+                    docIDs = booleanEngineRetrieval(query, engine)
+            except ValueError as e:
+                # Phrase queries on an index without positions, or queries that don't parse.
+                print(f"Error in topic {topicID}: {e}")
+                continue
+            writeRunLines(outf, topicID, docIDs, docIDToDOCNO)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,451 @@
+'''
+Boolean query language with a cost-based planner, on top of BooleanEngine (booleanAND.py).
+
+Usage:
+    python3 booleanQuery.py <indexPath> '(police OR sheriff) AND "los angeles" NOT county' [--explain]
+    python3 booleanAND.py <indexPath> <topics_file> <run_file> --language [--explain]
+
+Syntax:
+- words, and "quoted phrases" (they need an index built with indexEngine.py --positions)
+- AND, OR and NOT (in capitals; in lower case they are words), and parentheses
+- words next to each other are ANDed, so a plain list of words means what it does in booleanAND.py,
+  except that a word that isn't in the index matches nothing here instead of being left out
+- NOT binds tightest, then AND, then OR: a OR b c NOT d is a OR (b AND c AND (NOT d))
+A word the tokenizer splits (e.g. 1989-90) stands for all of its tokens ANDed.
+
+The parser turns a query into an operator tree. The planner then rewrites and costs it, using the document
+frequencies (read from the postings file's table, so nothing is decoded) to estimate how many documents each node
+gives, assuming the terms are independent:
+- NOT is pushed down through OR (NOT (a OR b) is NOT a AND NOT b) and double negations cancel, so NOTs end up as
+  operands of an AND, where they are subtracted from the other operands' result (a set difference) instead of
+  being turned into the complement of their documents. Only an AND of nothing but NOTs needs the complement.
+- The operands of an AND are intersected smallest estimate first, then the NOT operands are subtracted, largest
+  first, since they remove the most.
+- Each step picks the cheapest way to combine the candidates so far (m of them) with the next operand (n docIDs):
+  merge (walk both lists, m + n), gallop (search the longer list from where the last candidate was found,
+  about m * log(n / m)) or bitmap (one bit test per candidate, m, for terms common enough to have a bitmap).
+  An OR is a k-way merge of its operands, or an OR of their bitmaps when all of them have one and that is cheaper.
+The explain mode prints the plan: every node with its estimated size and cost and the strategy that joins it to its
+parent, and once the query has run, the actual number of documents and time of each node.
+
+Acknowledgements:
+- Recursive descent parsing is from chapter 2 of Aho, Lam, Sethi and Ullman, "Compilers: Principles, Techniques,
+  and Tools".
+- Processing Boolean queries rarest first, and estimating the size of intersections, are from the query processing
+  lecture and chapter 1.3 of Introduction to Information Retrieval (Manning, Raghavan, Schutze).
+- Cost-based choice between join methods is from Selinger et al., "Access path selection in a relational database
+  management system" (1979).
+'''
+
+import argparse
+import math
+import re
+import sys
+import time
+from booleanAND import (loadBooleanEngine, gallopIntersect, gallopDifference, mergeIntersect, mergeDifference,
+                        mergeUnion, bitmapIntersect, bitmapDifference, bitmapDocIds, orBitmaps)
+from phraseQuery import phraseDocuments
+from textAnalysis import tokenize
+
+# Quoted phrases, parentheses, and runs of anything else. An unmatched quote is ignored.
+TOKEN_PATTERN = re.compile(r'"([^"]*)"|([()])|([^\s()"]+)')
+OPERATORS = {"AND", "OR", "NOT"}
+
+
+class Term:
+    def __init__(self, term):
+        self.term = term
+
+
+class Phrase:
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+
+class Not:
+    def __init__(self, child):
+        self.child = child
+
+
+class And:
+    def __init__(self, children):
+        self.children = children
+
+
+class Or:
+    def __init__(self, children):
+        self.children = children
+
+
+def lex(query):
+    """
+    Splits a query into ("phrase", tokens), ("(",), (")",), ("AND",), ("OR",), ("NOT",) and ("word", tokens).
+    """
+    items = []
+    for phrase, paren, word in TOKEN_PATTERN.findall(query):
+        if paren:
+            items.append((paren,))
+        elif word in OPERATORS:
+            items.append((word,))
+        elif word:
+            items.append(("word", tokenize(word)))
+        else:
+            items.append(("phrase", tokenize(phrase)))
+    return items
+
+
+class Parser:
+    """
+    Recursive descent parser for the grammar:
+        expression := conjunction (OR conjunction)*
+        conjunction := negation ([AND] negation)*
+        negation := NOT negation | primary
+        primary := ( expression ) | "phrase" | word
+    """
+
+    def __init__(self, query):
+        self.items = lex(query)
+        self.position = 0
+
+    def peek(self):
+        return self.items[self.position][0] if self.position < len(self.items) else None
+
+    def take(self):
+        item = self.items[self.position]
+        self.position += 1
+        return item
+
+    def parse(self):
+        """
+        The operator tree of the whole query, or None if it has no words.
+        Raises ValueError for a query that doesn't follow the grammar.
+        """
+        if not self.items:
+            return None
+        node = self.expression()
+        if self.peek() is not None:
+            raise ValueError(f"Unexpected {self.describe()} in the query.")
+        return node
+
+    def describe(self):
+        kind = self.peek()
+        return "end of the query" if kind is None else (f"'{kind}'" if kind in OPERATORS or kind in "()" else "word")
+
+    def expression(self):
+        children = [self.conjunction()]
+        while self.peek() == "OR":
+            self.take()
+            children.append(self.conjunction())
+        return combine(Or, children)
+
+    def conjunction(self):
+        children = [self.negation()]
+        while self.peek() in ("AND", "NOT", "(", "word", "phrase"):
+            if self.peek() == "AND":
+                self.take()
+            children.append(self.negation())
+        return combine(And, children)
+
+    def negation(self):
+        if self.peek() == "NOT":
+            self.take()
+            child = self.negation()
+            return Not(child) if child is not None else None
+        return self.primary()
+
+    def primary(self):
+        kind = self.peek()
+        if kind == "(":
+            self.take()
+            node = self.expression()
+            if self.peek() != ")":
+                raise ValueError(f"Expected ')' but found {self.describe()}.")
+            self.take()
+            return node
+        if kind == "phrase":
+            tokens = self.take()[1]
+            if len(tokens) > 1:
+                return Phrase(tokens)
+            return Term(tokens[0]) if tokens else None
+        if kind == "word":
+            # A word the tokenizer splits is all of its tokens.
+            return combine(And, [Term(token) for token in self.take()[1]])
+        raise ValueError(f"Expected a word, a phrase or '(' but found {self.describe()}.")
+
+
+def combine(operator, children):
+    # Operands without any tokens (e.g. a lone "&") are left out.
+    children = [child for child in children if child is not None]
+    if not children:
+        return None
+    return children[0] if len(children) == 1 else operator(children)
+
+
+def parseQuery(query):
+    return Parser(query).parse()
+
+
+def pushNot(node, negate=False):
+    """
+    Removes double negations and pushes NOT through OR (De Morgan), and flattens nested ANDs and ORs.
+    NOT stays above an AND, which is cheaper to subtract once than as a NOT of each of its operands.
+    """
+    if isinstance(node, Not):
+        return pushNot(node.child, not negate)
+    if isinstance(node, Or):
+        if negate:
+            return flatten(And, [pushNot(child, True) for child in node.children])
+        return flatten(Or, [pushNot(child) for child in node.children])
+    if isinstance(node, And):
+        result = flatten(And, [pushNot(child) for child in node.children])
+        return Not(result) if negate else result
+    return Not(node) if negate else node
+
+
+def flatten(operator, children):
+    flat = []
+    for child in children:
+        flat.extend(child.children if isinstance(child, operator) else [child])
+    return operator(flat)
+
+
+class PlanNode:
+    """
+    One step of a query plan: where its documents come from, how many it is expected to give and what it costs
+    (in docIDs looked at, including its operands). After it runs, actual and seconds are filled in.
+    """
+
+    def __init__(self, kind, label, estimate, cost, children=(), strategies=(), negatives=(), negativeStrategies=(), termId=None):
+        self.kind = kind  # term, phrase, empty, and, or, not
+        self.label = label
+        self.estimate = estimate
+        self.cost = cost
+        self.children = list(children)  # for and: the operands in the order they are intersected
+        self.strategies = list(strategies)  # for and: how each operand after the first is intersected; for or: merge or bitmap
+        self.negatives = list(negatives)  # for and: the operands that are subtracted, in order
+        self.negativeStrategies = list(negativeStrategies)
+        self.termId = termId
+        self.hasBitmap = False
+        self.actual = None
+        self.seconds = None
+
+
+class QueryPlanner:
+    """
+    Plans and runs Boolean queries over one BooleanEngine. universe is every docID in the index, in order
+    (the complement of a NOT that has nothing to be subtracted from is taken from it).
+    """
+
+    def __init__(self, engine, universe):
+        self.engine = engine
+        self.universe = universe
+        self.numDocs = max(len(universe), 1)
+
+    def plan(self, query):
+        """
+        The plan of a query string. Raises ValueError if the query can't be parsed.
+        """
+        tree = parseQuery(query)
+        if tree is None:
+            return PlanNode("empty", "(no words)", 0, 0)
+        return self.planNode(pushNot(tree))
+
+    def planNode(self, node):
+        if isinstance(node, Term):
+            termId = self.engine.lexicon.get(node.term)
+            if termId is None:
+                return PlanNode("empty", f"{node.term} (not in the index)", 0, 0)
+            df = self.engine.documentFrequency(termId)
+            plan = PlanNode("term", node.term, df, df, termId=termId)
+            plan.hasBitmap = df >= self.engine.bitmapMinDf
+            return plan
+        if isinstance(node, Phrase):
+            termIds = [self.engine.lexicon.get(token) for token in node.tokens]
+            label = '"' + " ".join(node.tokens) + '"'
+            if any(termId is None for termId in termIds):
+                return PlanNode("empty", f"{label} (a word is not in the index)", 0, 0)
+            dfs = [self.engine.documentFrequency(termId) for termId in set(termIds)]
+            # At most the rarest word's documents. Every word's positional postings are read.
+            plan = PlanNode("phrase", label, min(dfs), sum(dfs))
+            plan.termIds = termIds
+            return plan
+        if isinstance(node, Not):
+            # Nothing to subtract it from (the AND case is handled in planAnd): the complement of the child.
+            child = self.planNode(node.child)
+            return PlanNode("not", "NOT", self.numDocs - child.estimate, child.cost + self.numDocs + child.estimate, [child])
+        if isinstance(node, And):
+            return self.planAnd(node.children)
+        return self.planOr([self.planNode(child) for child in node.children])
+
+    def stepCost(self, m, child):
+        """
+        The cheapest way to combine m candidates with the child's documents, and its cost.
+        """
+        n = max(child.estimate, 1)
+        costs = {"merge": m + n, "gallop": m * (1 + math.log2(n / max(m, 1) + 1))}
+        if child.hasBitmap:
+            costs["bitmap"] = m
+        strategy = min(costs, key=costs.get)
+        return strategy, costs[strategy]
+
+    def planAnd(self, children):
+        positives = []
+        negatives = []
+        for child in children:
+            if isinstance(child, Not):
+                negatives.append(self.planNode(child.child))
+            else:
+                positives.append(self.planNode(child))
+        negatives = [negative for negative in negatives if negative.kind != "empty"]  # subtracting nothing
+        if not positives:
+            # Only NOTs: the complement of their union.
+            union = self.planOr(negatives)
+            return PlanNode("not", "NOT", self.numDocs - union.estimate, union.cost + self.numDocs + union.estimate, [union])
+        if any(positive.kind == "empty" for positive in positives):
+            return PlanNode("empty", "AND (an operand matches nothing)", 0, 0)
+
+        positives.sort(key=lambda plan: plan.estimate)
+        negatives.sort(key=lambda plan: plan.estimate, reverse=True)
+        m = positives[0].estimate
+        cost = positives[0].cost
+        strategies = []
+        for child in positives[1:]:
+            strategy, stepCost = self.stepCost(m, child)
+            strategies.append(strategy)
+            # A bitmap probe doesn't need the child's docIDs as a list, but they are read once to make the bitmap.
+            cost += child.cost + stepCost
+            m = m * child.estimate / self.numDocs
+        negativeStrategies = []
+        for child in negatives:
+            strategy, stepCost = self.stepCost(m, child)
+            negativeStrategies.append(strategy)
+            cost += child.cost + stepCost
+            m = m * (1 - child.estimate / self.numDocs)
+        return PlanNode("and", "AND", round(m), round(cost), positives, strategies, negatives, negativeStrategies)
+
+    def planOr(self, plans):
+        plans = [plan for plan in plans if plan.kind != "empty"]
+        if not plans:
+            return PlanNode("empty", "OR (no operand matches anything)", 0, 0)
+        if len(plans) == 1:
+            return plans[0]
+        missing = 1.0
+        for plan in plans:
+            missing *= 1 - min(plan.estimate / self.numDocs, 1.0)
+        estimate = round(self.numDocs * (1 - missing))
+        total = sum(plan.estimate for plan in plans)
+        costs = {"merge": total * math.log2(len(plans))}
+        if all(plan.hasBitmap for plan in plans):
+            # The bitmaps are ORed in C; reading out the result looks at every byte.
+            costs["bitmap"] = self.numDocs / 8 + estimate
+        strategy = min(costs, key=costs.get)
+        return PlanNode("or", "OR", estimate, round(sum(plan.cost for plan in plans) + costs[strategy]), plans, [strategy])
+
+    def execute(self, plan):
+        """
+        Runs a plan. Returns the docIDs in increasing order.
+        """
+        start = time.perf_counter()
+        engine = self.engine
+        if plan.kind == "empty":
+            docIds = []
+        elif plan.kind == "term":
+            docIds = engine.docIds(plan.termId)
+        elif plan.kind == "phrase":
+            docIds = sorted(phraseDocuments(plan.termIds, engine.invertedIndex))
+        elif plan.kind == "not":
+            docIds = mergeDifference(self.universe, self.execute(plan.children[0]))
+        elif plan.kind == "or":
+            if plan.strategies[0] == "bitmap":
+                for child in plan.children:
+                    child.actual = child.estimate
+                docIds = bitmapDocIds(orBitmaps([engine.bitmap(child.termId) for child in plan.children]))
+            else:
+                docIds = mergeUnion([self.execute(child) for child in plan.children])
+        else:
+            docIds = self.execute(plan.children[0])
+            steps = [(child, strategy, False) for child, strategy in zip(plan.children[1:], plan.strategies)]
+            steps += [(child, strategy, True) for child, strategy in zip(plan.negatives, plan.negativeStrategies)]
+            for child, strategy, subtract in steps:
+                if not docIds:
+                    break
+                if strategy == "bitmap":
+                    bitmap = engine.bitmap(child.termId)
+                    child.actual = child.estimate
+                    docIds = bitmapDifference(docIds, bitmap) if subtract else bitmapIntersect(docIds, bitmap)
+                elif strategy == "gallop":
+                    other = self.execute(child)
+                    docIds = gallopDifference(docIds, other) if subtract else gallopIntersect(docIds, other)
+                else:
+                    other = self.execute(child)
+                    docIds = mergeDifference(docIds, other) if subtract else mergeIntersect(docIds, other)
+        plan.actual = len(docIds)
+        plan.seconds = time.perf_counter() - start
+        return list(docIds)
+
+    def search(self, query):
+        """
+        The docIDs matching a query, in increasing order, and the plan that found them.
+        """
+        plan = self.plan(query)
+        return self.execute(plan), plan
+
+
+def explain(plan, indent="", how=""):
+    """
+    The plan as indented lines, one per node.
+    """
+    line = f"{indent}{how}{plan.label}  est {plan.estimate} docs, cost {plan.cost}"
+    if plan.actual is not None:
+        line += f"  -> {plan.actual} docs"
+        if plan.seconds is not None:
+            line += f" in {plan.seconds * 1000:.2f} ms"
+    lines = [line]
+    childIndent = indent + "    "
+    if plan.kind == "and":
+        lines += explain(plan.children[0], childIndent, "first: ")
+        for child, strategy in zip(plan.children[1:], plan.strategies):
+            lines += explain(child, childIndent, f"AND by {strategy}: ")
+        for child, strategy in zip(plan.negatives, plan.negativeStrategies):
+            lines += explain(child, childIndent, f"NOT by {strategy}: ")
+    elif plan.kind == "or":
+        for child in plan.children:
+            lines += explain(child, childIndent, f"OR by {plan.strategies[0]}: ")
+    elif plan.kind == "not":
+        lines += explain(plan.children[0], childIndent, "all documents minus: ")
+    return lines
+
+
+def loadPlanner(indexPath):
+    """
+    Returns:
+        tuple: (QueryPlanner, mapping {docID: DOCNO})
+    """
+    engine, mapping = loadBooleanEngine(indexPath)
+    return QueryPlanner(engine, sorted(mapping)), mapping
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Boolean query with AND, OR, NOT and parentheses: python3 booleanQuery.py <indexPath> '<query>'")
+    parser.add_argument("indexPath", help="Directory containing the index files")
+    parser.add_argument("query", help="The Boolean query (quote it for the shell)")
+    parser.add_argument("--explain", action="store_true", help="Print the query plan with the estimated and actual size and cost of each step")
+    parser.add_argument("--limit", type=int, default=20, help="DOCNOs to print (default: 20, 0 for all)")
+    args = parser.parse_args()
+
+    planner, mapping = loadPlanner(args.indexPath)
+    try:
+        docIds, plan = planner.search(args.query)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    if args.explain:
+        print("\n".join(explain(plan)))
+    shown = docIds if args.limit == 0 else docIds[:args.limit]
+    for docId in shown:
+        print(mapping[docId])
+    print(f"{len(docIds)} documents match.")
+
+
+if __name__ == "__main__":
+    main()
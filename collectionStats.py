@@ -0,0 +1,237 @@
+'''
+Collection statistics written by indexEngine.py next to the postings, so BM25 doesn't have to derive them at query time.
+
+Layout of collection-stats.bin (all numbers little-endian):
+- header: magic, format version, number of terms, N (number of documents), total tokens, average document length
+- df: number of documents containing each term (4 bytes per termID)
+- cf: number of times each term occurs in the collection (8 bytes per termID)
+- idf: the BM25 IDF of each term, log((N - df + 0.5) / (df + 0.5)) (8-byte float per termID)
+- maxTf: the largest count of each term in one document (4 bytes per termID)
+- minDl: the length of the shortest document containing each term (4 bytes per termID)
+- maxScore: the largest BM25 contribution of each term to any document with the default k1 and b (8-byte float per termID)
+
+maxTf, minDl and maxScore are upper bounds for dynamic pruning (BM25Scorer.topK in scoring.py).
+
+A shard of a sharded index (indexEngine.py --shards, shards.py) also has global-stats.bin, in the same layout and
+indexed by the shard's own termIDs, but with the N, total tokens, df, cf and IDF of the whole collection (and
+maxScore worked out with them). It is loaded instead of collection-stats.bin, so every shard scores a document
+exactly like an index of the whole collection would.
+'''
+
+import math
+import os
+import struct
+import sys
+from array import array
+from postingsFile import littleEndianBytes
+from segments import segmentPaths
+
+STATS_FILE = "collection-stats.bin"
+GLOBAL_STATS_FILE = "global-stats.bin"  # Only in the shards of a sharded index
+STATS_MAGIC = b"IRCS"
+STATS_VERSION = 2
+# The k1 and b that maxScore is worked out for.
+DEFAULT_K1 = 1.2
+DEFAULT_B = 0.75
+HEADER_FORMAT = "<4sIIQQd"  # magic, version, number of terms, N, total tokens, average document length
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+
+def computeIdf(N, df):
+    """
+    BM25 inverse document frequency of a term that is in df of the N documents.
+    """
+    return math.log((N - df + 0.5) / (df + 0.5))
+
+
+class CollectionStats:
+    """
+    N, total tokens and average document length of a collection, plus df, cf and IDF arrays indexed by termID.
+    """
+
+    def __init__(self, N, totalTokens, df, cf, maxTf, minDl, idf=None, maxScore=None):
+        """
+        maxScore is only known when the statistics come straight from the postings. Statistics added up
+        from several segments leave it as None, and upperBound falls back on maxTf and minDl.
+        """
+        self.N = N
+        self.totalTokens = totalTokens
+        self.avgDl = totalTokens / N if N else 0.0
+        self.df = df
+        self.cf = cf
+        self.maxTf = maxTf
+        self.minDl = minDl
+        self.idf = idf if idf is not None else array("d", (computeIdf(N, termDf) for termDf in df))
+        self.maxScore = maxScore
+        # The length normalisation of every document for the default k1 and b, when it was loaded with the rest
+        # (indexSnapshot.py). None means BM25Scorer works it out.
+        self.norms = None
+
+    @property
+    def numTerms(self):
+        return len(self.df)
+
+    def upperBound(self, termID, k1, b):
+        """
+        The most the term can add to a document's BM25 sum (idf * f / (f + k)).
+        Exact for the default k1 and b, otherwise worked out from the largest count and the shortest document.
+        """
+        if self.maxScore is not None and k1 == DEFAULT_K1 and b == DEFAULT_B:
+            return self.maxScore[termID]
+        idf = self.idf[termID]
+        if idf <= 0 or not self.df[termID]:
+            # Every contribution of a term in more than half the documents is 0 or less.
+            return 0.0
+        maxTf = self.maxTf[termID]
+        return idf * maxTf / (maxTf + k1 * ((1 - b) + b * (self.minDl[termID] / self.avgDl)))
+
+    def write(self, path):
+        """
+        Writes the statistics of one index (the ones CollectionStatsBuilder makes, which have maxScore).
+        """
+        with open(path, "wb") as f:
+            f.write(struct.pack(HEADER_FORMAT, STATS_MAGIC, STATS_VERSION, self.numTerms, self.N, self.totalTokens, self.avgDl))
+            f.write(littleEndianBytes(self.df))
+            f.write(littleEndianBytes(self.cf))
+            f.write(littleEndianBytes(self.idf))
+            f.write(littleEndianBytes(self.maxTf))
+            f.write(littleEndianBytes(self.minDl))
+            f.write(littleEndianBytes(self.maxScore))
+
+
+def _readArray(typecode, data, start, count):
+    values = array(typecode)
+    values.frombytes(data[start:start + values.itemsize * count])
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values, start + values.itemsize * count
+
+
+def readCollectionStats(path):
+    """
+    Reads a collection-stats.bin file. The arrays are copied straight from the file, so this is O(1) per term.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, numTerms, N, totalTokens, _ = struct.unpack_from(HEADER_FORMAT, data, 0)
+    if magic != STATS_MAGIC or version != STATS_VERSION:
+        raise ValueError(f"{path} is not a supported collection statistics file.")
+    df, position = _readArray("I", data, HEADER_SIZE, numTerms)
+    cf, position = _readArray("Q", data, position, numTerms)
+    idf, position = _readArray("d", data, position, numTerms)
+    maxTf, position = _readArray("I", data, position, numTerms)
+    minDl, position = _readArray("I", data, position, numTerms)
+    maxScore, position = _readArray("d", data, position, numTerms)
+    return CollectionStats(N, totalTokens, df, cf, maxTf, minDl, idf, maxScore)
+
+
+def hasCurrentStats(path):
+    """
+    Whether path is a collection statistics file this version can read (older versions lack the score bounds).
+    """
+    if not os.path.exists(path):
+        return False
+    with open(path, "rb") as f:
+        header = f.read(HEADER_SIZE)
+    return len(header) == HEADER_SIZE and struct.unpack(HEADER_FORMAT, header)[:2] == (STATS_MAGIC, STATS_VERSION)
+
+
+def defaultNorm(dl, avgDl):
+    """
+    The BM25 length normalisation k1 * ((1 - b) + b * dl / avgDl) of a document for the default k1 and b,
+    worked out the same way as scoring.documentNorms.
+    """
+    return DEFAULT_K1 * ((1 - DEFAULT_B) + DEFAULT_B * (dl / avgDl))
+
+
+def termStatistics(postings, N, docLengths, norms):
+    """
+    cf, maxTf, minDl and maxScore of one term's postings (which mustn't be empty).
+    docLengths and norms are indexed by docID (dictionaries or arrays).
+    """
+    idf = computeIdf(N, len(postings))
+    cf = sum(posting[1] for posting in postings)
+    maxTf = max(posting[1] for posting in postings)
+    minDl = min(docLengths[posting[0]] for posting in postings)
+    maxScore = max(idf * posting[1] / (posting[1] + norms[posting[0]]) for posting in postings)
+    return cf, maxTf, minDl, maxScore
+
+
+class CollectionStatsBuilder:
+    """
+    Collects df and cf while the postings are being written, so no extra pass over the postings is needed.
+    """
+
+    def __init__(self, numTerms, docLengths):
+        self.N = len(docLengths)
+        self.totalTokens = sum(docLengths.values())
+        self.df = array("I", [0]) * numTerms
+        self.cf = array("Q", [0]) * numTerms
+        self.maxTf = array("I", [0]) * numTerms
+        self.minDl = array("I", [0]) * numTerms
+        self.maxScore = array("d", [0.0]) * numTerms
+        # The default BM25 length normalisation of each document.
+        avgDl = self.totalTokens / self.N if self.N else 0.0
+        self.norms = {docId: defaultNorm(dl, avgDl) for docId, dl in docLengths.items()}
+        self.docLengths = docLengths
+
+    def observe(self, termPostings):
+        """
+        Passes the (termID, postings) pairs through unchanged while recording their statistics.
+        """
+        for termID, postings in termPostings:
+            self.df[termID] = len(postings)
+            if postings:
+                self.cf[termID], self.maxTf[termID], self.minDl[termID], self.maxScore[termID] = termStatistics(
+                    postings, self.N, self.docLengths, self.norms)
+            yield termID, postings
+
+    def build(self):
+        return CollectionStats(self.N, self.totalTokens, self.df, self.cf, self.maxTf, self.minDl, maxScore=self.maxScore)
+
+
+def collectionStatsFromIndex(invertedIndex, docLengths, numTerms):
+    """
+    Works the statistics out from the postings, for indexes built before collection-stats.bin existed.
+    """
+    builder = CollectionStatsBuilder(numTerms, docLengths)
+    for _ in builder.observe(invertedIndex.items()):
+        pass
+    return builder.build()
+
+
+def loadCollectionStats(indexPath, invertedIndex, docLengths, numTerms):
+    """
+    Loads the statistics of an index, indexed by the same termIDs as the lexicon the query code uses.
+    For an index with appended segments, the statistics of each segment are added up under the unified termIDs.
+
+    Args:
+        indexPath (str): The index directory.
+        invertedIndex: The loaded inverted index (a MultiSegmentPostings for an index with appended segments).
+        docLengths (dict): The loaded document lengths.
+        numTerms (int): The size of the lexicon.
+    """
+    globalStatsPath = os.path.join(indexPath, GLOBAL_STATS_FILE)
+    if hasCurrentStats(globalStatsPath):
+        # A shard: BM25 needs the statistics of the whole collection, not just of the shard's documents.
+        return readCollectionStats(globalStatsPath)
+    statsPaths = [os.path.join(path, STATS_FILE) for path in segmentPaths(indexPath)]
+    if not all(hasCurrentStats(path) for path in statsPaths):
+        return collectionStatsFromIndex(invertedIndex, docLengths, numTerms)
+    if len(statsPaths) == 1:
+        return readCollectionStats(statsPaths[0])
+
+    segmentStats = [readCollectionStats(path) for path in statsPaths]
+    df = array("I", [0]) * numTerms
+    cf = array("Q", [0]) * numTerms
+    maxTf = array("I", [0]) * numTerms
+    minDl = array("I", [0]) * numTerms
+    for stats, localTermIDs in zip(segmentStats, invertedIndex.localTermIDs):
+        for termID, localID in localTermIDs.items():
+            if not stats.df[localID]:
+                continue
+            minDl[termID] = min(minDl[termID], stats.minDl[localID]) if df[termID] else stats.minDl[localID]
+            maxTf[termID] = max(maxTf[termID], stats.maxTf[localID])
+            df[termID] += stats.df[localID]
+            cf[termID] += stats.cf[localID]
+    return CollectionStats(sum(stats.N for stats in segmentStats), sum(stats.totalTokens for stats in segmentStats), df, cf, maxTf, minDl)
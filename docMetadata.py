@@ -0,0 +1,121 @@
+'''
+Per-document metadata table (DOCNO, date and headline) written by indexEngine.py.
+
+The result page only needs these three things for each result, so it can be rendered from this table
+without reading the raw documents (they are still read when a snippet is shown).
+
+Layout of doc-metadata.bin (all integers little-endian):
+- header: magic, format version, first internal ID, number of documents
+- offset table: (number of documents + 1) 8-byte offsets into the records, indexed by internal ID - first internal ID
+- records: "DOCNO<tab>yyyy-mm-dd<tab>headline" in UTF-8 (the headline is empty when the document has none)
+'''
+
+import mmap
+import os
+import struct
+from array import array
+from postingsFile import littleEndianBytes
+from segments import segmentPaths
+
+METADATA_FILE = "doc-metadata.bin"
+METADATA_MAGIC = b"IRDM"
+METADATA_VERSION = 1
+HEADER_FORMAT = "<4sIII"  # magic, version, first internal ID, number of documents
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+
+def writeMetadataTable(path, entries):
+    """
+    Writes the metadata table.
+
+    Args:
+        path (str): Where to write the file.
+        entries (dict): {internalId: (docno, date as yyyy-mm-dd, headline)}
+    """
+    firstId = min(entries) if entries else 1
+    count = (max(entries) - firstId + 1) if entries else 0
+    offsets = array("Q", [0]) * (count + 1)
+    records = bytearray()
+    for position in range(count):
+        offsets[position] = len(records)
+        entry = entries.get(firstId + position)
+        if entry is not None:
+            records += "\t".join(entry).encode("utf-8")
+    offsets[count] = len(records)
+    with open(path, "wb") as f:
+        f.write(struct.pack(HEADER_FORMAT, METADATA_MAGIC, METADATA_VERSION, firstId, count))
+        f.write(littleEndianBytes(offsets))
+        f.write(records)
+
+
+class MetadataTable:
+    """
+    Random access to one metadata table. The file is memory mapped and a record is decoded when it is asked for.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.firstId, self.count = struct.unpack_from(HEADER_FORMAT, self.mm, 0)
+        if magic != METADATA_MAGIC or version != METADATA_VERSION:
+            self.mm.close()
+            raise ValueError(f"{path} is not a supported metadata table.")
+        self.recordsStart = HEADER_SIZE + 8 * (self.count + 1)
+
+    def __contains__(self, internalId):
+        return self.firstId <= internalId < self.firstId + self.count
+
+    def get(self, internalId, default=None):
+        """
+        Returns (docno, date as yyyy-mm-dd, headline) for an internal ID, or default if there isn't one.
+        """
+        if internalId not in self:
+            return default
+        start, end = struct.unpack_from("<QQ", self.mm, HEADER_SIZE + 8 * (internalId - self.firstId))
+        if start == end:
+            return default
+        docno, date, headline = self.mm[self.recordsStart + start:self.recordsStart + end].decode("utf-8").split("\t", 2)
+        return docno, date, headline
+
+    def records(self):
+        """
+        Returns {internalId: (docno, date, headline)} for every document, in the form writeMetadataTable takes.
+        """
+        entries = {}
+        for internalId in range(self.firstId, self.firstId + self.count):
+            record = self.get(internalId)
+            if record is not None:
+                entries[internalId] = record
+        return entries
+
+    def close(self):
+        self.mm.close()
+
+
+class IndexMetadata:
+    """
+    The metadata of a whole index: looks each internal ID up in the table of the segment it belongs to.
+    """
+
+    def __init__(self, tables):
+        self.tables = tables
+
+    def get(self, internalId, default=None):
+        for table in self.tables:
+            if internalId in table:
+                return table.get(internalId, default)
+        return default
+
+    def close(self):
+        for table in self.tables:
+            table.close()
+
+
+def openMetadata(indexPath):
+    """
+    Opens the metadata tables of every segment of an index, or returns None for an index built before they existed.
+    """
+    paths = [os.path.join(path, METADATA_FILE) for path in segmentPaths(indexPath)]
+    if not all(os.path.exists(path) for path in paths):
+        return None
+    return IndexMetadata([MetadataTable(path) for path in paths])
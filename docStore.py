@@ -0,0 +1,187 @@
+'''
+Packed document store: an alternative to writing every document to its own yyyy/mm/dd/DOCNO.txt file.
+
+- docstore.dat: append-only file of zlib-compressed blocks. Each block holds several documents back to back.
+- docstore.idx: offset table keyed by internal ID. For every document it has the offset and compressed length
+  of its block, plus where the document starts inside the decompressed block and how long it is.
+
+Fetching a document is one seek and read of a small block and one decompress.
+
+Acknowledgements:
+- Reference for zlib: https://docs.python.org/3/library/zlib.html
+'''
+
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+DOC_STORE_DATA_FILE = "docstore.dat"
+DOC_STORE_INDEX_FILE = "docstore.idx"
+DOC_STORE_MAGIC = b"IRDS"
+DOC_STORE_VERSION = 1
+DOC_STORE_BLOCK_SIZE = 64 * 1024  # uncompressed bytes per block
+HEADER_FORMAT = "<4sIII"  # magic, version, first internal ID, number of records
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RECORD_FORMAT = "<QIII"  # block offset, compressed block length, start in block, document length
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+
+class DocStoreWriter:
+    """
+    Appends documents to a data file, compressing them a block at a time.
+    The data file can be a real file or an io.BytesIO, which is how the indexing workers build
+    their blocks before the main process appends them with appendSegment.
+    """
+
+    def __init__(self, dataFile, blockSize=DOC_STORE_BLOCK_SIZE):
+        self.dataFile = dataFile
+        self.blockSize = blockSize
+        self.position = dataFile.tell()
+        self.block = bytearray()
+        self.blockDocs = []  # (internalId, start, length) of the documents in the current block
+        self.entries = {}  # internalId -> (block offset, block length, start, length)
+
+    def add(self, internalId, text):
+        self.addRecord(internalId, text.encode("utf-8"))
+
+    def addRecord(self, internalId, data):
+        """
+        Adds raw bytes for an internal ID. add() is the version for document text.
+        """
+        self.blockDocs.append((internalId, len(self.block), len(data)))
+        self.block += data
+        if len(self.block) >= self.blockSize:
+            self.flushBlock()
+
+    def flushBlock(self):
+        if not self.blockDocs:
+            return
+        compressed = zlib.compress(bytes(self.block))
+        self.dataFile.write(compressed)
+        for internalId, start, length in self.blockDocs:
+            self.entries[internalId] = (self.position, len(compressed), start, length)
+        self.position += len(compressed)
+        self.block = bytearray()
+        self.blockDocs = []
+
+    def finish(self):
+        """
+        Compresses whatever is left in the current block. Returns the entries for writeDocStoreIndex.
+        """
+        self.flushBlock()
+        return self.entries
+
+    def appendSegment(self, data, entries):
+        """
+        Appends blocks that were built by another writer (data is its whole data file, entries its finish() result).
+        Their block offsets are shifted to where they land in this file.
+        """
+        self.flushBlock()
+        base = self.position
+        self.dataFile.write(data)
+        for internalId, (blockOffset, blockLength, start, length) in entries.items():
+            self.entries[internalId] = (base + blockOffset, blockLength, start, length)
+        self.position += len(data)
+
+
+def writeDocStoreIndex(path, entries):
+    """
+    Writes the offset table for the given {internalId: record} entries.
+    Records are stored densely from the smallest to the largest internal ID so a lookup is a multiplication.
+    """
+    firstId = min(entries) if entries else 1
+    count = (max(entries) - firstId + 1) if entries else 0
+    emptyRecord = struct.pack(RECORD_FORMAT, 0, 0, 0, 0)
+    with open(path, "wb") as f:
+        f.write(struct.pack(HEADER_FORMAT, DOC_STORE_MAGIC, DOC_STORE_VERSION, firstId, count))
+        for internalId in range(firstId, firstId + count):
+            record = entries.get(internalId)
+            f.write(struct.pack(RECORD_FORMAT, *record) if record else emptyRecord)
+
+
+class DocStoreReader:
+    """
+    Random access to the documents of a packed document store.
+    The most recently decompressed block is kept since results often come from neighbouring documents.
+    """
+
+    def __init__(self, storePath, dataFileName=DOC_STORE_DATA_FILE, indexFileName=DOC_STORE_INDEX_FILE):
+        """
+        The file names can be changed for other stores with the same format (e.g. sentenceStore.py).
+        """
+        self.storePath = storePath
+        with open(os.path.join(storePath, indexFileName), "rb") as f:
+            self.table = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.firstId, self.count = struct.unpack_from(HEADER_FORMAT, self.table, 0)
+        if magic != DOC_STORE_MAGIC or version != DOC_STORE_VERSION:
+            self.table.close()
+            raise ValueError(f"{storePath} does not contain a supported document store.")
+        self.dataFile = open(os.path.join(storePath, dataFileName), "rb")
+        # Results are fetched from several threads (BM25.renderTopResults) and forked processes (searchServer.py) at
+        # once, and they all share the file position. So blocks are read with pread, which doesn't use it, or where
+        # there is no pread, the seek and read go together. The cached block is replaced together with its offset.
+        self.lock = threading.Lock()
+        self.cached = (None, None)  # (block offset, decompressed block)
+        self.docNoToId = None
+
+    def __contains__(self, internalId):
+        return self.firstId <= internalId < self.firstId + self.count
+
+    def fetchRecord(self, internalId):
+        """
+        Returns the raw bytes stored for an internal ID, or None if it isn't in the store.
+        """
+        if internalId not in self:
+            return None
+        blockOffset, blockLength, start, length = struct.unpack_from(
+            RECORD_FORMAT, self.table, HEADER_SIZE + RECORD_SIZE * (internalId - self.firstId))
+        if blockLength == 0:
+            return None
+        cachedOffset, block = self.cached
+        if blockOffset != cachedOffset:
+            if hasattr(os, "pread"):
+                ## Reference: https://docs.python.org/3/library/os.html#os.pread
+                compressed = os.pread(self.dataFile.fileno(), blockLength, blockOffset)
+            else:
+                with self.lock:
+                    self.dataFile.seek(blockOffset)
+                    compressed = self.dataFile.read(blockLength)
+            block = zlib.decompress(compressed)
+            self.cached = (blockOffset, block)
+        return block[start:start + length]
+
+    def fetch(self, internalId):
+        """
+        Returns the stored document text for an internal ID, or None if it isn't in the store.
+        """
+        data = self.fetchRecord(internalId)
+        return data.decode("utf-8") if data is not None else None
+
+    def records(self):
+        """
+        Returns {internalId: record} for every document in the store, in the form writeDocStoreIndex takes.
+        """
+        entries = {}
+        for position in range(self.count):
+            record = struct.unpack_from(RECORD_FORMAT, self.table, HEADER_SIZE + RECORD_SIZE * position)
+            if record[1]:
+                entries[self.firstId + position] = record
+        return entries
+
+    def internalIdForDocNo(self, docNo, mappingPath):
+        """
+        Looks up a DOCNO's internal ID. The mapping file is read the first time this is needed.
+        """
+        if self.docNoToId is None:
+            self.docNoToId = {}
+            with open(mappingPath, "r") as f:
+                for line in f:
+                    internalId, mappedDocNo = line.strip().split(":")
+                    self.docNoToId[mappedDocNo] = int(internalId)
+        return self.docNoToId.get(docNo)
+
+    def close(self):
+        self.table.close()
+        self.dataFile.close()
@@ -77,6 +77,66 @@ def calculateIdcg(relevantDocs, k):
     return idcg
 
 
+def evaluateQuery(queryId, retrievedDocs, qrels):
+    """
+    All the evaluation metrics of one query.
+
+    retrievedDocs: list of Result objects that were retrieved, in rank order
+    qrels: Qrels object containing all judgements
+    return: dictionary with precisionAt10, averagePrecision, ndcgAt10 and ndcgAt1000
+    """
+    # Calling all the evaluation metrics 
+    precisionAt10 = calculatePrecisionAtK(queryId, retrievedDocs, qrels, 10)
+    ap = calculateAveragePrecision(queryId, retrievedDocs, qrels)
+    dcgAt10 = calculateDcgAtK(queryId, retrievedDocs, qrels, 10)
+    dcgAt1000 = calculateDcgAtK(queryId, retrievedDocs, qrels, 1000)
+
+    relevant_docs = qrels.query_2_reldoc_nos[queryId]  # Correct way to access relevant docs
+    idcgAt10 = calculateIdcg(relevant_docs, 10)
+    idcgAt1000 = calculateIdcg(relevant_docs, 1000)
+    
+    ndcgAt10 = dcgAt10 / idcgAt10 if idcgAt10 > 0 else 0
+    ndcgAt1000 = dcgAt1000 / idcgAt1000 if idcgAt1000 > 0 else 0
+
+    return {
+        'precisionAt10': precisionAt10,
+        'averagePrecision': ap,
+        'ndcgAt10': ndcgAt10,
+        'ndcgAt1000': ndcgAt1000
+    }
+
+def evaluateResults(qrels, results):
+    """
+    Evaluates a run that is already in memory (a Results object), so runs don't have to be
+    written to a file and parsed again to be scored (see parameterSweep.py).
+
+    qrels: Qrels object containing all judgements
+    results: Results object with the retrieved documents of each query, in rank order
+    return: {queryId: metrics dictionary} for every judged query that has results
+    """
+    evaluationMetrics = {}
+
+    # Loop over each query in the qrels
+    for queryId in qrels.get_query_ids():
+        retrievedDocs = results.get_result(queryId)  # Correct method to retrieve results
+        if not retrievedDocs:
+            continue  # If no docs retrieved for this query, skip to the next
+
+        # retrievedDocsSorted = sorted(retrievedDocs, key=lambda x: (-x.score, x.doc_id))
+
+        evaluationMetrics[queryId] = evaluateQuery(queryId, retrievedDocs, qrels)
+    return evaluationMetrics
+
+def meanMetrics(evaluationMetrics):
+    """
+    The mean of each metric over the evaluated queries (so the mean of averagePrecision is MAP).
+    """
+    names = ['precisionAt10', 'averagePrecision', 'ndcgAt10', 'ndcgAt1000']
+    if not evaluationMetrics:
+        return {name: 0.0 for name in names}
+    return {name: sum(metrics[name] for metrics in evaluationMetrics.values()) / len(evaluationMetrics) for name in names}
+
+
 def evaluateIRSystem(qrelPath, resultsPath):
     """
     Evaluate the information retrieval system based on qrels and result data.
@@ -94,35 +154,7 @@ def evaluateIRSystem(qrelPath, resultsPath):
         if not results.query_2_results:
             raise ValueError("Results data is empty or incorrectly formatted.")
 
-        evaluationMetrics = {}
-
-        # Loop over each query in the qrels
-        for queryId in qrels.get_query_ids():
-            retrievedDocs = results.get_result(queryId)  # Correct method to retrieve results
-            if not retrievedDocs:
-                continue  # If no docs retrieved for this query, skip to the next
-
-            # retrievedDocsSorted = sorted(retrievedDocs, key=lambda x: (-x.score, x.doc_id))
-
-            # Calling all the evaluation metrics 
-            precisionAt10 = calculatePrecisionAtK(queryId, retrievedDocs, qrels, 10)
-            ap = calculateAveragePrecision(queryId, retrievedDocs, qrels)
-            dcgAt10 = calculateDcgAtK(queryId, retrievedDocs, qrels, 10)
-            dcgAt1000 = calculateDcgAtK(queryId, retrievedDocs, qrels, 1000)
-
-            relevant_docs = qrels.query_2_reldoc_nos[queryId]  # Correct way to access relevant docs
-            idcgAt10 = calculateIdcg(relevant_docs, 10)
-            idcgAt1000 = calculateIdcg(relevant_docs, 1000)
-            
-            ndcgAt10 = dcgAt10 / idcgAt10 if idcgAt10 > 0 else 0
-            ndcgAt1000 = dcgAt1000 / idcgAt1000 if idcgAt1000 > 0 else 0
-
-            evaluationMetrics[queryId] = {
-                'precisionAt10': precisionAt10,
-                'averagePrecision': ap,
-                'ndcgAt10': ndcgAt10,
-                'ndcgAt1000': ndcgAt1000
-            }
+        evaluationMetrics = evaluateResults(qrels, results)
 
         # Print the evaluation metrics for each query
         for queryId, metrics in evaluationMetrics.items():
@@ -7,46 +7,136 @@ Acknowledgements:
 
 import os # to help with creating directories
 import sys # to help catch errors with user input in the terminal
+from docStore import DocStoreReader, DOC_STORE_INDEX_FILE
+from segments import segmentPaths, SEGMENTS_DIR
 
-def fetchDocumentByDocNo(indexPath, docNo):
+# Packed document stores that have been opened, by index path, so each one is only opened once per process.
+# A store is closed and dropped once its segment is gone (closeRetiredDocStores).
+openDocStores = {}
+
+def openDocStore(indexPath):
     """
-    Fetches a document by its DOCNO from the storage.
-    outputPath: The path where the documents are stored.
-    docNo: The DOCNO of the desired document.
+    Returns the packed document store of an index built with --doc-store,
+    or None if the index stores each document in its own file.
+    """
+    if indexPath not in openDocStores:
+        store = None
+        if os.path.exists(os.path.join(indexPath, DOC_STORE_INDEX_FILE)):
+            store = DocStoreReader(indexPath)
+        openDocStores[indexPath] = store
+    return openDocStores[indexPath]
+
+def closeDocStores(paths):
+    """
+    Closes the packed document stores opened for these index or segment paths, and forgets them
+    (they are opened again if a document is fetched from them later).
+    """
+    for path in paths:
+        store = openDocStores.pop(path, None)
+        if store is not None:
+            store.close()
+
+def closeRetiredDocStores(indexPath):
     """
+    Closes the document stores of the segments of indexPath that are no longer in the index, e.g. the ones a merge
+    replaced and deleted. Documents are always fetched from the current segments, so nothing reads them anymore.
+    """
+    current = set(segmentPaths(indexPath))
+    segmentsPrefix = os.path.join(indexPath, SEGMENTS_DIR, "")
+    closeDocStores([path for path in openDocStores if path.startswith(segmentsPrefix) and path not in current])
+
+def fetchFromSegmentByDocNo(segmentPath, docNo):
+    """
+    Fetches a document by its DOCNO from one segment of the index (the index directory itself or an appended segment).
+    Returns None if the document isn't in this segment.
+    """
+    # Indexes built with --doc-store keep every document in one packed file.
+    store = openDocStore(segmentPath)
+    if store is not None:
+        internalId = store.internalIdForDocNo(docNo, os.path.join(segmentPath, "mapping.txt"))
+        return store.fetch(internalId) if internalId is not None else None
+
     # Extracting the date from the DOCNO to build the directory path
     year, month, day = '19' + docNo[6:8], docNo[2:4], docNo[4:6]
     # Constructing the directory path based on the date
-    directoryPath = os.path.join(indexPath, year, month, day)
+    directoryPath = os.path.join(segmentPath, year, month, day)
     # Construct the file path by appending the DOCNO to the directory path
     filePath = os.path.join(directoryPath, docNo + '.txt')
     
     # Check if the file exists at the constructed path
     if not os.path.exists(filePath):
-        return "This document doesn't exist. Please try searching again with a valid DOCNO."
+        return None
     
     # If the file exists, open it and return its content
     with open(filePath, 'r') as f:
         return f.read()
 
-def fetchDocumentByInternalId(indexPath, internalId):
+def fetchFromSegmentByInternalId(segmentPath, internalId):
     """
-    Fetches a document by its internal ID.
-    This function converts the internal ID to a DOCNO, then calls the function above to return the whole document.
+    Fetches a document by its internal ID from one segment of the index.
+    Returns None if the document isn't in this segment.
     """
+    # The packed document store is keyed by internal ID already, so it is read directly when there is one.
+    store = openDocStore(segmentPath)
+    if store is not None:
+        return store.fetch(internalId)
+
     # Open the mapping file that contains the relationship between internal IDs and DOCNO
     ## Reference: https://www.geeksforgeeks.org/python-os-path-join-method/
-    with open(os.path.join(indexPath, "mapping.txt"), "r") as map_file:
+    with open(os.path.join(segmentPath, "mapping.txt"), "r") as map_file:
         # Read all the lines (each line represents a mapping) and store it in a list
         ## Inspired from campuswire: https://campuswire.com/c/G6DF2065F/feed/23
         docNos = map_file.readlines()
-        
-        if internalId < len(docNos): # checking if it's a valids DOCNO we have
-            # Split the line at the colon to get the correct DOCNO
-            docNo = docNos[internalId-1].split(":")[1].strip()
-            return fetchDocumentByDocNo(indexPath, docNo) # Fetch the document using the extracted DOCNO
+
+    if not docNos:
+        return None
+    # Lines are in internal ID order, starting from the segment's first internal ID.
+    lineNumber = internalId - int(docNos[0].split(":")[0])
+    if 0 <= lineNumber < len(docNos): # checking if it's a valid DOCNO we have
+        # Split the line at the colon to get the correct DOCNO
+        docNo = docNos[lineNumber].split(":")[1].strip()
+        return fetchFromSegmentByDocNo(segmentPath, docNo) # Fetch the document using the extracted DOCNO
+    return None
+
+def fetchDocumentByDocNo(indexPath, docNo):
+    """
+    Fetches a document by its DOCNO from the storage.
+    indexPath: The path where the documents are stored.
+    docNo: The DOCNO of the desired document.
+    Documents indexed later with --append live in their segment, so every segment is checked.
+    """
+    for segmentPath in segmentPaths(indexPath):
+        document = fetchFromSegmentByDocNo(segmentPath, docNo)
+        if document is not None:
+            return document
+    return "This document doesn't exist. Please try searching again with a valid DOCNO."
+
+def fetchDocumentByInternalId(indexPath, internalId):
+    """
+    Fetches a document by its internal ID.
+    This function converts the internal ID to a DOCNO, then calls the function above to return the whole document.
+    """
+    for segmentPath in segmentPaths(indexPath):
+        document = fetchFromSegmentByInternalId(segmentPath, internalId)
+        if document is not None:
+            return document
     return "This document doesn't exist. Please try searching again with a valid ID."
 
+def fetchDocument(indexPath, internalId, docNo):
+    """
+    Fetches a document when both its internal ID and DOCNO are already known (e.g. a search result).
+    Uses the internal ID with the packed document store and the DOCNO with one file per document.
+    """
+    for segmentPath in segmentPaths(indexPath):
+        store = openDocStore(segmentPath)
+        if store is not None:
+            document = store.fetch(internalId)
+        else:
+            document = fetchFromSegmentByDocNo(segmentPath, docNo)
+        if document is not None:
+            return document
+    return "This document doesn't exist. Please try searching again with a valid DOCNO."
+
 def main():
     """
     Main function to fetch a document by its DOCNO or internal ID.
@@ -0,0 +1,284 @@
+'''
+Impact-ordered postings (indexEngine.py --impacts), an alternative to scoring with BM25.py's bm25.
+
+For each term, the BM25 contribution idf * f / (f + k) of every posting is worked out at indexing time
+(with k1 = 1.2 and b = 0.75) and quantized to a small integer, its "impact". The postings of a term are then
+grouped by impact, highest first. A query takes the groups with the highest impacts across all of its terms
+first, adds the impacts up in integer accumulators, and can stop after a budget of postings, which puts a
+ceiling on how long any query takes. Without a budget, the scores are BM25.bm25's scores (the sum times the
+number of query term occurrences found) with every contribution rounded to the nearest 1 / scale, so the ranking
+is BM25's except between documents whose scores are within the rounding error of each other.
+Every posting is stored, including those whose contribution rounds to 0 or is negative (terms in more than half
+of the documents have a negative IDF): they still count as an occurrence, and their groups come last.
+Each segment of an index with appended segments has its own impacts, worked out with its own statistics, so
+only an index without appended segments is guaranteed to rank like BM25 up to the rounding.
+
+Layout of impact_index.bin (all integers little-endian unless noted):
+- header: magic, format version, number of terms, impact scale (8-byte float)
+- offset table: (number of terms + 1) 8-byte offsets into the postings data, indexed by termID
+- postings data, for each term (variable byte coded): number of groups, then for each group the impact
+  (zigzag coded, 2n for n >= 0 and -2n - 1 below 0), the number of documents and their gap encoded docIDs
+  (in increasing order)
+
+Acknowledgements:
+- Impact-ordered indexes and score-at-a-time processing follow Anh and Moffat, "Pruned query evaluation
+  using pre-computed impacts" (SIGIR 2006), as presented in the efficient query processing lecture.
+'''
+
+import heapq
+import math
+import mmap
+import os
+import struct
+from array import array
+from collections import defaultdict
+from postingsFile import encodeVarByte, decodeVarByte, littleEndianBytes
+from collectionStats import computeIdf, defaultNorm
+from phraseQuery import parsePhrases, matchingDocuments
+from segments import segmentPaths
+from textAnalysis import tokenize
+
+IMPACT_INDEX_FILE = "impact_index.bin"
+IMPACT_MAGIC = b"IRIX"
+IMPACT_VERSION = 2  # 1 left out the postings that quantized to 0 or less
+HEADER_FORMAT = "<4sIId"  # magic, version, number of terms, impact scale
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# Impacts per unit of BM25 contribution. The largest contribution, log(N), is about 12 for LATimes,
+# so impacts fit in a byte.
+IMPACT_SCALE = 20
+
+
+def quantizeImpact(contribution, scale=IMPACT_SCALE):
+    # Rounded to the nearest integer, negative contributions too.
+    return math.floor(contribution * scale + 0.5)
+
+
+def zigzag(number):
+    # Maps 0, -1, 1, -2, 2, ... to 0, 1, 2, 3, 4, ... so signed impacts can be variable byte coded.
+    return 2 * number if number >= 0 else -2 * number - 1
+
+
+def unzigzag(number):
+    return number >> 1 if not number & 1 else -((number + 1) >> 1)
+
+
+def encodeImpacts(postings, idf, norms):
+    """
+    Encodes a term's postings as impact groups, highest impact first.
+    norms is the default length normalisation of each document, indexed by docID (a dictionary or an array).
+    """
+    groups = defaultdict(list)
+    for posting in postings:
+        docId, f_i = posting[0], posting[1]
+        groups[quantizeImpact(idf * f_i / (f_i + norms[docId]))].append(docId)
+
+    encoded = bytearray()
+    encodeVarByte(len(groups), encoded)
+    for impact in sorted(groups, reverse=True):
+        docIds = groups[impact]
+        encodeVarByte(zigzag(impact), encoded)
+        encodeVarByte(len(docIds), encoded)
+        previous = 0
+        for docId in docIds:
+            encodeVarByte(docId - previous, encoded)
+            previous = docId
+    return bytes(encoded)
+
+
+class ImpactIndexWriter:
+    """
+    Writes impact_index.bin while the regular postings are being written (see observe), one term at a time.
+    """
+
+    def __init__(self, path, numTerms, docLengths):
+        self.f = open(path, "wb")
+        self.numTerms = numTerms
+        self.N = len(docLengths)
+        avgDl = sum(docLengths.values()) / self.N if self.N else 0.0
+        self.norms = {docId: defaultNorm(dl, avgDl) for docId, dl in docLengths.items()}
+        self.offsets = array("Q", [0]) * (numTerms + 1)
+        self.position = 0
+        self.nextTermID = 0
+        self.f.write(struct.pack(HEADER_FORMAT, IMPACT_MAGIC, IMPACT_VERSION, numTerms, IMPACT_SCALE))
+        # Leave room for the offset table and fill it in at the end.
+        self.f.write(bytes(8 * (numTerms + 1)))
+
+    def observe(self, termPostings):
+        """
+        Passes the (termID, postings) pairs through unchanged while writing their impacts.
+        """
+        for termID, postings in termPostings:
+            self.addTerm(termID, postings)
+            yield termID, postings
+
+    def addTerm(self, termID, postings):
+        self.addEncodedTerm(termID, encodeImpacts(postings, computeIdf(self.N, len(postings)), self.norms))
+
+    def addEncodedTerm(self, termID, encoded):
+        """
+        Adds a term's groups encoded by encodeImpacts (indexEngine.py --workers encodes them in the workers).
+        """
+        # Any skipped terms have no groups.
+        while self.nextTermID <= termID:
+            self.offsets[self.nextTermID] = self.position
+            self.nextTermID += 1
+        self.f.write(encoded)
+        self.position += len(encoded)
+
+    def close(self):
+        while self.nextTermID <= self.numTerms:
+            self.offsets[self.nextTermID] = self.position
+            self.nextTermID += 1
+        self.f.seek(HEADER_SIZE)
+        self.f.write(littleEndianBytes(self.offsets))
+        self.f.close()
+
+
+class ImpactReader:
+    """
+    Reads impact_index.bin. The file is memory mapped and a term's groups are decoded one at a time,
+    so a query that stops early never decodes the rest.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.numTerms, self.scale = struct.unpack_from(HEADER_FORMAT, self.mm, 0)
+        if magic != IMPACT_MAGIC or version != IMPACT_VERSION:
+            self.mm.close()
+            raise ValueError(f"{path} is not a supported impact index.")
+        self.dataStart = HEADER_SIZE + 8 * (self.numTerms + 1)
+
+    def groups(self, termID):
+        """
+        Yields (impact, docIDs) for the term, highest impact first.
+        """
+        if not 0 <= termID < self.numTerms:
+            return
+        pos = self.dataStart + struct.unpack_from("<Q", self.mm, HEADER_SIZE + 8 * termID)[0]
+        numGroups, pos = decodeVarByte(self.mm, pos)
+        for _ in range(numGroups):
+            impact, pos = decodeVarByte(self.mm, pos)
+            impact = unzigzag(impact)
+            count, pos = decodeVarByte(self.mm, pos)
+            docIds = []
+            docId = 0
+            for _ in range(count):
+                gap, pos = decodeVarByte(self.mm, pos)
+                docId += gap
+                docIds.append(docId)
+            yield impact, docIds
+
+    def close(self):
+        self.mm.close()
+
+
+def hasCurrentImpacts(path):
+    """
+    Whether path is an impact index this version can read.
+    """
+    if not os.path.exists(path):
+        return False
+    with open(path, "rb") as f:
+        header = f.read(HEADER_SIZE)
+    return len(header) == HEADER_SIZE and struct.unpack(HEADER_FORMAT, header)[:2] == (IMPACT_MAGIC, IMPACT_VERSION)
+
+
+def hasImpacts(indexPath):
+    """
+    Whether every segment of the index was built with --impacts (by a version that writes the current format).
+    """
+    return all(hasCurrentImpacts(os.path.join(path, IMPACT_INDEX_FILE)) for path in segmentPaths(indexPath))
+
+
+class ImpactScorer:
+    """
+    Score-at-a-time retrieval from the impact-ordered postings of every segment of an index.
+    """
+
+    def __init__(self, indexPath, lexicon, invertedIndex, docLengths):
+        """
+        Args:
+            indexPath (str): The index directory (built with indexEngine.py --impacts).
+            lexicon (dict): Mapping of terms to term IDs.
+            invertedIndex: The regular inverted index, used for phrases and for the termIDs of each segment.
+            docLengths (dict): Mapping of document IDs to document lengths (for the size of the accumulators).
+        """
+        self.lexicon = lexicon
+        self.invertedIndex = invertedIndex
+        self.readers = [ImpactReader(os.path.join(path, IMPACT_INDEX_FILE)) for path in segmentPaths(indexPath)]
+        # {unified termID: segment termID} for each segment. An index without appended segments uses the lexicon's IDs.
+        self.localTermIDs = getattr(invertedIndex, "localTermIDs", None)
+        self.numDocIds = max(docLengths, default=0) + 1
+
+    def topK(self, query, k, postingsBudget=None):
+        """
+        The k documents with the highest summed impacts.
+
+        Args:
+            query (str): The search query.
+            k (int): The number of results.
+            postingsBudget (int): Stop after this many postings (None to process them all).
+
+        Returns:
+            list: (docID, score) tuples with the highest scoring documents first. Like BM25.bm25, the score is
+                  the sum of the document's impacts times the number of query term occurrences found in it,
+                  divided by the impact scale.
+        """
+        phraseMatches = matchingDocuments(parsePhrases(query), self.lexicon.get, self.invertedIndex)
+        # A term that is in the query twice counts twice.
+        weights = defaultdict(int)
+        for term in tokenize(query):
+            termId = self.lexicon.get(term)
+            if termId is not None:
+                weights[termId] += 1
+
+        # One stream of groups per query term and segment, ordered by the impact of its next group.
+        streams = []
+        for termId, weight in weights.items():
+            for segment, reader in enumerate(self.readers):
+                localId = termId if self.localTermIDs is None else self.localTermIDs[segment].get(termId)
+                if localId is not None:
+                    streams.append((weight, reader.groups(localId)))
+        heads = []
+        for number, (weight, groups) in enumerate(streams):
+            group = next(groups, None)
+            if group is not None:
+                heads.append((-group[0] * weight, number, group[1]))
+
+        accumulators = array("i", [0]) * self.numDocIds
+        # Query term occurrences found in each document: BM25.bm25 multiplies a document's sum by this.
+        occurrences = array("I", [0]) * self.numDocIds
+        touched = []
+        processed = 0
+        while heads and (postingsBudget is None or processed < postingsBudget):
+            # The highest impact group left. There are only a few streams, so max is quicker than a heap.
+            best = max(range(len(heads)), key=lambda position: (-heads[position][0], -heads[position][1]))
+            negativeImpact, number, docIds = heads[best]
+            impact = -negativeImpact
+            weight = streams[number][0]
+            if postingsBudget is not None:
+                docIds = docIds[:postingsBudget - processed]
+            processed += len(docIds)
+            for docId in docIds:
+                if phraseMatches is not None and docId not in phraseMatches:
+                    continue
+                if not occurrences[docId]:
+                    touched.append(docId)
+                accumulators[docId] += impact
+                occurrences[docId] += weight
+
+            group = next(streams[number][1], None)
+            if group is None:
+                heads.pop(best)
+            else:
+                heads[best] = (-group[0] * streams[number][0], number, group[1])
+
+        # Highest score first, ties by docID.
+        best = heapq.nsmallest(k, touched, key=lambda docId: (-occurrences[docId] * accumulators[docId], docId))
+        scale = self.readers[0].scale
+        return [(docId, occurrences[docId] * accumulators[docId] / scale) for docId in best]
+
+    def close(self):
+        for reader in self.readers:
+            reader.close()
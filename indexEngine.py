@@ -9,6 +9,24 @@ Acknowledgements:
 import os # to help with creating directories
 import sys # to help catch errors with user input in the terminal
 import gzip
+import io
+import argparse
+import multiprocessing
+import shutil
+from array import array
+from bisect import bisect_left
+from collections import deque
+from textAnalysis import tokenize, removeTags
+from postingsFile import writePostingsFile, writeEncodedPostingsFile, writeBatchRun, mergeBatchRuns, PostingsReader, decodePostings, writeRun, readRun, mergeRuns
+from docStore import DocStoreReader, DocStoreWriter, writeDocStoreIndex, DOC_STORE_DATA_FILE, DOC_STORE_INDEX_FILE
+from docMetadata import writeMetadataTable, MetadataTable, METADATA_FILE
+from collectionStats import CollectionStats, CollectionStatsBuilder, computeIdf, defaultNorm, termStatistics, STATS_FILE
+from impactIndex import ImpactIndexWriter, encodeImpacts, IMPACT_INDEX_FILE
+from sentenceStore import snippetSentences, encodeSentences, remapSentences, sentenceStoreWriter, UNKNOWN_TERM, SENTENCES_DATA_FILE, SENTENCES_INDEX_FILE
+from segments import readManifest, writeManifest, segmentPath, segmentPaths, temporarySegmentPath, newSegmentName, lastInternalId, segmentDocNos, segmentSize, chooseSegmentsToMerge, MAX_SEGMENTS
+from shards import shardName, writeShardManifest, writeGlobalStats, isSharded
+
+INVERTED_INDEX_FILE = "inverted_index.bin"
 
 # Dictionary to convert numerical months to full word strings
 MONTHS = {
@@ -31,28 +49,27 @@ lexicon = {}  # Maps terms to their unique integer IDs
 termStringToID = {}  # Maps integer IDs back to their corresponding terms
 invertedIndex = {}  # The actual inverted index
 docLengths = {}  # DOCNO to document length
+docNoMapping = {}  # Internal ID to DOCNO, written to mapping.txt at the end
+docMetadata = {}  # Internal ID to (DOCNO, date, headline), written to the metadata table at the end
+docStore = None  # DocStoreWriter when indexing with --doc-store, otherwise documents get their own files
+sentenceStore = None  # DocStoreWriter for the snippet sentences of each document (see sentenceStore.py)
+docSentences = {}  # In a worker: internal ID to its encoded sentences with local term IDs, remapped when merged
+storePositions = False  # With --positions, postings are (docID, count, positions) so phrase queries can use them
+storeImpacts = False  # With --impacts, impact-ordered postings are written too (see impactIndex.py)
+storeSentences = False  # With --snippet-store, the snippet sentences of each document are written too (see sentenceStore.py)
 
-def tokenize(text):
-    """
-    Tokenizes the given text by downcasing all characters and treating sequences of alphanumerics as tokens.
-    Using mainly the pseudocode from the lectures.
-    """
-    tokens = []
-    text = text.lower()
-    start = 0  # Starting index of a potential token
-
-    for i in range(len(text)):
-        if not text[i].isalnum():  # If the character is not alphanumeric
-            if start != i:  # If there's a potential token between start and i
-                token = text[start:i]
-                tokens.append(token)
-            start = i + 1  # Update the starting index for the next potential token
-
-    # Handles the case where the last token extends to the end of the text
-    if start < len(text):
-        tokens.append(text[start:])
+# Number of <DOC> blocks handed to a worker at a time when indexing with --workers.
+DOCS_PER_BATCH = 1000
+# With --workers, the statistics of the merged postings are worked out in about this many ranges of terms per worker.
+TERM_RANGES_PER_WORKER = 4
 
-    return tokens
+# Memory-bounded indexing (--memory-budget).
+memoryBudget = None  # Bytes of postings to keep in memory before they are spilled to disk as a sorted run
+postingsMemory = 0  # Estimate of how many bytes the postings in invertedIndex take
+spilledRuns = []  # Paths of the sorted runs written so far, oldest first
+BYTES_PER_POSTING = 100  # Rough size of one (docID, count) tuple in a Python list
+BYTES_PER_POSITION = 36  # Rough size of one position in a positions list
+RUNS_DIR = "runs"  # Temporary folder for the runs inside the output directory
 
 def convertTokensToIDs(tokens):
     """
@@ -91,11 +108,38 @@ def addToPostings(wordCounts, docID):
     Building the inverted index using individual posting lists.
     Mainly using the pseudocode from the lecture.
     """
+    global postingsMemory
     for termID in wordCounts:
         count = wordCounts[termID]
         if termID not in invertedIndex:
             invertedIndex[termID] = []
         invertedIndex[termID].append((docID, count))
+    postingsMemory += len(wordCounts) * BYTES_PER_POSTING
+
+def collectPositions(tokenIDs):
+    """
+    Positions of each token ID in the document (0 for the first token, 1 for the second, ...), for --positions.
+    """
+    positions = {}
+    for position, ID in enumerate(tokenIDs):
+        if ID in positions:
+            positions[ID].append(position)
+        else:
+            positions[ID] = [position]
+    return positions
+
+def addToPositionalPostings(positions, docID):
+    """
+    Positional version of addToPostings: each posting is (docID, count, positions).
+    """
+    global postingsMemory
+    numPositions = 0
+    for termID, termPositions in positions.items():
+        if termID not in invertedIndex:
+            invertedIndex[termID] = []
+        invertedIndex[termID].append((docID, len(termPositions), termPositions))
+        numPositions += len(termPositions)
+    postingsMemory += len(positions) * BYTES_PER_POSTING + numPositions * BYTES_PER_POSITION
 
 
 def extractMetadataAndStoreDocument(documentContent, outputPath, internalId):
@@ -115,18 +159,26 @@ def extractMetadataAndStoreDocument(documentContent, outputPath, internalId):
         headlineContent = documentContent.split('<HEADLINE>')[1].split('</HEADLINE>')[0].strip()
         # Removing the all other tags within the headline and removing new lines
         headline = headlineContent.replace('<P>', '').replace('</P>', '').replace('\n', '').strip()
+        docMetadata[internalId] = (docno, f"{year}-{month}-{day}", headline)
+    else:
+        # An empty headline in the metadata table lets the result page fall back to the snippet
+        docMetadata[internalId] = (docno, f"{year}-{month}-{day}", "")
 
-    # Create directory structure based on date using the format yyyy / mm / dd / docs
-    directoryPath = os.path.join(outputPath, year, month, day)
-    os.makedirs(directoryPath, exist_ok=True)
+    storedDocument = f"docno: {docno}\ninternal id: {internalId}\ndate: {MONTHS[month]} {day}, {year}\nheadline: {headline}\nraw document:\n{documentContent}"
+    if docStore is not None:
+        # Append the document to the packed document store
+        docStore.add(internalId, storedDocument)
+    else:
+        # Create directory structure based on date using the format yyyy / mm / dd / docs
+        directoryPath = os.path.join(outputPath, year, month, day)
+        os.makedirs(directoryPath, exist_ok=True)
 
-    # Store the document in a .txt file
-    with open(os.path.join(directoryPath, docno + '.txt'), 'w') as f:
-        f.write(f"docno: {docno}\ninternal id: {internalId}\ndate: {MONTHS[month]} {day}, {year}\nheadline: {headline}\nraw document:\n{documentContent}")
+        # Store the document in a .txt file
+        with open(os.path.join(directoryPath, docno + '.txt'), 'w') as f:
+            f.write(storedDocument)
     
-    # Writing the mapping to the mapping.txt file
-    with open(os.path.join(outputPath, "mapping.txt"), "a") as map_file:
-        map_file.write(f"{internalId}:{docno}\n")
+    # Remembering the mapping for the mapping.txt file
+    docNoMapping[internalId] = docno
     
     # Tokenizing the content
     # Extract content from <HEADLINE> tag
@@ -144,10 +196,25 @@ def extractMetadataAndStoreDocument(documentContent, outputPath, internalId):
     tokens = tokenize(content_cleaned) # Tokenize the contnet
     # Convert tokens to their integer IDs
     tokenIDs = convertTokensToIDs(tokens)
-    # Count the occurrences of each token ID
-    wordCounts = countWords(tokenIDs)
-    # Add the word counts to the inverted index
-    addToPostings(wordCounts, internalId)
+    if storeSentences:
+        # The sentences a snippet can be made of, with the term IDs of their tokens, so the result page doesn't
+        # have to split and tokenize the document for every query.
+        getTermID = termStringToID.get
+        sentences = [(sentence, [getTermID(token, UNKNOWN_TERM) for token in tokenize(sentence)]) for sentence in snippetSentences(documentContent)]
+        if sentenceStore is not None:
+            sentenceStore.addRecord(internalId, encodeSentences(sentences))
+        else:
+            # A worker's term IDs are local to its batch, so they are remapped once the batch is merged.
+            docSentences[internalId] = encodeSentences(sentences)
+
+    if storePositions:
+        # Add the positions of each token ID to the inverted index
+        addToPositionalPostings(collectPositions(tokenIDs), internalId)
+    else:
+        # Count the occurrences of each token ID
+        wordCounts = countWords(tokenIDs)
+        # Add the word counts to the inverted index
+        addToPostings(wordCounts, internalId)
 
     # After tokenizing the document
     docLength = len(tokens)
@@ -158,52 +225,10 @@ def extractMetadataAndStoreDocument(documentContent, outputPath, internalId):
 
     return internalId
 
-def removeTags(content):
-    '''
-    Function to remove all inner tags within the <HEADLINE>, <TEXT>, and <GRAPHIC> tags.
-    Used ChatGPT for inspiration behind the logic of this function.
-    '''
-    result = []
-    inside_tag = False
-    for char in content:
-        if char == '<':
-            inside_tag = True
-        elif char == '>':
-            inside_tag = False
-        elif not inside_tag:
-            result.append(char)
-    return ''.join(result)
-
-def main():
+def readDocuments(inputPath):
     """
-    Main function to index and store documents and their metadata.
+    Generator that reads the gzip file line by line and yields the content of each <DOC>...</DOC> block.
     """
-    # Checking if the correct number of command line arguments are provided.
-    ## Used Chat GPT here to explain to me what sys.argv does as I wasn't familiar with the package at the start of this assignment.
-    if len(sys.argv) != 3:
-        print("Error: Please provide all the required arguments to run properly: python3 indexEngine.py <path_to_latimes.gz> <path_to_store>")
-        sys.exit(1)
-
-    # Extracting the input file path and the output directory path from the command line arguments.
-    inputPath = sys.argv[1]
-    outputPath = sys.argv[2]
-
-    # Checking if the input directory exists. If it does not, exit with an error message.
-    if not os.path.exists(inputPath):
-        print("Error: The specified input directory does not exist. Please choose an existing one and try again.")
-        sys.exit(1)
-
-    # Checking if the output directory already exists. If it does, exit with an error message.
-    if os.path.exists(outputPath):
-        print("Error: The specified directory already exists. Please choose something different and try again.")
-        sys.exit(1)
-
-    # Create the output directory.
-    ## Reference: https://www.geeksforgeeks.org/python-os-makedirs-method/
-    os.makedirs(outputPath)
-
-    # Initializing the internal ID counter for the documents.
-    internalId = 1
     # Initializing an empty string to accumulate the content of a document.
     documentContent = ""
     # Boolean to indicate if we are currently inside a <DOC>...</DOC> block.
@@ -223,11 +248,288 @@ def main():
             # Checking if the current line marks the end of a document.
             if "</DOC>" in line:
                 insideDoc = False
-                # Extract metadata from the accumulated document content and store the document.
-                internalId = extractMetadataAndStoreDocument(documentContent, outputPath, internalId)
+                yield documentContent
                 # Reset the document content accumulator for the next document.
                 documentContent = ""
 
+def documentNumbers(inputPath):
+    """
+    Generator over the DOCNO of every document of the input, without indexing anything.
+    """
+    for documentContent in readDocuments(inputPath):
+        yield documentContent.split("<DOCNO>")[1].split("</DOCNO>")[0].strip()
+
+def findDuplicateDocNos(docNos, seen):
+    """
+    The DOCNOs that are already in seen or come up more than once, in the order they come up. Adds them all to seen.
+    """
+    duplicates = []
+    for docNo in docNos:
+        if docNo in seen:
+            duplicates.append(docNo)
+        seen.add(docNo)
+    return duplicates
+
+def batchDocuments(documents, firstId, batchSize=DOCS_PER_BATCH):
+    """
+    Groups the documents into batches for the workers.
+    Yields (internal ID of the first document in the batch, list of documents).
+    The internal IDs are given out here so they are the same as a single process run.
+    """
+    batch = []
+    for documentContent in documents:
+        batch.append(documentContent)
+        if len(batch) == batchSize:
+            yield firstId, batch
+            firstId += batchSize
+            batch = []
+    if batch:
+        yield firstId, batch
+
+def resetIndex():
+    """
+    Clears the global index structures so a worker starts every batch with an empty private segment.
+    """
+    global postingsMemory
+    lexicon.clear()
+    termStringToID.clear()
+    invertedIndex.clear()
+    docLengths.clear()
+    docNoMapping.clear()
+    docMetadata.clear()
+    docSentences.clear()
+    postingsMemory = 0
+    spilledRuns.clear()
+
+def indexBatch(args):
+    """
+    Worker function for --workers mode.
+    Indexes a batch of documents into a private segment that uses local term IDs (0, 1, 2, ... in
+    order of first appearance in the batch). The postings are written to a run in their final encoding
+    (postingsFile.writeBatchRun), and the rest is returned so the main process can merge it.
+    """
+    global docStore, sentenceStore, storePositions, storeSentences
+    outputPath, firstId, documents, useDocStore, storePositions, storeSentences = args
+    resetIndex()
+    sentenceStore = None
+    # With --doc-store the worker compresses its documents into blocks in memory.
+    docStore = DocStoreWriter(io.BytesIO()) if useDocStore else None
+    internalId = firstId
+    for documentContent in documents:
+        internalId = extractMetadataAndStoreDocument(documentContent, outputPath, internalId)
+    runPath = os.path.join(outputPath, RUNS_DIR, f"batch-{firstId:010d}.bin")
+    offsets, dfs, lastDocIDs = writeBatchRun(runPath, [invertedIndex[localID] for localID in range(len(lexicon))], storePositions)
+    segment = {
+        "terms": [lexicon[localID] for localID in range(len(lexicon))],
+        "run": (runPath, offsets, dfs, lastDocIDs),
+        "docLengths": dict(docLengths),
+        "mapping": dict(docNoMapping),
+        "metadata": dict(docMetadata),
+        "sentences": dict(docSentences),
+    }
+    if docStore is not None:
+        entries = docStore.finish()
+        segment["docStore"] = (docStore.dataFile.getvalue(), entries)
+    return segment
+
+def mergeSegment(segment):
+    """
+    Merges a segment read back from disk (loadSegmentFromDisk) into the global index.
+    Local term IDs are remapped to global IDs with convertTokensToIDs, so new terms get the next IDs in
+    the same order a single process would have given them. Segments are merged in order, which keeps
+    every postings list sorted by docID.
+    """
+    global postingsMemory
+    globalIDs = convertTokensToIDs(segment["terms"])
+    for localID, postings in segment["postings"].items():
+        termID = globalIDs[localID]
+        if termID not in invertedIndex:
+            invertedIndex[termID] = []
+        invertedIndex[termID].extend(postings)
+        postingsMemory += len(postings) * BYTES_PER_POSTING
+        if storePositions:
+            postingsMemory += sum(posting[1] for posting in postings) * BYTES_PER_POSITION
+    mergeDocuments(segment, globalIDs)
+
+def encodeBatchSentences(args):
+    """
+    Worker function for --workers mode with --snippet-store: gives a batch's sentence records their global term IDs
+    and compresses them into blocks, which the main process appends to the sentence store as they are.
+    """
+    records, globalIDs = args
+    writer = sentenceStoreWriter(io.BytesIO())
+    for internalId, record in records.items():
+        writer.addRecord(internalId, remapSentences(record, globalIDs))
+    entries = writer.finish()
+    return writer.dataFile.getvalue(), entries
+
+def mergeBatch(segment, batches, pool, sentenceJobs):
+    """
+    Merges a worker's batch into the global index. Its postings stay in the run the worker wrote: only the global
+    term IDs of its terms are worked out (in batch order, like mergeSegment), and the run is added to batches
+    for writeIndexFiles to merge. Its sentences are handed back to a worker with the global term IDs, and the
+    job is added to sentenceJobs.
+    """
+    globalIDs = convertTokensToIDs(segment["terms"])
+    batches.append(segment["run"] + (globalIDs,))
+    records = segment.pop("sentences")
+    if sentenceStore is not None:
+        sentenceJobs.append(pool.apply_async(encodeBatchSentences, ((records, array("I", globalIDs)),)))
+    mergeDocuments(segment, globalIDs)
+
+def mergeDocuments(segment, globalIDs):
+    """
+    Adds the document lengths, DOCNOs, metadata, sentences and stored documents of a segment or batch.
+    """
+    docLengths.update(segment["docLengths"])
+    docNoMapping.update(segment["mapping"])
+    docMetadata.update(segment["metadata"])
+    if sentenceStore is not None:
+        for internalId, record in segment.get("sentences", {}).items():
+            sentenceStore.addRecord(internalId, remapSentences(record, globalIDs))
+    if "docStore" in segment:
+        docStore.appendSegment(*segment["docStore"])
+
+def spillIfOverBudget(outputPath):
+    """
+    With --memory-budget, writes the in-memory postings to disk as a sorted run once they take up more than the budget,
+    then starts over with an empty inverted index. writeIndexFiles merges all the runs at the end.
+    """
+    global postingsMemory
+    if memoryBudget is None or postingsMemory <= memoryBudget:
+        return
+    runsPath = os.path.join(outputPath, RUNS_DIR)
+    os.makedirs(runsPath, exist_ok=True)
+    runPath = os.path.join(runsPath, f"run-{len(spilledRuns):05d}.bin")
+    writeRun(runPath, sorted(invertedIndex.items()), storePositions)
+    spilledRuns.append(runPath)
+    invertedIndex.clear()
+    postingsMemory = 0
+
+def indexWithWorkers(pool, inputPath, outputPath, numWorkers, useDocStore, firstId):
+    """
+    Indexes the collection with a pool of worker processes. Each batch's postings are written by its worker to a run
+    in the runs folder, so the main process never holds postings (and --memory-budget isn't needed).
+    Only a couple of batches per worker are in flight at once so memory use doesn't depend on the collection size.
+    Returns the runs of the batches, in docID order, for writeIndexFiles.
+    """
+    os.makedirs(os.path.join(outputPath, RUNS_DIR), exist_ok=True)
+    batches = []
+    pending = deque()
+    sentenceJobs = deque()
+    for firstId, documents in batchDocuments(readDocuments(inputPath), firstId):
+        pending.append(pool.apply_async(indexBatch, ((outputPath, firstId, documents, useDocStore, storePositions, storeSentences),)))
+        # Merge the oldest batch once enough work is queued up. Merging in submission order keeps docIDs sorted.
+        if len(pending) >= 2 * numWorkers:
+            mergeBatch(pending.popleft().get(), batches, pool, sentenceJobs)
+        # The compressed sentence blocks are only concatenated here.
+        if len(sentenceJobs) >= 2 * numWorkers:
+            sentenceStore.appendSegment(*sentenceJobs.popleft().get())
+    while pending:
+        mergeBatch(pending.popleft().get(), batches, pool, sentenceJobs)
+    while sentenceJobs:
+        sentenceStore.appendSegment(*sentenceJobs.popleft().get())
+    return batches
+
+def splitTermRanges(offsets, numRanges):
+    """
+    Splits the termIDs into up to numRanges ranges with about the same number of bytes of postings each.
+    offsets are the offsets of the terms' postings returned by writeEncodedPostingsFile.
+    """
+    numTerms = len(offsets) - 1
+    ends = {bisect_left(offsets, offsets[-1] * part / numRanges, 0, numTerms) for part in range(1, numRanges)}
+    bounds = [0] + sorted(end for end in ends if 0 < end < numTerms) + [numTerms]
+    return list(zip(bounds, bounds[1:]))
+
+def collectTermStatistics(args):
+    """
+    Worker function for --workers mode: the collection statistics (and with --impacts, the encoded impacts) of a
+    range of terms of the merged postings file. The postings are decoded here instead of in the main process.
+    """
+    postingsPath, start, end, N, lengths, norms, withImpacts = args
+    postingsReader = PostingsReader(postingsPath)
+    statistics = []
+    impacts = [] if withImpacts else None
+    for termID in range(start, end):
+        postings = decodePostings(postingsReader.rawPostings(termID), postingsReader.positional)
+        if postings:
+            statistics.append((len(postings),) + termStatistics(postings, N, lengths, norms))
+        else:
+            statistics.append((0, 0, 0, 0, 0.0))
+        if withImpacts:
+            impacts.append(encodeImpacts(postings, computeIdf(N, len(postings)), norms))
+    postingsReader.close()
+    return start, statistics, impacts
+
+def writeMergedBatches(outputPath, pool, numWorkers, batches):
+    """
+    --workers: k-way merges the batches' runs into the postings file as bytes, then works out the collection statistics
+    and impacts of ranges of terms in the worker processes.
+    """
+    postingsPath = os.path.join(outputPath, INVERTED_INDEX_FILE)
+    numTerms = len(lexicon)
+    offsets = writeEncodedPostingsFile(postingsPath, numTerms, mergeBatchRuns(batches), storePositions)
+    shutil.rmtree(os.path.join(outputPath, RUNS_DIR))
+
+    # Document lengths and default length normalisations as arrays indexed by docID, which are quick to send to the workers.
+    N = len(docLengths)
+    totalTokens = sum(docLengths.values())
+    avgDl = totalTokens / N if N else 0.0
+    lengths = array("I", [0]) * (max(docLengths, default=0) + 1)
+    norms = array("d", [0.0]) * len(lengths)
+    for docID, length in docLengths.items():
+        lengths[docID] = length
+        norms[docID] = defaultNorm(length, avgDl)
+
+    df = array("I", [0]) * numTerms
+    cf = array("Q", [0]) * numTerms
+    maxTf = array("I", [0]) * numTerms
+    minDl = array("I", [0]) * numTerms
+    maxScore = array("d", [0.0]) * numTerms
+    impactWriter = None
+    if storeImpacts:
+        impactWriter = ImpactIndexWriter(os.path.join(outputPath, IMPACT_INDEX_FILE), numTerms, docLengths)
+    work = [(postingsPath, start, end, N, lengths, norms, storeImpacts)
+            for start, end in splitTermRanges(offsets, numWorkers * TERM_RANGES_PER_WORKER)]
+    # imap hands the ranges back in order, so the impacts are written in termID order.
+    for start, statistics, impacts in pool.imap(collectTermStatistics, work):
+        for termID, (df[termID], cf[termID], maxTf[termID], minDl[termID], maxScore[termID]) in enumerate(statistics, start):
+            if impactWriter is not None:
+                impactWriter.addEncodedTerm(termID, impacts[termID - start])
+    CollectionStats(N, totalTokens, df, cf, maxTf, minDl, maxScore=maxScore).write(os.path.join(outputPath, STATS_FILE))
+    if impactWriter is not None:
+        impactWriter.close()
+
+def writePostings(outputPath):
+    """
+    Writes the in-memory postings (merged with any runs spilled by --memory-budget) to the postings file,
+    with the collection statistics and impacts worked out as they stream past.
+    """
+    termPostings = sorted(invertedIndex.items())
+    if spilledRuns:
+        # Some postings were spilled to disk, so k-way merge the runs with what is still in memory (the newest postings).
+        termPostings = mergeRuns([readRun(runPath, storePositions) for runPath in spilledRuns] + [termPostings])
+    # The collection statistics (df, cf and IDF of each term) are collected as the postings stream past.
+    statsBuilder = CollectionStatsBuilder(len(lexicon), docLengths)
+    termPostings = statsBuilder.observe(termPostings)
+    impactWriter = None
+    if storeImpacts:
+        # And so are the impact-ordered postings.
+        impactWriter = ImpactIndexWriter(os.path.join(outputPath, IMPACT_INDEX_FILE), len(lexicon), docLengths)
+        termPostings = impactWriter.observe(termPostings)
+    writePostingsFile(os.path.join(outputPath, INVERTED_INDEX_FILE), len(lexicon), termPostings, storePositions)
+    statsBuilder.build().write(os.path.join(outputPath, STATS_FILE))
+    if impactWriter is not None:
+        impactWriter.close()
+    if spilledRuns:
+        shutil.rmtree(os.path.join(outputPath, RUNS_DIR))
+        spilledRuns.clear()
+
+def writeIndexFiles(outputPath, pool=None, numWorkers=1, batches=None):
+    """
+    Writes the lexicon, mapping, inverted index and document lengths to the output directory.
+    With --workers, the postings are in the batches' runs and are merged with writeMergedBatches.
+    """
     # Writing all required files to the latimes-index folder.
     # Lexicon: termID -> termString.
     with open(os.path.join(outputPath, "lexicon.txt"), "w") as f:
@@ -239,18 +541,384 @@ def main():
         for term, termID in termStringToID.items():
             f.write(f"{term}:{termID}\n")
 
-    # Inverted index -> termID: docID:count, docID:count, docID:count, ...
-    with open(os.path.join(outputPath, "inverted_index.txt"), "w") as f:
-        for termID, postings in invertedIndex.items():
-            postingsStr = ', '.join([f"{docID}:{count}" for docID, count in postings])
-            f.write(f"{termID}: {postingsStr}\n")
+    # Mapping: internal ID -> DOCNO, one line per document in internal ID order.
+    with open(os.path.join(outputPath, "mapping.txt"), "w") as f:
+        for internalId in sorted(docNoMapping):
+            f.write(f"{internalId}:{docNoMapping[internalId]}\n")
+
+    # Inverted index -> binary postings file (see postingsFile.py for the layout).
+    # DocIDs are gap encoded and counts are varbyte coded, with an offset table to find each term.
+    if batches is not None:
+        writeMergedBatches(outputPath, pool, numWorkers, batches)
+    else:
+        writePostings(outputPath)
 
     # Doc lengths to specify how many tokens each document has.
     with open(os.path.join(outputPath, "doc-lengths.txt"), "w") as f:
         for docID, length in docLengths.items():
             f.write(f"{docID}: {length}\n")
 
+    # Metadata table: internal ID -> DOCNO, date and headline, for showing results without reading the documents.
+    writeMetadataTable(os.path.join(outputPath, METADATA_FILE), docMetadata)
+
+def startSentenceStore(outputPath):
+    """
+    Opens the sentence store (see sentenceStore.py) that extractMetadataAndStoreDocument and mergeSegment add to.
+    """
+    global sentenceStore
+    sentenceStore = sentenceStoreWriter(open(os.path.join(outputPath, SENTENCES_DATA_FILE), "wb"))
+
+def finishSentenceStore(outputPath):
+    """
+    Compresses the last block of sentences and writes the sentence store's offset table.
+    """
+    global sentenceStore
+    writeDocStoreIndex(os.path.join(outputPath, SENTENCES_INDEX_FILE), sentenceStore.finish())
+    sentenceStore.dataFile.close()
+    sentenceStore = None
+
+def finishStores(outputPath, docStoreFile):
+    """
+    Writes the offset tables of the document store (with --doc-store) and of the sentence store (with --snippet-store).
+    """
+    global docStore
+    if docStore is not None:
+        # Compress the last block and write the offset table for the document store.
+        writeDocStoreIndex(os.path.join(outputPath, DOC_STORE_INDEX_FILE), docStore.finish())
+        docStoreFile.close()
+        docStore = None
+    if sentenceStore is not None:
+        finishSentenceStore(outputPath)
+
+def buildIndex(inputPath, outputPath, numWorkers, useDocStore, firstId=1, shard=None):
+    """
+    Indexes the collection into outputPath (which must already exist) and writes all the index files.
+    Internal IDs start at firstId, which is above 1 when appending a segment to an existing index.
+    With shard = (shard number, number of shards), only that shard's documents are indexed (see buildShards).
+    Returns the number of documents that were indexed.
+    """
+    global docStore
+    docStoreFile = None
+    if useDocStore:
+        docStoreFile = open(os.path.join(outputPath, DOC_STORE_DATA_FILE), "wb")
+        docStore = DocStoreWriter(docStoreFile)
+    if storeSentences:
+        startSentenceStore(outputPath)
+
+    if numWorkers > 1:
+        # The same workers index the batches, then work out the statistics of the merged postings.
+        ## Reference: https://docs.python.org/3/library/multiprocessing.html#module-multiprocessing.pool
+        with multiprocessing.Pool(numWorkers) as pool:
+            batches = indexWithWorkers(pool, inputPath, outputPath, numWorkers, useDocStore, firstId)
+            finishStores(outputPath, docStoreFile)
+            writeIndexFiles(outputPath, pool, numWorkers, batches)
+    else:
+        # Internal IDs count every document of the input, so a shard's documents keep the IDs they have in the whole collection.
+        for internalId, documentContent in enumerate(readDocuments(inputPath), firstId):
+            if shard is not None and (internalId - firstId) % shard[1] != shard[0]:
+                continue
+            # Extract metadata from the accumulated document content and store the document.
+            extractMetadataAndStoreDocument(documentContent, outputPath, internalId)
+            spillIfOverBudget(outputPath)
+        finishStores(outputPath, docStoreFile)
+        writeIndexFiles(outputPath)
+    return len(docLengths)
+
+def buildShard(args):
+    """
+    Builds one shard of a sharded index (in a worker process with --workers).
+    """
+    global storePositions, storeSentences, memoryBudget
+    inputPath, shardPath, shardNumber, numShards, useDocStore, storePositions, storeSentences, memoryBudget = args
+    resetIndex()
+    os.makedirs(shardPath)
+    return buildIndex(inputPath, shardPath, 1, useDocStore, shard=(shardNumber, numShards))
+
+def buildShards(inputPath, outputPath, numShards, numWorkers, useDocStore):
+    """
+    --shards: splits the collection into numShards indexes by document (shards.py). Documents are dealt out in turn,
+    which keeps the shards the same size, and up to numWorkers shards are built at the same time.
+    Each shard then gets the global statistics BM25 needs to score its documents like a single index would.
+    Returns the number of documents that were indexed.
+    """
+    names = [shardName(number) for number in range(numShards)]
+    work = [(inputPath, os.path.join(outputPath, name), number, numShards, useDocStore, storePositions, storeSentences, memoryBudget)
+            for number, name in enumerate(names)]
+    if numWorkers > 1 and numShards > 1:
+        with multiprocessing.Pool(min(numWorkers, numShards)) as pool:
+            counts = pool.map(buildShard, work)
+    else:
+        counts = [buildShard(item) for item in work]
+    writeGlobalStats([os.path.join(outputPath, name) for name in names])
+    writeShardManifest(outputPath, names)
+    return sum(counts)
+
+def loadSegmentFromDisk(path, newPath):
+    """
+    Reads a written segment back into the same form the workers return, so mergeSegment can merge it.
+    Documents stored one file per document are hard linked into newPath (the merged segment's directory).
+    """
+    with open(os.path.join(path, "lexicon.txt"), "r") as f:
+        terms = [line.rstrip("\n").split(":", 1)[1] for line in f]
+    postingsReader = PostingsReader(os.path.join(path, INVERTED_INDEX_FILE))
+    postings = postingsReader.positionalItems() if postingsReader.positional else postingsReader.items()
+    segment = {"terms": terms, "postings": dict(postings), "docLengths": {}, "mapping": {}, "sentences": {}}
+    postingsReader.close()
+    with open(os.path.join(path, "doc-lengths.txt"), "r") as f:
+        for line in f:
+            docID, length = line.strip().split(":")
+            segment["docLengths"][int(docID)] = int(length)
+    with open(os.path.join(path, "mapping.txt"), "r") as f:
+        for line in f:
+            docID, docno = line.strip().split(":")
+            segment["mapping"][int(docID)] = docno
+    metadataTable = MetadataTable(os.path.join(path, METADATA_FILE))
+    segment["metadata"] = metadataTable.records()
+    metadataTable.close()
+    if storeSentences and os.path.exists(os.path.join(path, SENTENCES_INDEX_FILE)):
+        # Term IDs in the sentences are the segment's own, like the postings, so mergeSegment remaps them.
+        store = DocStoreReader(path, SENTENCES_DATA_FILE, SENTENCES_INDEX_FILE)
+        for internalId in store.records():
+            segment["sentences"][internalId] = store.fetchRecord(internalId)
+        store.close()
+
+    if os.path.exists(os.path.join(path, DOC_STORE_INDEX_FILE)):
+        store = DocStoreReader(path)
+        with open(os.path.join(path, DOC_STORE_DATA_FILE), "rb") as f:
+            segment["docStore"] = (f.read(), store.records())
+        store.close()
+    else:
+        # The yyyy / mm / dd folders. Hard links make this cheap and leave the old segment readable until it's deleted.
+        ## Reference: https://docs.python.org/3/library/shutil.html#shutil.copytree
+        for name in os.listdir(path):
+            if name.isdigit() and os.path.isdir(os.path.join(path, name)):
+                shutil.copytree(os.path.join(path, name), os.path.join(newPath, name), copy_function=os.link, dirs_exist_ok=True)
+    return segment
+
+def hasPositions(path):
+    """
+    Whether the index (or segment) at path was built with --positions.
+    """
+    postingsReader = PostingsReader(os.path.join(path, INVERTED_INDEX_FILE))
+    positional = postingsReader.positional
+    postingsReader.close()
+    return positional
+
+def mergeSegments(indexPath, names):
+    """
+    Merges adjacent appended segments into one new segment, then swaps it into the manifest and deletes the old ones.
+    Readers keep seeing the old segments until the manifest is replaced. The new segment is built under a temporary
+    name and removed if the merge fails, so the index is left as it was.
+    Raises ValueError if a DOCNO is in more than one of the segments (their documents can't be linked into one).
+    """
+    global docStore, storePositions, storeImpacts, storeSentences
+    seen = set()
+    for name in names:
+        duplicates = findDuplicateDocNos(segmentDocNos(segmentPath(indexPath, name)), seen)
+        if duplicates:
+            raise ValueError(f"{len(duplicates)} documents of segment {name} are also in an earlier segment (e.g. {duplicates[0]}), so the segments can't be merged.")
+    resetIndex()
+    newName = newSegmentName(indexPath)
+    newPath = segmentPath(indexPath, newName)
+    buildPath = temporarySegmentPath(indexPath, newName)
+    shutil.rmtree(buildPath, ignore_errors=True)  # left behind by a merge that was killed
+    os.makedirs(buildPath)
+
+    try:
+        docStoreFile = None
+        if os.path.exists(os.path.join(segmentPath(indexPath, names[0]), DOC_STORE_INDEX_FILE)):
+            docStoreFile = open(os.path.join(buildPath, DOC_STORE_DATA_FILE), "wb")
+            docStore = DocStoreWriter(docStoreFile)
+        storePositions = hasPositions(segmentPath(indexPath, names[0]))
+        storeImpacts = os.path.exists(os.path.join(segmentPath(indexPath, names[0]), IMPACT_INDEX_FILE))
+        storeSentences = os.path.exists(os.path.join(segmentPath(indexPath, names[0]), SENTENCES_INDEX_FILE))
+        if storeSentences:
+            startSentenceStore(buildPath)
+
+        # Segments hold increasing ranges of internal IDs, so merging them in order keeps the postings sorted.
+        for name in names:
+            mergeSegment(loadSegmentFromDisk(segmentPath(indexPath, name), buildPath))
+            spillIfOverBudget(buildPath)
+
+        finishStores(buildPath, docStoreFile)
+        writeIndexFiles(buildPath)
+        ## Reference: https://docs.python.org/3/library/os.html#os.replace
+        os.replace(buildPath, newPath)
+    except BaseException:
+        shutil.rmtree(buildPath, ignore_errors=True)
+        raise
+
+    manifest = readManifest(indexPath)
+    start = manifest.index(names[0])
+    manifest[start:start + len(names)] = [newName]
+    try:
+        writeManifest(indexPath, manifest)
+    except BaseException:
+        shutil.rmtree(newPath, ignore_errors=True)
+        raise
+    for name in names:
+        shutil.rmtree(segmentPath(indexPath, name))
+    resetIndex()
+    return newName
+
+def appendSegment(indexPath, inputPath, numWorkers, useDocStore):
+    """
+    --append: indexes the input into a new segment of the index and adds it to the manifest.
+    The segment is built under a temporary name, renamed once it is complete and only then added to the manifest.
+    If anything fails it is removed, so the index is either unchanged or has the whole new segment.
+    Raises ValueError if documents of the input are already in the index (or are in the input twice).
+    Returns:
+        tuple: (name of the new segment, number of documents), with no segment made if the input has no documents
+    """
+    seen = set()
+    for path in segmentPaths(indexPath):
+        seen.update(segmentDocNos(path))
+    duplicates = findDuplicateDocNos(documentNumbers(inputPath), seen)
+    if duplicates:
+        raise ValueError(f"{len(duplicates)} documents of the input are already in the index or are in the input twice (e.g. {duplicates[0]}). The index was not changed.")
+
+    newName = newSegmentName(indexPath)
+    newPath = segmentPath(indexPath, newName)
+    buildPath = temporarySegmentPath(indexPath, newName)
+    shutil.rmtree(buildPath, ignore_errors=True)  # left behind by an append that was killed
+    os.makedirs(buildPath)
+    try:
+        numDocs = buildIndex(inputPath, buildPath, numWorkers, useDocStore, lastInternalId(indexPath) + 1)
+        if numDocs == 0:
+            shutil.rmtree(buildPath)
+            return newName, 0
+        os.replace(buildPath, newPath)
+    except BaseException:
+        shutil.rmtree(buildPath, ignore_errors=True)
+        raise
+    try:
+        writeManifest(indexPath, readManifest(indexPath) + [newName])
+    except BaseException:
+        shutil.rmtree(newPath, ignore_errors=True)
+        raise
+    return newName, numDocs
+
+def applyMergePolicy(indexPath, maxSegments):
+    """
+    Merges appended segments until there are at most maxSegments of them (see segments.chooseSegmentsToMerge).
+    """
+    while True:
+        names = readManifest(indexPath)
+        window = chooseSegmentsToMerge([segmentSize(segmentPath(indexPath, name)) for name in names], maxSegments)
+        if window is None:
+            return
+        start, end = window
+        newName = mergeSegments(indexPath, names[start:end])
+        print(f"Merged {end - start} segments into {newName}.")
+
+def main():
+    """
+    Main function to index and store documents and their metadata.
+    """
+    # Parsing the command line arguments.
+    ## Reference: https://docs.python.org/3/library/argparse.html
+    parser = argparse.ArgumentParser(description="Index a gzipped LATimes-style collection: python3 indexEngine.py <path_to_latimes.gz> <path_to_store>")
+    parser.add_argument("inputPath", nargs="?", help="Path to the gzip file of <DOC> blocks")
+    parser.add_argument("outputPath", nargs="?", help="Directory to create for the index and the stored documents (the existing index with --append)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes used to index the documents (default: 1)")
+    parser.add_argument("--doc-store", action="store_true", help="Store the documents in one packed, compressed file instead of one file per document")
+    parser.add_argument("--positions", action="store_true", help="Store the position of every term occurrence so phrase queries can be answered from the postings")
+    parser.add_argument("--impacts", action="store_true", help="Also write impact-ordered postings for budgeted score-at-a-time queries (BM25.py --impacts)")
+    parser.add_argument("--snippet-store", action="store_true", help="Also store the snippet sentences of every document with their term IDs, so snippets are made without reading the documents")
+    parser.add_argument("--append", action="store_true", help="Index the input into a new segment of the existing index at outputPath")
+    parser.add_argument("--merge", metavar="INDEX_PATH", help="Merge all the appended segments of an index into one and exit")
+    parser.add_argument("--memory-budget", type=int, metavar="MB", help="Approximate memory for in-memory postings. Past it, postings are spilled to disk as sorted runs and merged at the end")
+    parser.add_argument("--max-segments", type=int, default=MAX_SEGMENTS, help=f"Appended segments allowed before some are merged (default: {MAX_SEGMENTS})")
+    parser.add_argument("--shards", type=int, metavar="N", help="Split the documents into N shard indexes, searched together with shards.py (with --workers, shards are built in parallel)")
+    args = parser.parse_args()
+
+    if args.workers < 1 or args.max_segments < 1 or (args.memory_budget is not None and args.memory_budget < 1) or (args.shards is not None and args.shards < 1):
+        print("Error: --workers, --max-segments, --memory-budget and --shards must be at least 1.")
+        sys.exit(1)
+    if args.shards is not None and (args.append or args.merge or args.impacts):
+        # Appending to one shard would change the collection statistics of all of them, and the impacts are quantized
+        # with the statistics of the index they are written for.
+        print("Error: --shards can't be used with --append, --merge or --impacts.")
+        sys.exit(1)
+
+    global memoryBudget, storePositions, storeImpacts, storeSentences
+    storePositions = args.positions
+    storeImpacts = args.impacts
+    storeSentences = args.snippet_store
+    if args.memory_budget is not None:
+        memoryBudget = args.memory_budget * 1024 * 1024
+
+    # On-demand merge of every appended segment.
+    if args.merge:
+        names = readManifest(args.merge)
+        if len(names) > 1:
+            try:
+                print(f"Merged {len(names)} segments into {mergeSegments(args.merge, names)}.")
+            except ValueError as e:
+                print(f"Error: {e}")
+                sys.exit(1)
+        else:
+            print("Nothing to merge.")
+        return
+
+    if args.inputPath is None or args.outputPath is None:
+        print("Error: Please provide all the required arguments to run properly: python3 indexEngine.py <path_to_latimes.gz> <path_to_store>")
+        sys.exit(1)
+
+    # Extracting the input file path and the output directory path from the command line arguments.
+    inputPath = args.inputPath
+    outputPath = args.outputPath
+
+    # Checking if the input directory exists. If it does not, exit with an error message.
+    if not os.path.exists(inputPath):
+        print("Error: The specified input directory does not exist. Please choose an existing one and try again.")
+        sys.exit(1)
+
+    if args.append:
+        if isSharded(outputPath):
+            print("Error: The specified index is sharded. Rebuild it with --shards to add documents.")
+            sys.exit(1)
+        # Appending needs an existing index. The new documents go into a new segment and keep the index's storage format.
+        if not os.path.exists(os.path.join(outputPath, "mapping.txt")):
+            print("Error: The specified index does not exist. Please build it first, without --append.")
+            sys.exit(1)
+        indexPath = outputPath
+        useDocStore = os.path.exists(os.path.join(indexPath, DOC_STORE_INDEX_FILE))
+        storePositions = hasPositions(indexPath)
+        storeImpacts = os.path.exists(os.path.join(indexPath, IMPACT_INDEX_FILE))
+        storeSentences = os.path.exists(os.path.join(indexPath, SENTENCES_INDEX_FILE))
+        try:
+            newName, numDocs = appendSegment(indexPath, inputPath, args.workers, useDocStore)
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        if numDocs == 0:
+            print("No documents found in the input. The index was not changed.")
+            return
+        print(f"Appended {numDocs} documents as segment {newName}.")
+        try:
+            applyMergePolicy(indexPath, args.max_segments)
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        return
+
+    # Checking if the output directory already exists. If it does, exit with an error message.
+    if os.path.exists(outputPath):
+        print("Error: The specified directory already exists. Please choose something different and try again.")
+        sys.exit(1)
+
+    # Create the output directory.
+    ## Reference: https://www.geeksforgeeks.org/python-os-makedirs-method/
+    os.makedirs(outputPath)
+
+    if args.shards is not None:
+        numDocs = buildShards(inputPath, outputPath, args.shards, args.workers, args.doc_store)
+        print(f"Indexed {numDocs} documents into {args.shards} shards.")
+        return
+
+    buildIndex(inputPath, outputPath, args.workers, args.doc_store)
+
 # Entry point of the script.
 if __name__ == "__main__":
     main()
- 
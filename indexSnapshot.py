@@ -0,0 +1,358 @@
+'''
+A snapshot of everything BM25.loadIndex loads, in one file that opens in milliseconds.
+
+Loading an index parses lexicon.txt, mapping.txt and doc-lengths.txt line by line into dictionaries and works out
+the length normalisation of every document, which takes longer the bigger the collection is. The snapshot keeps
+the same data as flat little-endian arrays and string tables. Opening it memory maps the file, checks its checksum,
+and wraps the arrays in read-only views that behave like the dictionaries (see SnapshotLexicon and
+SnapshotDocuments), so nothing is parsed or copied. Terms are found with an open addressing hash table stored in
+the file. The postings stay in inverted_index.bin, which is memory mapped already.
+
+Usage:
+    python3 indexSnapshot.py <indexPath> [--check]
+
+BM25.loadIndex (so BM25.py, searchServer.py and parameterSweep.py) uses the snapshot when there is one and it was
+made from the current index files. If the index files changed since (their sizes and modification times are kept
+in the snapshot), the snapshot is ignored with a warning. Indexes with appended segments are always loaded from
+their text files.
+
+Layout of index-snapshot.bin (all numbers little-endian):
+- header: magic, format version, number of terms, number of documents, N, total tokens, CRC-32 of the rest
+- section table: the offset and length of every section in SECTIONS
+- sections, each starting on an 8-byte boundary:
+  source (JSON sizes and modification times of the index files), termOffsets and terms (the string table of
+  the terms in termID order), termSlots (hash table of termIDs, -1 for empty slots), docIds (sorted),
+  docLengths, docNoOffsets and docNos (string table of the DOCNOs in docID order), the collection statistics
+  arrays (df, cf, idf, maxTf, minDl, maxScore) and norms (scoring.documentNorms for the default k1 and b)
+
+Acknowledgements:
+- Open addressing with linear probing: https://en.wikipedia.org/wiki/Linear_probing
+- Reference for memoryview.cast: https://docs.python.org/3/library/stdtypes.html#memoryview.cast
+- Reference for zlib.crc32: https://docs.python.org/3/library/zlib.html#zlib.crc32
+- Reference for collections.abc.Mapping: https://docs.python.org/3/library/collections.abc.html
+'''
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+from itertools import accumulate
+from postingsFile import littleEndianBytes
+from collectionStats import CollectionStats, DEFAULT_K1, DEFAULT_B, STATS_FILE, GLOBAL_STATS_FILE
+from segments import readManifest
+
+SNAPSHOT_FILE = "index-snapshot.bin"
+SNAPSHOT_MAGIC = b"IRSN"
+SNAPSHOT_VERSION = 1
+HEADER_FORMAT = "<4sIQQQQI"  # magic, version, number of terms, number of documents, N, total tokens, checksum
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+SECTIONS = ("source", "termOffsets", "terms", "termSlots", "docIds", "docLengths", "docNoOffsets", "docNos",
+            "df", "cf", "idf", "maxTf", "minDl", "maxScore", "norms")
+TABLE_SIZE = 16 * len(SECTIONS)  # an 8-byte offset and an 8-byte length per section
+# Index files the snapshot is made from. If any of them changes, the snapshot is out of date.
+SOURCE_FILES = ("lexicon.txt", "mapping.txt", "doc-lengths.txt", STATS_FILE, GLOBAL_STATS_FILE, "inverted_index.bin", "inverted_index.txt")
+
+
+def sourceFingerprint(indexPath):
+    """
+    The size and modification time of each index file the snapshot is made from.
+    """
+    fingerprint = {}
+    for name in SOURCE_FILES:
+        path = os.path.join(indexPath, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            fingerprint[name] = [stat.st_size, stat.st_mtime_ns]
+    return fingerprint
+
+
+def termHash(data):
+    return zlib.crc32(data)
+
+
+def hashTable(encodedTerms):
+    """
+    The slots of an open addressing hash table of the termIDs (at most half full), -1 for the empty ones.
+    """
+    size = 1
+    while size < 2 * len(encodedTerms):
+        size *= 2
+    mask = size - 1
+    slots = array("i", [-1]) * size
+    for termID, data in enumerate(encodedTerms):
+        slot = termHash(data) & mask
+        while slots[slot] != -1:
+            slot = (slot + 1) & mask
+        slots[slot] = termID
+    return slots
+
+
+def stringTable(strings):
+    """
+    The (offsets, data, encoded strings) of a list of strings: string i is data[offsets[i]:offsets[i + 1]].
+    """
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = array("Q", [0])
+    offsets.extend(accumulate(map(len, encoded)))
+    return offsets, b"".join(encoded), encoded
+
+
+def writeSnapshot(indexPath, snapshotPath=None):
+    """
+    Loads an index from its files and writes its snapshot (to index-snapshot.bin in the index by default).
+    Returns:
+        str: the path of the snapshot.
+    """
+    # Imported here since BM25 imports this module.
+    from BM25 import loadIndex
+    from scoring import documentNorms
+
+    if readManifest(indexPath):
+        raise ValueError("Indexes with appended segments can't be snapshotted.")
+    snapshotPath = snapshotPath or os.path.join(indexPath, SNAPSHOT_FILE)
+    source = sourceFingerprint(indexPath)
+    lexicon, _, docLengths, mapping, stats = loadIndex(indexPath, useSnapshot=False)
+    if sorted(lexicon.values()) != list(range(len(lexicon))):
+        raise ValueError("The termIDs of this index are not 0 to the number of terms - 1.")
+
+    terms = [None] * len(lexicon)
+    for term, termID in lexicon.items():
+        terms[termID] = term
+    termOffsets, termData, encodedTerms = stringTable(terms)
+    docIds = array("I", sorted(docLengths))
+    docNoOffsets, docNoData, _ = stringTable([mapping.get(docId, "") for docId in docIds])
+    sections = {
+        "source": json.dumps(source, sort_keys=True).encode("utf-8"),
+        "termOffsets": littleEndianBytes(termOffsets),
+        "terms": termData,
+        "termSlots": littleEndianBytes(hashTable(encodedTerms)),
+        "docIds": littleEndianBytes(docIds),
+        "docLengths": littleEndianBytes(array("I", (docLengths[docId] for docId in docIds))),
+        "docNoOffsets": littleEndianBytes(docNoOffsets),
+        "docNos": docNoData,
+        "df": littleEndianBytes(array("I", stats.df)),
+        "cf": littleEndianBytes(array("Q", stats.cf)),
+        "idf": littleEndianBytes(array("d", stats.idf)),
+        "maxTf": littleEndianBytes(array("I", stats.maxTf)),
+        "minDl": littleEndianBytes(array("I", stats.minDl)),
+        "maxScore": littleEndianBytes(array("d", stats.maxScore)),
+        "norms": littleEndianBytes(documentNorms(docLengths, stats.avgDl, DEFAULT_K1, DEFAULT_B)),
+    }
+
+    # The section table, then the sections on 8-byte boundaries so the arrays can be viewed in place.
+    body = bytearray(TABLE_SIZE)
+    for index, name in enumerate(SECTIONS):
+        body.extend(b"\0" * (-(HEADER_SIZE + len(body)) % 8))
+        struct.pack_into("<QQ", body, 16 * index, HEADER_SIZE + len(body), len(sections[name]))
+        body.extend(sections[name])
+
+    # Written next to the snapshot and renamed over it, so a process opening it never sees half a file.
+    temporaryPath = snapshotPath + ".tmp"
+    with open(temporaryPath, "wb") as f:
+        f.write(struct.pack(HEADER_FORMAT, SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(terms), len(docIds),
+                            stats.N, stats.totalTokens, zlib.crc32(body)))
+        f.write(body)
+    os.replace(temporaryPath, snapshotPath)
+    return snapshotPath
+
+
+class Snapshot:
+    """
+    An open snapshot file. lexicon, docLengths, mapping and stats can be used like the ones BM25.loadIndex returns.
+    """
+
+    def __init__(self, path, verify=True):
+        """
+        Raises ValueError if the file isn't a snapshot this version can read, or if its checksum doesn't match.
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < HEADER_SIZE + TABLE_SIZE:
+            raise ValueError(f"{path} is not a supported index snapshot.")
+        magic, version, numTerms, numDocs, N, totalTokens, checksum = struct.unpack_from(HEADER_FORMAT, self.mm, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"{path} is not a supported index snapshot.")
+        if verify and zlib.crc32(memoryview(self.mm)[HEADER_SIZE:]) != checksum:
+            raise ValueError(f"{path} is damaged (its checksum doesn't match).")
+        self.sections = {name: struct.unpack_from("<QQ", self.mm, HEADER_SIZE + 16 * index) for index, name in enumerate(SECTIONS)}
+        self.source = json.loads(bytes(self.bytes("source")))
+
+        self.lexicon = SnapshotLexicon(self.view("termOffsets", "Q"), self.bytes("terms"), self.view("termSlots", "i"))
+        self.docLengths = SnapshotDocuments(self.view("docIds", "I"), self.view("docLengths", "I"))
+        self.mapping = SnapshotDocuments(self.docLengths.docIds, StringTable(self.view("docNoOffsets", "Q"), self.bytes("docNos")))
+        self.stats = CollectionStats(N, totalTokens, self.view("df", "I"), self.view("cf", "Q"), self.view("maxTf", "I"),
+                                     self.view("minDl", "I"), self.view("idf", "d"), self.view("maxScore", "d"))
+        self.stats.norms = self.view("norms", "d")
+
+    def bytes(self, name):
+        offset, length = self.sections[name]
+        return memoryview(self.mm)[offset:offset + length]
+
+    def view(self, name, typecode):
+        """
+        A section as a sequence of numbers: a view of the mapped file, or a copy on big-endian machines.
+        """
+        data = self.bytes(name)
+        if sys.byteorder == "big":
+            values = array(typecode)
+            values.frombytes(data)
+            values.byteswap()
+            return values
+        return data.cast(typecode)
+
+
+class StringTable:
+    """
+    The strings of a string table as a read-only sequence.
+    """
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __getitem__(self, index):
+        return str(self.data[self.offsets[index]:self.offsets[index + 1]], "utf-8")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+
+class SnapshotLexicon(Mapping):
+    """
+    {term: termID} looked up in the snapshot's hash table.
+    """
+
+    def __init__(self, termOffsets, terms, termSlots):
+        self.terms = StringTable(termOffsets, terms)
+        self.slots = termSlots
+        self.mask = len(termSlots) - 1
+
+    def get(self, term, default=None):
+        data = term.encode("utf-8")
+        offsets, terms, slots = self.terms.offsets, self.terms.data, self.slots
+        slot = termHash(data) & self.mask
+        while True:
+            termID = slots[slot]
+            if termID == -1:
+                return default
+            if terms[offsets[termID]:offsets[termID + 1]] == data:
+                return termID
+            slot = (slot + 1) & self.mask
+
+    def __getitem__(self, term):
+        termID = self.get(term)
+        if termID is None:
+            raise KeyError(term)
+        return termID
+
+    def __contains__(self, term):
+        return self.get(term) is not None
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def items(self):
+        return zip(self.terms, range(len(self.terms)))
+
+
+class SnapshotDocuments(Mapping):
+    """
+    {docID: value} for the document lengths or the DOCNOs, from the sorted docIDs and the values in the same order.
+    """
+
+    def __init__(self, docIds, column):
+        self.docIds = docIds
+        self.column = column
+        # Internal IDs are normally consecutive, so a docID's position can be worked out instead of searched for.
+        self.first = docIds[0] if len(docIds) else 0
+        self.consecutive = not len(docIds) or docIds[-1] - self.first == len(docIds) - 1
+
+    def position(self, docId):
+        if self.consecutive:
+            position = docId - self.first
+            return position if 0 <= position < len(self.docIds) else None
+        position = bisect_left(self.docIds, docId)
+        return position if position < len(self.docIds) and self.docIds[position] == docId else None
+
+    def get(self, docId, default=None):
+        position = self.position(docId) if isinstance(docId, int) else None
+        return default if position is None else self.column[position]
+
+    def __getitem__(self, docId):
+        position = self.position(docId) if isinstance(docId, int) else None
+        if position is None:
+            raise KeyError(docId)
+        return self.column[position]
+
+    def __contains__(self, docId):
+        return isinstance(docId, int) and self.position(docId) is not None
+
+    def __iter__(self):
+        return iter(self.docIds)
+
+    def __len__(self):
+        return len(self.docIds)
+
+    def items(self):
+        return zip(self.docIds, self.column)
+
+    def values(self):
+        return iter(self.column)
+
+
+def openSnapshot(indexPath, verify=True):
+    """
+    The snapshot of an index, or None if it has none, or if it is out of date or can't be read (with a warning).
+    """
+    path = os.path.join(indexPath, SNAPSHOT_FILE)
+    if not os.path.exists(path) or readManifest(indexPath):
+        return None
+    try:
+        snapshot = Snapshot(path, verify)
+    except ValueError as e:
+        print(f"Warning: {e} Loading the index files instead.", file=sys.stderr)
+        return None
+    if snapshot.source != sourceFingerprint(indexPath):
+        print(f"Warning: {path} was made before the index last changed. Loading the index files instead "
+              f"(run python3 indexSnapshot.py {indexPath} to update it).", file=sys.stderr)
+        return None
+    return snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a snapshot of an index for fast startup: python3 indexSnapshot.py <indexPath>")
+    parser.add_argument("indexPath", help="Directory containing the index files")
+    parser.add_argument("--check", action="store_true", help="Only check that the index's snapshot can be read and is up to date")
+    args = parser.parse_args()
+    if not os.path.exists(os.path.join(args.indexPath, "mapping.txt")):
+        parser.error("the index doesn't exist.")
+
+    if args.check:
+        if openSnapshot(args.indexPath) is None:
+            print("The snapshot is missing, damaged or out of date.")
+            sys.exit(1)
+        print("The snapshot is up to date.")
+        return
+    try:
+        path = writeSnapshot(args.indexPath)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    print(f"Wrote {path} ({os.path.getsize(path) / 1e6:.1f} MB).")
+
+
+if __name__ == "__main__":
+    main()
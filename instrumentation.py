@@ -0,0 +1,457 @@
+'''
+Per-phase timers, counters and histograms for queries, with JSON and Prometheus exports and optional profiling.
+
+The process has one Instrumentation object, instruments, which is off by default. Code that answers queries marks
+its phases and counts its work:
+
+    with instruments.query():
+        with instruments.phase("tokenize"):
+            ...
+        instruments.count("postingsScanned", n)
+
+When it is off, phase() and query() return a shared object that does nothing and count() returns straight away,
+so the hooks cost a few function calls per query. When it is on, the time of every phase and every counter is
+added up for the query being measured, and when the query ends they go into histograms: one of the time of each
+phase per query, and one of the value of each counter per query. Phases timed in other threads (e.g. the snippets
+rendered by a thread pool) are added to the query too, so phase times can add up to more than the query's time.
+
+The phases used are tokenize, lexicon (term ID lookup), decode (postings decoding), phrases (positional matching),
+score, sort, fetch (reading documents), snippet and render. The counters are postingsScanned, postingsProbed
+(binary searches of the MaxScore candidates), docsScored, postingsCacheHits, postingsCacheMisses and
+postingsDecoded.
+
+With a profiler, every measured query is also profiled, with cProfile or by sampling the query's thread's stack
+every few milliseconds (much less overhead, only approximate). The busiest functions or stacks are kept with the
+query, and the full profiles can be written to a directory (.prof files for pstats / snakeviz, and .folded
+collapsed stacks for flame graphs, named after the process ID and the query's number in that process).
+
+Acknowledgements:
+- Histogram buckets and the text exposition format follow the Prometheus documentation:
+  https://prometheus.io/docs/concepts/metric_types/#histogram and
+  https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+- Quantiles are estimated from the buckets with linear interpolation, like Prometheus' histogram_quantile.
+- Reference for cProfile and pstats: https://docs.python.org/3/library/profile.html
+- Reference for sys._current_frames (used by the sampling profiler): https://docs.python.org/3/library/sys.html#sys._current_frames
+- Collapsed stacks are the input format of Brendan Gregg's flamegraph.pl: https://github.com/brendangregg/FlameGraph
+'''
+
+import cProfile
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+# Upper bounds of the histogram buckets: seconds for times, and counts for the counters.
+TIME_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 3, 10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000, 300000, 1000000, 3000000, 10000000)
+PROFILERS = ("cprofile", "sample")
+DEFAULT_SAMPLE_INTERVAL = 0.002  # seconds between stack samples
+PROFILE_ENTRIES = 15  # functions or stacks kept with each query's measurement
+PROMETHEUS_PREFIX = "search_"
+
+
+class Histogram:
+    """
+    Counts of observed values in fixed buckets, plus their count, sum, min and max.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last bucket is everything above the largest bound
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def observe(self, value):
+        # A value equal to a bound goes in that bound's bucket, like Prometheus' "le".
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Estimated q-quantile (0 <= q <= 1), by linear interpolation within the bucket it falls in.
+        """
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for index, bucketCount in enumerate(self.counts):
+            if bucketCount and seen + bucketCount >= target:
+                low = self.bounds[index - 1] if index > 0 else min(self.min, 0.0)
+                high = self.bounds[index] if index < len(self.bounds) else self.max
+                estimate = low + (high - low) * (target - seen) / bucketCount
+                return min(max(estimate, self.min), self.max)
+            seen += bucketCount
+        return self.max
+
+    def summary(self):
+        cumulative = 0
+        buckets = {}
+        for bound, bucketCount in zip(self.bounds, self.counts):
+            cumulative += bucketCount
+            buckets[repr(bound)] = cumulative
+        buckets["+Inf"] = self.count
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "min": self.min if self.count else 0.0,
+            "max": self.max if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": buckets,
+        }
+
+
+class _Off:
+    """
+    What phase() and query() return when instrumentation is off.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+OFF = _Off()
+
+
+class _Phase:
+    __slots__ = ("instruments", "name", "start")
+
+    def __init__(self, instruments, name):
+        self.instruments = instruments
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.instruments.addTime(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _Query:
+    """
+    Measures one query: its total time, the phases and counters recorded while it runs, and its profile.
+    """
+
+    def __init__(self, instruments, aggregate):
+        self.instruments = instruments
+        self.aggregate = aggregate
+        self.record = None
+
+    def __enter__(self):
+        instruments = self.instruments
+        with instruments.lock:
+            instruments.current = {"phases": defaultdict(float), "counters": defaultdict(int)}
+        self.profiler = None
+        if instruments.profiler == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif instruments.profiler == "sample":
+            self.profiler = StackSampler(threading.get_ident(), instruments.sampleInterval)
+            self.profiler.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        instruments = self.instruments
+        if isinstance(self.profiler, cProfile.Profile):
+            self.profiler.disable()
+        elif self.profiler is not None:
+            self.profiler.stop()
+        with instruments.lock:
+            current, instruments.current = instruments.current, None
+            instruments.profiled += 1
+            number = instruments.profiled
+        self.record = {"seconds": seconds, "phases": dict(current["phases"]), "counters": dict(current["counters"])}
+        if self.profiler is not None:
+            self.record["profile"] = instruments.saveProfile(self.profiler, number)
+        instruments.lastQuery = self.record
+        if self.aggregate:
+            instruments.addQuery(self.record)
+        return False
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the stack of one thread every interval seconds and counts the stacks seen (collapsed into
+    "outermost;...;innermost" strings of function names).
+    """
+
+    def __init__(self, threadId, interval):
+        super().__init__(daemon=True)
+        self.threadId = threadId
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.threadId)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class Instrumentation:
+    """
+    Timers, counters and histograms of the queries answered by this process.
+    """
+
+    def __init__(self, enabled=False, profiler=None, profileDir=None, sampleInterval=DEFAULT_SAMPLE_INTERVAL):
+        self.lock = threading.Lock()
+        self.current = None  # phases and counters of the query being measured
+        self.lastQuery = None  # the measurement of the last query
+        self.profiled = 0
+        self.reset()
+        self.configure(enabled, profiler, profileDir, sampleInterval)
+
+    def configure(self, enabled=True, profiler=None, profileDir=None, sampleInterval=DEFAULT_SAMPLE_INTERVAL):
+        """
+        Turns instrumentation on or off. profiler is None, "cprofile" or "sample", and profileDir is where the
+        full profile of every query is written (None keeps only a summary with each query's measurement).
+        """
+        if profiler not in (None,) + PROFILERS:
+            raise ValueError(f"Unknown profiler {profiler!r}. Use one of: {', '.join(PROFILERS)}.")
+        if profileDir is not None:
+            os.makedirs(profileDir, exist_ok=True)
+        self.enabled = enabled
+        self.profiler = profiler if enabled else None
+        self.profileDir = profileDir
+        self.sampleInterval = sampleInterval
+
+    def reset(self):
+        """
+        Forgets everything measured so far.
+        """
+        with self.lock:
+            self.queries = 0
+            self.totals = defaultdict(int)  # counter -> total over all queries
+            self.querySeconds = Histogram(TIME_BUCKETS)
+            self.phaseSeconds = {}  # phase -> Histogram of its time per query
+            self.counterValues = {}  # counter -> Histogram of its value per query
+
+    def query(self, aggregate=True):
+        """
+        Context manager that measures one query. Afterwards lastQuery holds its measurement, which is also added to
+        the histograms unless aggregate is False (e.g. in a worker process that sends it back to its parent, which
+        adds it with addQuery).
+        """
+        if not self.enabled:
+            return OFF
+        return _Query(self, aggregate)
+
+    def phase(self, name):
+        """
+        Context manager that adds the time it takes to the phase of the current query.
+        """
+        if not self.enabled:
+            return OFF
+        return _Phase(self, name)
+
+    def addTime(self, name, seconds):
+        with self.lock:
+            if self.current is not None:
+                self.current["phases"][name] += seconds
+            else:
+                # Outside a query (e.g. a document viewed after the results): its own observation.
+                self.phaseSeconds.setdefault(name, Histogram(TIME_BUCKETS)).observe(seconds)
+
+    def count(self, name, amount=1):
+        """
+        Adds amount to a counter of the current query (or to the totals outside a query).
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            if self.current is not None:
+                self.current["counters"][name] += amount
+            else:
+                self.totals[name] += amount
+
+    def addQuery(self, record):
+        """
+        Adds the measurement of one query (from query(), here or in another process) to the histograms.
+        """
+        with self.lock:
+            self.queries += 1
+            self.querySeconds.observe(record["seconds"])
+            for name, seconds in record["phases"].items():
+                self.phaseSeconds.setdefault(name, Histogram(TIME_BUCKETS)).observe(seconds)
+            for name, value in record["counters"].items():
+                self.counterValues.setdefault(name, Histogram(COUNT_BUCKETS)).observe(value)
+                self.totals[name] += value
+
+    def saveProfile(self, profiler, number):
+        """
+        The busiest functions (cProfile) or stacks (sampling) of a query's profile, and the file it was written to.
+        """
+        summary = {"profiler": self.profiler}
+        if isinstance(profiler, cProfile.Profile):
+            stats = pstats.Stats(profiler).stats
+            # (file, line, function) -> (primitive calls, calls, own time, cumulative time, callers)
+            busiest = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_ENTRIES]
+            summary["functions"] = [
+                {"function": f"{function} ({os.path.basename(fileName)}:{line})", "calls": calls,
+                 "ownSeconds": ownTime, "cumulativeSeconds": cumulativeTime}
+                for (fileName, line, function), (_, calls, ownTime, cumulativeTime, _) in busiest
+            ]
+            if self.profileDir is not None:
+                summary["file"] = os.path.join(self.profileDir, f"query-{os.getpid()}-{number:05d}.prof")
+                profiler.dump_stats(summary["file"])
+        else:
+            summary["samples"] = sum(profiler.stacks.values())
+            summary["intervalSeconds"] = profiler.interval
+            summary["stacks"] = [{"stack": stack, "samples": samples} for stack, samples in profiler.stacks.most_common(PROFILE_ENTRIES)]
+            if self.profileDir is not None:
+                summary["file"] = os.path.join(self.profileDir, f"query-{os.getpid()}-{number:05d}.folded")
+                with open(summary["file"], "w") as f:
+                    for stack, samples in profiler.stacks.most_common():
+                        f.write(f"{stack} {samples}\n")
+        return summary
+
+    def snapshot(self):
+        """
+        Everything measured so far as a dictionary that can be written as JSON.
+        """
+        with self.lock:
+            return {
+                "queries": self.queries,
+                "querySeconds": self.querySeconds.summary(),
+                "phaseSeconds": {name: histogram.summary() for name, histogram in sorted(self.phaseSeconds.items())},
+                "counters": {name: {"total": self.totals[name], **(self.counterValues[name].summary() if name in self.counterValues else {})}
+                             for name in sorted(self.totals)},
+            }
+
+    def toJSON(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def toPrometheus(self):
+        """
+        Everything measured so far in the Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}queries_total Queries measured.")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}queries_total counter")
+            lines.append(f"{PROMETHEUS_PREFIX}queries_total {self.queries}")
+            _prometheusHistogram(lines, "query_seconds", "Time to answer a query.", {"": self.querySeconds})
+            _prometheusHistogram(lines, "phase_seconds", "Time spent in each phase of a query.",
+                                 {f'phase="{name}"': histogram for name, histogram in sorted(self.phaseSeconds.items())})
+            for name in sorted(self.totals):
+                metric = _snakeCase(name)
+                lines.append(f"# HELP {PROMETHEUS_PREFIX}{metric}_total Total {name} over all queries.")
+                lines.append(f"# TYPE {PROMETHEUS_PREFIX}{metric}_total counter")
+                lines.append(f"{PROMETHEUS_PREFIX}{metric}_total {self.totals[name]}")
+                if name in self.counterValues:
+                    _prometheusHistogram(lines, f"{metric}_per_query", f"{name} per query.", {"": self.counterValues[name]})
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        """
+        A table of the mean and estimated percentiles of the query time, of each phase and of each counter.
+        """
+        snapshot = self.snapshot()
+        lines = [f"{snapshot['queries']} queries measured",
+                 f"{'':<22} {'mean':>10} {'p50':>10} {'p95':>10} {'p99':>10} {'max':>10}"]
+        rows = [("query (ms)", snapshot["querySeconds"], 1000)]
+        rows += [(f"{name} (ms)", summary, 1000) for name, summary in snapshot["phaseSeconds"].items()]
+        rows += [(name, summary, 1) for name, summary in snapshot["counters"].items() if "count" in summary]
+        for name, summary, scale in rows:
+            lines.append(f"{name:<22} " + " ".join(f"{summary[key] * scale:>10.2f}" for key in ("mean", "p50", "p95", "p99", "max")))
+        return "\n".join(lines)
+
+    def writeMetrics(self, path, metricsFormat="json"):
+        """
+        Writes everything measured so far to a file, as JSON or as Prometheus text ("prometheus").
+        """
+        with open(path, "w") as f:
+            f.write(self.toPrometheus() if metricsFormat == "prometheus" else self.toJSON() + "\n")
+
+
+def _snakeCase(name):
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", name).lower()
+
+
+def _prometheusHistogram(lines, metric, description, histograms):
+    """
+    Appends the lines of a histogram metric, with one series per label set in histograms ({labels: Histogram}).
+    """
+    name = PROMETHEUS_PREFIX + metric
+    lines.append(f"# HELP {name} {description}")
+    lines.append(f"# TYPE {name} histogram")
+    for labels, histogram in histograms.items():
+        separator = "," if labels else ""
+        cumulative = 0
+        for bound, bucketCount in zip(histogram.bounds, histogram.counts):
+            cumulative += bucketCount
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {histogram.count}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {histogram.sum}")
+        lines.append(f"{name}_count{suffix} {histogram.count}")
+
+
+def formatQuery(record):
+    """
+    One line summing up a query's measurement: its time, the time of each phase and its counters.
+    """
+    phases = ", ".join(f"{name} {seconds * 1000:.2f}" for name, seconds in record["phases"].items())
+    counters = ", ".join(f"{name} {value}" for name, value in record["counters"].items())
+    line = f"{record['seconds'] * 1000:.2f} ms"
+    if phases:
+        line += f" ({phases} ms)"
+    if counters:
+        line += f"; {counters}"
+    if "profile" in record and "file" in record["profile"]:
+        line += f"; profile in {record['profile']['file']}"
+    return line
+
+
+def addArguments(parser):
+    """
+    Adds the command line options that turn instrumentation on (used by BM25.py and searchServer.py).
+    """
+    parser.add_argument("--instrument", action="store_true", help="Time the phases of every query and count the postings and documents it goes through")
+    parser.add_argument("--metrics", metavar="FILE", help="Write the measurements to FILE when done (implies --instrument)")
+    parser.add_argument("--metrics-format", choices=("json", "prometheus"), default="json", help="Format of --metrics (default: json)")
+    parser.add_argument("--profile", choices=PROFILERS, help="Also profile every query with cProfile or by sampling its stack (implies --instrument)")
+    parser.add_argument("--profile-dir", metavar="DIR", help="With --profile, write the full profile of every query to DIR")
+
+
+def configureFromArguments(args):
+    """
+    Turns instrumentation on if the options added by addArguments ask for it. Returns whether it is on.
+    """
+    enabled = bool(args.instrument or args.metrics or args.profile)
+    if enabled:
+        instruments.configure(True, args.profile, args.profile_dir)
+    return enabled
+
+
+# The instrumentation of this process. Off until configure() turns it on.
+instruments = Instrumentation()
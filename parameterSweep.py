@@ -0,0 +1,345 @@
+'''
+Tunes BM25's k1 and b by evaluating a whole grid of (k1, b) values against the qrels in one go.
+
+Running BM25.py --topics and evaluation.py once per grid point tokenizes every topic, decodes every postings
+list and looks up every document length again for each point, and writes and parses a run file each time.
+None of that depends on k1 or b. Here each topic's postings are decoded once, into the count of every query
+term and the length of every document that contains one (TopicPostings), and every grid point only redoes
+the arithmetic
+    idf * f / (f + k1 * ((1 - b) + b * dl / avgdl))
+for the documents that can still make the top --depth. Rankings are evaluated in memory
+(evaluation.evaluateQuery), without writing and parsing run files.
+
+Most documents of a topic can't make its top 1000 at any k1 and b. The documents are grouped by which query
+terms they contain and cut into small chunks of documents that score alike, and the largest count and the
+shortest length in a chunk bound the score of all its documents for any k1 and b. A grid point scores the
+chunks with the highest bounds first and stops when no chunk left can reach the depth-th best score, the same
+kind of pruning as BM25Scorer.topK (MaxScore) but over chunks of documents instead of terms.
+
+The scores (and the order of ties) are exactly those of BM25Scorer with the same k1 and b, so the metrics are
+the same as evaluating a BM25.py --topics run made with --k1 and --b.
+
+The b values are spread over worker processes (--workers). They fork after the topics are decoded, so they
+share the decoded postings instead of loading the index again.
+
+Usage:
+    python3 parameterSweep.py <indexPath> <topics_file> <qrels_file> [--k1 0.2:2.0:0.2] [--b 0:1:0.1]
+                              [--depth 1000] [--workers N] [--metric averagePrecision] [--output sweep.tsv]
+                              [--best-run run.txt]
+
+Acknowledgements:
+- BM25 and its parameters are from the BM25 lecture (see BM25.py and scoring.py).
+- Grid search over k1 and b is the usual way of tuning them, e.g. Trotman, Puurula and Burgess,
+  "Improvements to BM25 and Language Models Examined" (2014).
+- Bounding blocks of documents instead of whole postings lists is the idea behind block-max indexes
+  (Ding and Suel, "Faster Top-k Document Retrieval Using Block-Max Indexes", 2011).
+'''
+
+import argparse
+import heapq
+import multiprocessing
+import time
+from bisect import bisect_left, bisect_right
+from itertools import chain, repeat
+from operator import add, floordiv, itemgetter, mod, mul, sub
+from BM25 import loadIndex
+from evaluation import evaluateQuery, meanMetrics
+from parsers import QrelsParser
+from phraseQuery import parsePhrases, matchingDocuments
+from postingsFile import DEFAULT_CACHE_POSTINGS
+from Results import Result
+from textAnalysis import tokenize
+from topics import readTopics
+
+METRICS = ['precisionAt10', 'averagePrecision', 'ndcgAt10', 'ndcgAt1000']
+METRIC_NAMES = {'precisionAt10': 'P@10', 'averagePrecision': 'MAP', 'ndcgAt10': 'NDCG@10', 'ndcgAt1000': 'NDCG@1000'}
+# Documents per chunk. Smaller chunks have tighter bounds but cost more to bound at every grid point.
+CHUNK_SIZE = 32
+
+# The decoded topics, qrels and DOCNOs used by the sweep workers. They are set before the worker processes
+# start, so with the fork start method every worker shares them.
+sweepTopics = None
+sweepQrels = None
+sweepMapping = None
+
+
+class TopicPostings:
+    """
+    Everything about one topic's postings that doesn't depend on k1 or b.
+    """
+
+    def __init__(self, topicID, query, lexicon, invertedIndex, docLengths, stats):
+        self.topicID = topicID
+        self.avgDl = stats.avgDl
+        queryTerms = tokenize(query)
+        phraseMatches = matchingDocuments(parsePhrases(query), lexicon.get, invertedIndex)
+
+        # Distinct terms in order of first appearance, and which of them each query term occurrence is.
+        termIndexes = {}
+        self.occurrenceTerms = []
+        for term in queryTerms:
+            termId = lexicon.get(term)
+            if termId is None:
+                continue
+            if termId not in termIndexes:
+                termIndexes[termId] = len(termIndexes)
+            self.occurrenceTerms.append(termIndexes[termId])
+        self.idfs = [stats.idf[termId] for termId in termIndexes]
+
+        # {docID: count} of each distinct term.
+        termCounts = []
+        for termId in termIndexes:
+            ## Reference: https://docs.python.org/3/library/operator.html#operator.itemgetter
+            counts = dict(map(itemgetter(0, 1), invertedIndex.get(termId, [])))
+            if phraseMatches is not None:
+                counts = {docId: f_i for docId, f_i in counts.items() if docId in phraseMatches}
+            termCounts.append(counts)
+        # The topic's documents in the order BM25Scorer.accumulate first finds them, which is how BM25Scorer.score
+        # orders documents with the same score. A document's local index is its position in this list.
+        self.docIds = list(dict.fromkeys(chain.from_iterable(termCounts)))
+
+        # The counts of each term in every document (0 if it isn't there) and the documents' lengths, by local index.
+        # These and the sort keys below are built with map over whole columns rather than a loop over the documents,
+        # since there can be hundreds of thousands of them.
+        numDocs = len(self.docIds)
+        columns = [list(map(counts.get, self.docIds, repeat(0))) for counts in termCounts]
+        lengths = list(map(docLengths.get, self.docIds, repeat(0)))
+
+        # Sort the documents by which terms they contain, then best counts first, then shortest first, so the
+        # documents in a chunk have the same terms and the same or close counts and lengths, and its bound is close
+        # to their scores whatever k1 and b are. The sort key of a document is one integer with each of these in its
+        # own digits (and the local index last), which sorts much faster than tuples.
+        keys = [0] * numDocs
+        for index, column in enumerate(columns):
+            keys = list(map(add, keys, map(mul, map(bool, column), repeat(1 << index))))
+        bitsBase = 1
+        for column in columns:
+            maxF = max(column, default=0)
+            keys = list(map(add, map(mul, keys, repeat(maxF + 1)), map(sub, repeat(maxF), column)))
+            bitsBase *= maxF + 1
+        keys = list(map(add, map(mul, keys, repeat(max(lengths, default=0) + 1)), lengths))
+        bitsBase *= max(lengths, default=0) + 1
+        keys = list(map(add, map(mul, keys, repeat(numDocs)), range(numDocs)))
+        bitsBase *= numDocs
+        keys.sort()
+        order = list(map(mod, keys, repeat(numDocs)))
+        sortedTerms = list(map(floordiv, keys, repeat(bitsBase)))
+
+        # The documents with the same terms make a group: (the group's query term occurrences in query term order,
+        # its chunks, {term: (smallest count of each chunk, largest count of each chunk)}, shortest length of each
+        # chunk, longest length of each chunk). A chunk is (the documents' local indexes, {term: count in each
+        # document}, the documents' lengths). The bounds are kept by group so rank() can work them out a list at a time.
+        self.groups = []
+        for bits in sorted(set(sortedTerms)):
+            terms = [index for index in range(len(columns)) if bits >> index & 1]
+            occurrenceTerms = [index for index in self.occurrenceTerms if bits >> index & 1]
+            chunks = []
+            ## Reference: https://docs.python.org/3/library/bisect.html
+            end = bisect_right(sortedTerms, bits)
+            for start in range(bisect_left(sortedTerms, bits), end, CHUNK_SIZE):
+                chunk = order[start:min(start + CHUNK_SIZE, end)]
+                chunks.append((chunk, {index: list(map(columns[index].__getitem__, chunk)) for index in terms},
+                               list(map(lengths.__getitem__, chunk))))
+            countRanges = {index: ([min(counts[index]) for _, counts, _ in chunks], [max(counts[index]) for _, counts, _ in chunks])
+                           for index in terms}
+            self.groups.append((occurrenceTerms, chunks, countRanges,
+                                [min(chunkLengths) for _, _, chunkLengths in chunks], [max(chunkLengths) for _, _, chunkLengths in chunks]))
+
+    def scoreDocuments(self, occurrenceTerms, counts, lengths, k1, b):
+        """
+        BM25 scores of documents that all contain the same query terms, added up exactly like BM25Scorer.score.
+        """
+        idfs = self.idfs
+        avgDl = self.avgDl
+        scores = []
+        for j, dl in enumerate(lengths):
+            norm = k1 * ((1 - b) + b * (dl / avgDl))
+            # The sum in query term order, then once per query term occurrence that found the document.
+            partial = 0.0
+            for index in occurrenceTerms:
+                f_i = counts[index][j]
+                partial += idfs[index] * f_i / (f_i + norm)
+            score = 0.0
+            for _ in occurrenceTerms:
+                score += partial
+            scores.append(score)
+        return scores
+
+    def rank(self, k1, b, depth):
+        """
+        The top depth (docID, score) of the topic, the same as BM25Scorer(..., k1, b).score(query)[:depth].
+        """
+        if depth <= 0:
+            return []
+        idfs = self.idfs
+        avgDl = self.avgDl
+        # (bound, group, chunk) of every chunk.
+        bounds = []
+        for groupNumber, (occurrenceTerms, chunks, countRanges, minLengths, maxLengths) in enumerate(self.groups):
+            # f / (f + k1 * norm) grows with f and shrinks with dl, so a term's largest contribution is at the largest
+            # count and the shortest length. For a term in more than half the documents (idf < 0) it's the other way.
+            shortNorms = [k1 * ((1 - b) + b * (dl / avgDl)) for dl in minLengths]
+            longNorms = [k1 * ((1 - b) + b * (dl / avgDl)) for dl in maxLengths]
+            contributions = {}
+            for index, (minCounts, maxCounts) in countRanges.items():
+                idf = idfs[index]
+                if idf >= 0:
+                    contributions[index] = [idf * f_i / (f_i + norm) for f_i, norm in zip(maxCounts, shortNorms)]
+                else:
+                    contributions[index] = [idf * f_i / (f_i + norm) for f_i, norm in zip(minCounts, longNorms)]
+            groupBounds = [0.0] * len(chunks)
+            for index in occurrenceTerms:
+                groupBounds = list(map(add, groupBounds, contributions[index]))
+            bounds.extend(zip(map(mul, groupBounds, repeat(len(occurrenceTerms))), repeat(groupNumber), range(len(chunks))))
+        bounds.sort(key=itemgetter(0), reverse=True)
+
+        # (score, -local index) of the best documents so far, smallest first. Ties go to the document found first.
+        best = []
+        for bound, groupNumber, chunkNumber in bounds:
+            if len(best) >= depth and _below(bound, best[0][0]):
+                # No document in this chunk or any later one can reach the top depth.
+                break
+            occurrenceTerms, chunks = self.groups[groupNumber][:2]
+            locals, counts, lengths = chunks[chunkNumber]
+            for local, score in zip(locals, self.scoreDocuments(occurrenceTerms, counts, lengths, k1, b)):
+                item = (score, -local)
+                if len(best) < depth:
+                    heapq.heappush(best, item)
+                elif item > best[0]:
+                    heapq.heapreplace(best, item)
+        return [(self.docIds[-negativeLocal], score) for score, negativeLocal in sorted(best, reverse=True)]
+
+
+def _below(bound, threshold):
+    # Strictly below, with some room for rounding: the bounds are added up in a different order than the scores.
+    # A document that could tie the depth-th best score is always scored, since it might win the tie.
+    # Unlike scoring._below, bounds here can be negative.
+    return bound + abs(bound) * 1e-9 + 1e-12 < threshold
+
+
+def parseGrid(spec):
+    """
+    Parses "start:stop:step" (stop included) or a comma separated list of values.
+    """
+    if ":" in spec:
+        start, stop, step = (float(value) for value in spec.split(":"))
+        if step <= 0:
+            raise ValueError(f"The step of {spec} must be positive")
+        # Rounded, so repeated steps don't drift (0.30000000000000004).
+        count = int((stop - start) / step + 1e-9) + 1
+        return [round(start + i * step, 10) for i in range(count)]
+    return [float(value) for value in spec.split(",")]
+
+
+def rankingResults(ranking, mapping):
+    """
+    A ranking as the Result objects of a run, with DOCNOs like the run files have.
+    """
+    return [Result(mapping[docId], score, rank) for rank, (docId, score) in enumerate(ranking, 1)]
+
+
+def sweepB(args):
+    """
+    Evaluates every k1 for one b. Returns [(k1, b, {metric: mean over the topics})].
+    """
+    b, k1Values, depth = args
+    # Only judged topics count, like evaluation.evaluateIRSystem.
+    judged = [topic for topic in sweepTopics if topic.topicID in sweepQrels.query_2_reldoc_nos]
+    points = []
+    for k1 in k1Values:
+        evaluationMetrics = {}
+        for topic in judged:
+            ranking = topic.rank(k1, b, depth)
+            if ranking:
+                evaluationMetrics[topic.topicID] = evaluateQuery(topic.topicID, rankingResults(ranking, sweepMapping), sweepQrels)
+        points.append((k1, b, meanMetrics(evaluationMetrics)))
+    return points
+
+
+def runSweep(indexPath, topicsPath, qrelsPath, k1Values, bValues, depth=1000, numWorkers=1, cachePostings=DEFAULT_CACHE_POSTINGS):
+    """
+    Evaluates BM25 for every (k1, b) in the grid.
+    Returns:
+        list: (k1, b, {metric: mean over the judged topics}) for every grid point, b by b.
+    """
+    global sweepTopics, sweepQrels, sweepMapping
+    lexicon, invertedIndex, docLengths, mapping, stats = loadIndex(indexPath, cachePostings)
+    sweepQrels = QrelsParser(qrelsPath).parse()
+    sweepMapping = mapping
+
+    start_time = time.time()
+    sweepTopics = [TopicPostings(topicID, query, lexicon, invertedIndex, docLengths, stats) for topicID, query in readTopics(topicsPath)]
+    print(f"Decoded the postings of {len(sweepTopics)} topics in {time.time() - start_time:.2f} seconds.")
+
+    start_time = time.time()
+    work = [(b, k1Values, depth) for b in bValues]
+    if numWorkers > 1 and len(work) > 1:
+        ## Reference: https://docs.python.org/3/library/multiprocessing.html#contexts-and-start-methods
+        if "fork" not in multiprocessing.get_all_start_methods():
+            raise ValueError("--workers needs the fork start method, so the workers can share the decoded postings")
+        with multiprocessing.get_context("fork").Pool(min(numWorkers, len(work))) as pool:
+            points = [point for points in pool.imap(sweepB, work) for point in points]
+    else:
+        points = [point for item in work for point in sweepB(item)]
+    print(f"Evaluated {len(points)} (k1, b) points in {time.time() - start_time:.2f} seconds.")
+    return points
+
+
+def writeBestRun(runPath, k1, b, depth, runTag):
+    """
+    Writes the run of one grid point in TREC format, the same as BM25.py --topics --k1 k1 --b b.
+    """
+    with open(runPath, "w") as f:
+        for topic in sweepTopics:
+            for rank, (docId, score) in enumerate(topic.rank(k1, b, depth), 1):
+                f.write(f"{topic.topicID} Q0 {sweepMapping[docId]} {rank} {score} {runTag}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate BM25 over a grid of k1 and b values.")
+    parser.add_argument("indexPath", help="Directory containing the index files")
+    parser.add_argument("topicsPath", help="TREC topics file")
+    parser.add_argument("qrelsPath", help="Qrels file")
+    parser.add_argument("--k1", default="0.2:2.0:0.2", help="k1 values, start:stop:step or a comma separated list (default: 0.2:2.0:0.2)")
+    parser.add_argument("--b", default="0.0:1.0:0.1", help="b values, start:stop:step or a comma separated list (default: 0.0:1.0:0.1)")
+    parser.add_argument("--depth", type=int, default=1000, help="Results per topic (default: 1000)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes, each taking whole b values (default: 1)")
+    parser.add_argument("--metric", default="averagePrecision", choices=METRICS, help="Metric to pick the best point by (default: averagePrecision)")
+    parser.add_argument("--output", help="Write the metrics of every grid point to this tab separated file")
+    parser.add_argument("--best-run", help="Write the run of the best point to this TREC run file")
+    parser.add_argument("--run-tag", default="yabadeerBM25", help="With --best-run, the run tag in the last column (default: yabadeerBM25)")
+    parser.add_argument("--postings-cache", type=int, default=DEFAULT_CACHE_POSTINGS, metavar="N", help=f"Decoded postings to keep in the LRU cache (default: {DEFAULT_CACHE_POSTINGS})")
+    args = parser.parse_args()
+
+    try:
+        k1Values = parseGrid(args.k1)
+        bValues = parseGrid(args.b)
+    except ValueError as e:
+        parser.error(str(e))
+    # The chunk bounds need scores that grow with the count and shrink with the document length.
+    if min(k1Values) < 0 or min(bValues) < 0 or max(bValues) > 1:
+        parser.error("k1 can't be negative and b must be between 0 and 1.")
+    if args.depth < 1 or args.workers < 1:
+        parser.error("--depth and --workers must be at least 1.")
+    points = runSweep(args.indexPath, args.topicsPath, args.qrelsPath, k1Values, bValues, args.depth, args.workers, args.postings_cache)
+
+    header = f"{'k1':<6} {'b':<6} " + " ".join(f"{METRIC_NAMES[name]:<10}" for name in METRICS)
+    print(header)
+    for k1, b, metrics in points:
+        print(f"{k1:<6g} {b:<6g} " + " ".join(f"{metrics[name]:<10.4f}" for name in METRICS))
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write("k1\tb\t" + "\t".join(METRIC_NAMES[name] for name in METRICS) + "\n")
+            for k1, b, metrics in points:
+                f.write(f"{k1:g}\t{b:g}\t" + "\t".join(f"{metrics[name]:.4f}" for name in METRICS) + "\n")
+
+    # Ties go to the first point in the grid.
+    bestK1, bestB, bestMetrics = max(points, key=lambda point: point[2][args.metric])
+    print(f"Best {METRIC_NAMES[args.metric]}: {bestMetrics[args.metric]:.4f} with k1 = {bestK1:g}, b = {bestB:g}")
+    if args.best_run:
+        writeBestRun(args.best_run, bestK1, bestB, args.depth, args.run_tag)
+        print(f"The run is in {args.best_run}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+'''
+Quoted phrase queries, answered from positional postings (indexes built with indexEngine.py --positions).
+
+A query like: "los angeles" police
+only matches documents where "los" is immediately followed by "angeles". The words of the phrase are still
+scored like any other query term by BM25.py; the phrase just decides which documents can be returned.
+
+Acknowledgements:
+- The positional intersection follows the positional index lecture and chapter 2.4 of
+  Introduction to Information Retrieval (Manning, Raghavan, Schutze).
+'''
+
+import re
+from textAnalysis import tokenize
+
+# Text between a pair of double quotes. An unmatched quote is ignored.
+PHRASE_PATTERN = re.compile(r'"([^"]*)"')
+
+
+def parsePhrases(query):
+    """
+    Returns the tokens of each quoted phrase in the query, e.g. '"Los Angeles" police' -> [['los', 'angeles']].
+    """
+    phrases = []
+    for phraseText in PHRASE_PATTERN.findall(query):
+        tokens = tokenize(phraseText)
+        if tokens:
+            phrases.append(tokens)
+    return phrases
+
+
+def phraseDocuments(termIDs, invertedIndex):
+    """
+    Finds the documents that contain the terms next to each other, in order.
+
+    Args:
+        termIDs (list): The term ID of each word of the phrase (None for a word that isn't in the lexicon).
+        invertedIndex: An inverted index with positions (it needs getPositional).
+
+    Returns:
+        set: The docIDs that contain the phrase.
+    """
+    if not hasattr(invertedIndex, "getPositional"):
+        raise ValueError("This index has no positions. Rebuild it with indexEngine.py --positions to use phrase queries.")
+    if not termIDs or any(termID is None for termID in termIDs):
+        return set()
+
+    # {docID: positions} for each distinct word of the phrase.
+    positionsByTerm = {}
+    for termID in set(termIDs):
+        positionsByTerm[termID] = {docID: positions for docID, _, positions in invertedIndex.getPositional(termID, [])}
+
+    # Only documents that contain every word can contain the phrase. Start from the rarest word.
+    candidates = set(min(positionsByTerm.values(), key=len))
+    for docPositions in positionsByTerm.values():
+        candidates.intersection_update(docPositions)
+
+    matches = set()
+    for docID in candidates:
+        # Possible start positions of the phrase: where word i is, minus i. The phrase is there if every word agrees.
+        starts = set(positionsByTerm[termIDs[0]][docID])
+        for offset, termID in enumerate(termIDs[1:], 1):
+            starts.intersection_update(position - offset for position in positionsByTerm[termID][docID])
+            if not starts:
+                break
+        if starts:
+            matches.add(docID)
+    return matches
+
+
+def matchingDocuments(phrases, termIDForToken, invertedIndex):
+    """
+    The documents that contain every phrase of a query, or None if the query has no phrases.
+
+    Args:
+        phrases (list): The output of parsePhrases.
+        termIDForToken (function): Looks up a token's term ID (None if the token isn't in the lexicon).
+        invertedIndex: An inverted index with positions.
+    """
+    if not phrases:
+        return None
+    matches = None
+    for phrase in phrases:
+        docs = phraseDocuments([termIDForToken(token) for token in phrase], invertedIndex)
+        matches = docs if matches is None else matches & docs
+    return matches
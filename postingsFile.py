@@ -0,0 +1,470 @@
+'''
+Binary postings file used by indexEngine.py, BM25.py and booleanAND.py.
+
+Layout of inverted_index.bin (all integers little-endian):
+- header: magic, format version, flags, number of terms
+- offset table: (number of terms + 1) 8-byte offsets into the postings data, indexed by termID
+- document frequency table: one 4-byte count per termID
+- postings data: for every term, its postings as varbyte-coded docID gaps and counts
+  (in a positional index, each count is followed by that many varbyte-coded position gaps)
+
+Acknowledgements:
+- Variable byte encoding and gap (delta) encoding of docIDs are from the compression lectures
+  and chapter 5 of Introduction to Information Retrieval (Manning, Raghavan, Schutze).
+- Reference for mmap: https://docs.python.org/3/library/mmap.html
+'''
+
+import heapq
+import itertools
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import OrderedDict
+from instrumentation import instruments
+
+POSTINGS_MAGIC = b"IRPS"
+POSTINGS_VERSION = 1
+HEADER_FORMAT = "<4sIII"  # magic, version, flags, number of terms
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+POSITIONS_FLAG = 1  # set in the header flags when every posting also has its positions (indexEngine.py --positions)
+DEFAULT_CACHE_POSTINGS = 1000000  # decoded postings PostingsReader keeps in its LRU cache (roughly 100 MB)
+
+
+def encodeVarByte(number, out):
+    """
+    Append the variable byte encoding of a non-negative integer to the bytearray out.
+    7 bits of the number go in each byte, and the high bit is set on every byte except the last.
+    """
+    while number >= 0x80:
+        out.append((number & 0x7F) | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def decodeVarByte(data, pos):
+    """
+    Decode one variable byte encoded integer from data starting at pos.
+    Returns:
+        tuple: (the decoded integer, the position right after it)
+    """
+    number = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        number |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return number, pos
+        shift += 7
+
+
+def encodePostings(postings, positional=False):
+    """
+    Encode a postings list of (docID, count) tuples sorted by docID.
+    The docIDs are stored as gaps from the previous docID so that they stay small.
+    With positional=True the postings are (docID, count, positions) and the sorted positions are gap encoded too.
+    """
+    out = bytearray()
+    previousDocID = 0
+    for posting in postings:
+        docID, count = posting[0], posting[1]
+        gap = docID - previousDocID
+        if gap <= 0 and previousDocID:
+            raise ValueError(f"Postings must be sorted by increasing docID (got {docID} after {previousDocID}).")
+        encodeVarByte(gap, out)
+        encodeVarByte(count, out)
+        if positional:
+            previousPosition = 0
+            for position in posting[2]:
+                encodeVarByte(position - previousPosition, out)
+                previousPosition = position
+        previousDocID = docID
+    return bytes(out)
+
+
+def decodePostings(data, positional=False):
+    """
+    Decode a block produced by encodePostings back into a list of (docID, count) tuples.
+    The varbyte decoding is written inline since this is the hot loop of every query.
+    With positional=True the positions are skipped over (decodePositionalPostings keeps them).
+    """
+    postings = []
+    append = postings.append
+    pos = 0
+    end = len(data)
+    docID = 0
+    while pos < end:
+        # docID gap
+        byte = data[pos]
+        pos += 1
+        gap = byte & 0x7F
+        shift = 7
+        while byte >= 0x80:
+            byte = data[pos]
+            pos += 1
+            gap |= (byte & 0x7F) << shift
+            shift += 7
+        # count
+        byte = data[pos]
+        pos += 1
+        count = byte & 0x7F
+        shift = 7
+        while byte >= 0x80:
+            byte = data[pos]
+            pos += 1
+            count |= (byte & 0x7F) << shift
+            shift += 7
+        if positional:
+            # Skip over the position gaps: every varbyte number ends with a byte below 0x80.
+            for _ in range(count):
+                while data[pos] >= 0x80:
+                    pos += 1
+                pos += 1
+        docID += gap
+        append((docID, count))
+    return postings
+
+
+def decodePositionalPostings(data):
+    """
+    Decode a positional postings block into a list of (docID, count, positions) tuples.
+    """
+    postings = []
+    pos = 0
+    end = len(data)
+    docID = 0
+    while pos < end:
+        gap, pos = decodeVarByte(data, pos)
+        count, pos = decodeVarByte(data, pos)
+        positions = []
+        position = 0
+        for _ in range(count):
+            positionGap, pos = decodeVarByte(data, pos)
+            position += positionGap
+            positions.append(position)
+        docID += gap
+        postings.append((docID, count, positions))
+    return postings
+
+
+def littleEndianBytes(values):
+    # Arrays are written in native byte order, so swap on big-endian machines to keep the file portable.
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def writePostingsFile(path, numTerms, termPostings, positional=False):
+    """
+    Write a binary postings file.
+
+    Args:
+        path (str): Where to write the file.
+        numTerms (int): The size of the lexicon. TermIDs go from 0 to numTerms - 1.
+        termPostings (iterable): (termID, postings) pairs in increasing termID order.
+            Terms that never show up get an empty postings list.
+        positional (bool): Whether the postings are (docID, count, positions) and the positions should be stored.
+    """
+    encoded = ((termID, len(postings), encodePostings(postings, positional)) for termID, postings in termPostings)
+    return writeEncodedPostingsFile(path, numTerms, encoded, positional)
+
+
+def writeEncodedPostingsFile(path, numTerms, termEncoded, positional=False):
+    """
+    Write a binary postings file from postings that are already encoded (see mergeBatchRuns).
+
+    Args:
+        termEncoded (iterable): (termID, document frequency, encoded postings) in increasing termID order.
+    Returns:
+        array: The offset of each term's postings in the postings data (numTerms + 1 of them).
+    """
+    offsets = array("Q", [0]) * (numTerms + 1)
+    documentFrequencies = array("I", [0]) * numTerms
+    tablesSize = 8 * (numTerms + 1) + 4 * numTerms
+
+    with open(path, "wb") as f:
+        flags = POSITIONS_FLAG if positional else 0
+        f.write(struct.pack(HEADER_FORMAT, POSTINGS_MAGIC, POSTINGS_VERSION, flags, numTerms))
+        # Leave room for the tables and fill them in once all the postings are written.
+        f.write(bytes(tablesSize))
+
+        position = 0
+        nextTermID = 0
+        for termID, df, encoded in termEncoded:
+            if termID < nextTermID or termID >= numTerms:
+                raise ValueError(f"TermID {termID} is out of order or outside the lexicon.")
+            # Any skipped terms have empty postings lists.
+            while nextTermID <= termID:
+                offsets[nextTermID] = position
+                nextTermID += 1
+            f.write(encoded)
+            position += len(encoded)
+            documentFrequencies[termID] = df
+        while nextTermID <= numTerms:
+            offsets[nextTermID] = position
+            nextTermID += 1
+
+        f.seek(HEADER_SIZE)
+        f.write(littleEndianBytes(offsets))
+        f.write(littleEndianBytes(documentFrequencies))
+    return offsets
+
+
+def writeRun(path, termPostings, positional=False):
+    """
+    Writes a sorted run for the external merge in indexEngine.py --memory-budget.
+    Each term is stored as its varbyte termID, the varbyte length of its encoded postings, then the postings.
+
+    Args:
+        termPostings (iterable): (termID, postings) pairs in increasing termID order.
+    """
+    with open(path, "wb") as f:
+        for termID, postings in termPostings:
+            encoded = encodePostings(postings, positional)
+            header = bytearray()
+            encodeVarByte(termID, header)
+            encodeVarByte(len(encoded), header)
+            f.write(header)
+            f.write(encoded)
+
+
+def readRun(path, positional=False):
+    """
+    Generator over the (termID, postings) pairs of a run written by writeRun.
+    The run is memory mapped, so only the term being decoded takes up memory.
+    """
+    decode = decodePositionalPostings if positional else decodePostings
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = 0
+        end = len(mm)
+        while pos < end:
+            termID, pos = decodeVarByte(mm, pos)
+            length, pos = decodeVarByte(mm, pos)
+            yield termID, decode(mm[pos:pos + length])
+            pos += length
+
+
+def _numberRun(run, runNumber):
+    for termID, postings in run:
+        yield termID, runNumber, postings
+
+
+def mergeRuns(runs):
+    """
+    K-way merge of sorted runs into one sequence of (termID, postings) in increasing termID order.
+    Runs must be given oldest first: a term's postings from each run are concatenated in run order,
+    which keeps them sorted by docID since later runs hold later documents.
+    """
+    ## Reference: https://docs.python.org/3/library/heapq.html#heapq.merge
+    merged = heapq.merge(*[_numberRun(run, runNumber) for runNumber, run in enumerate(runs)], key=lambda item: (item[0], item[1]))
+    for termID, group in itertools.groupby(merged, key=lambda item: item[0]):
+        postings = []
+        for _, _, runPostings in group:
+            postings.extend(runPostings)
+        yield termID, postings
+
+
+def writeBatchRun(path, postingsLists, positional=False):
+    """
+    Writes the postings of one batch of documents indexed by a worker (indexEngine.py --workers): the encoded postings
+    list of each of the batch's termIDs (0, 1, 2, ...), back to back, in their final encoding.
+    Returns:
+        tuple: (offsets of the lists in the file, with one more at the end, df of each list, last docID of each list)
+    """
+    offsets = array("Q", [0])
+    dfs = array("I")
+    lastDocIDs = array("I")
+    with open(path, "wb") as f:
+        for postings in postingsLists:
+            encoded = encodePostings(postings, positional)
+            f.write(encoded)
+            offsets.append(offsets[-1] + len(encoded))
+            dfs.append(len(postings))
+            lastDocIDs.append(postings[-1][0] if postings else 0)
+    return offsets, dfs, lastDocIDs
+
+
+def _batchTerms(batchNumber, globalTermIDs):
+    # The batch's termIDs in increasing order of the termIDs they were given in the whole index.
+    for localID in sorted(range(len(globalTermIDs)), key=globalTermIDs.__getitem__):
+        yield globalTermIDs[localID], batchNumber, localID
+
+
+def mergeBatchRuns(batches):
+    """
+    K-way merge of batch runs (writeBatchRun) into (termID, document frequency, encoded postings) in increasing termID
+    order, for writeEncodedPostingsFile. The encoded lists are joined as bytes: only the first docID gap of each list
+    after the first is decoded and encoded again, as the gap from the last docID of the list before it.
+
+    Args:
+        batches (list): (run path, offsets, dfs, last docIDs, termID of each of the batch's termIDs) of every batch,
+            in increasing docID order.
+    """
+    files = []
+    runs = []
+    try:
+        for path, offsets, dfs, lastDocIDs, globalTermIDs in batches:
+            f = open(path, "rb")
+            files.append(f)
+            runs.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if offsets[-1] else b"")
+        ## Reference: https://docs.python.org/3/library/heapq.html#heapq.merge
+        merged = heapq.merge(*[_batchTerms(number, batch[4]) for number, batch in enumerate(batches)])
+        for termID, group in itertools.groupby(merged, key=lambda item: item[0]):
+            encoded = bytearray()
+            df = 0
+            previousDocID = 0
+            for _, batchNumber, localID in group:
+                _, offsets, dfs, lastDocIDs, _ = batches[batchNumber]
+                start, end = offsets[localID], offsets[localID + 1]
+                data = runs[batchNumber]
+                if previousDocID:
+                    firstDocID, start = decodeVarByte(data, start)
+                    encodeVarByte(firstDocID - previousDocID, encoded)
+                encoded += data[start:end]
+                df += dfs[localID]
+                previousDocID = lastDocIDs[localID]
+            yield termID, df, bytes(encoded)
+    finally:
+        for run in runs:
+            if isinstance(run, mmap.mmap):
+                run.close()
+        for f in files:
+            f.close()
+
+
+class PostingsReader:
+    """
+    Read-only view of a binary postings file.
+    The file is memory mapped and a postings list is only decoded when it is asked for,
+    so opening the index does not depend on how many postings there are.
+    It behaves like the {termID: [(docID, count), ...]} dictionary the text loaders return.
+
+    Decoded lists are kept in an LRU cache holding up to cachePostings postings (positions count too),
+    so the terms of recent queries aren't decoded again. Lists from the cache are shared: don't change them.
+    hits and misses count the lookups that were and weren't answered from the cache. They are also counted for the
+    query being measured, if instrumentation.py is on.
+    """
+
+    def __init__(self, path, cachePostings=DEFAULT_CACHE_POSTINGS):
+        self.path = path
+        self.cachePostings = cachePostings
+        ## Reference: https://docs.python.org/3/library/collections.html#collections.OrderedDict
+        self.cache = OrderedDict()  # (termID, positional) -> (decoded list, size), least recently used first
+        self.cachedPostings = 0
+        self.hits = 0
+        self.misses = 0
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.flags, self.numTerms = struct.unpack_from(HEADER_FORMAT, self.mm, 0)
+        if magic != POSTINGS_MAGIC or version != POSTINGS_VERSION:
+            self.mm.close()
+            raise ValueError(f"{path} is not a supported postings file.")
+        self.positional = bool(self.flags & POSITIONS_FLAG)
+        self.offsetsStart = HEADER_SIZE
+        self.dfStart = self.offsetsStart + 8 * (self.numTerms + 1)
+        self.dataStart = self.dfStart + 4 * self.numTerms
+
+    def documentFrequency(self, termID):
+        """
+        Number of documents containing the term, read from the table without decoding anything.
+        """
+        if not 0 <= termID < self.numTerms:
+            return 0
+        return struct.unpack_from("<I", self.mm, self.dfStart + 4 * termID)[0]
+
+    def rawPostings(self, termID):
+        """
+        The encoded bytes of a term's postings list (empty if the term has no postings).
+        """
+        if not 0 <= termID < self.numTerms:
+            return b""
+        start, end = struct.unpack_from("<QQ", self.mm, self.offsetsStart + 8 * termID)
+        return self.mm[self.dataStart + start:self.dataStart + end]
+
+    def cached(self, key, decode):
+        """
+        Returns the decoded list for key from the cache, or decodes it with decode() and caches it.
+        """
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.hits += 1
+            instruments.count("postingsCacheHits")
+            self.cache.move_to_end(key)
+            return entry[0]
+        self.misses += 1
+        postings = decode()
+        instruments.count("postingsCacheMisses")
+        instruments.count("postingsDecoded", len(postings))
+        size = len(postings) + (sum(len(posting[2]) for posting in postings) if key[1] else 0)
+        if size <= self.cachePostings:
+            self.cache[key] = (postings, size)
+            self.cachedPostings += size
+            # Evict the least recently used lists until the cache fits again.
+            while self.cachedPostings > self.cachePostings:
+                _, (_, evictedSize) = self.cache.popitem(last=False)
+                self.cachedPostings -= evictedSize
+        return postings
+
+    def cacheStats(self):
+        """
+        Hit and miss counts and the current size of the postings cache.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / lookups if lookups else 0.0,
+            "lists": len(self.cache),
+            "postings": self.cachedPostings,
+        }
+
+    def get(self, termID, default=None):
+        if not self.documentFrequency(termID):
+            return default
+        return self.cached((termID, False), lambda: decodePostings(self.rawPostings(termID), self.positional))
+
+    def getPositional(self, termID, default=None):
+        """
+        Returns the term's postings as (docID, count, positions) tuples. Only for indexes built with --positions.
+        """
+        if not self.positional:
+            raise ValueError(f"{self.path} has no positions. Rebuild the index with indexEngine.py --positions.")
+        if not self.documentFrequency(termID):
+            return default
+        return self.cached((termID, True), lambda: decodePositionalPostings(self.rawPostings(termID)))
+
+    def positionalItems(self):
+        # Full scans (merging, statistics) decode each list once and skip the cache, so they don't flush it.
+        for termID in range(self.numTerms):
+            data = self.rawPostings(termID)
+            if data:
+                yield termID, decodePositionalPostings(data)
+
+    def __getitem__(self, termID):
+        postings = self.get(termID)
+        if postings is None:
+            raise KeyError(termID)
+        return postings
+
+    def __contains__(self, termID):
+        return self.documentFrequency(termID) > 0
+
+    def __len__(self):
+        return self.numTerms
+
+    def keys(self):
+        return (termID for termID in range(self.numTerms) if termID in self)
+
+    def items(self):
+        for termID in range(self.numTerms):
+            data = self.rawPostings(termID)
+            if data:
+                yield termID, decodePostings(data, self.positional)
+
+    def close(self):
+        self.mm.close()
@@ -0,0 +1,80 @@
+'''
+Cache of query results for BM25.py (and the search server), for the head queries that keep coming back.
+
+Results are cached under the normalised query: its tokens (so "Los Angeles" and "los  angeles" are the same
+query) and its quoted phrases, plus the settings that change the ranking or the rendering (k1, b, top N, ...).
+Entries are evicted least recently used first once there are too many, and expire after a time to live.
+All entries are dropped when the index generation changes (segments.indexGeneration), since they may no longer
+match the index.
+
+Acknowledgements:
+- Result caching for skewed query logs follows the caching part of the efficient query processing lecture.
+- Reference for OrderedDict: https://docs.python.org/3/library/collections.html#collections.OrderedDict
+'''
+
+import time
+from collections import OrderedDict
+from textAnalysis import tokenize
+from phraseQuery import parsePhrases
+
+DEFAULT_CACHE_ENTRIES = 1000
+DEFAULT_TTL_SECONDS = 600
+
+
+def queryCacheKey(query, k1, b, topN, *settings):
+    """
+    The cache key of a query: its tokens and phrases, k1, b, top N and any other settings that change the results.
+    """
+    phrases = tuple(tuple(phrase) for phrase in parsePhrases(query))
+    return (tuple(tokenize(query)), phrases, k1, b, topN) + settings
+
+
+class QueryResultCache:
+    """
+    LRU cache with a time to live. A maxEntries of 0 turns caching off.
+    """
+
+    def __init__(self, maxEntries=DEFAULT_CACHE_ENTRIES, ttlSeconds=DEFAULT_TTL_SECONDS, generation=None, clock=time.monotonic):
+        self.maxEntries = maxEntries
+        self.ttlSeconds = ttlSeconds
+        self.generation = generation
+        self.clock = clock
+        self.entries = OrderedDict()  # key -> (value, expiry time), least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        The cached value for key, or None if it isn't cached or has expired.
+        """
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] > self.clock():
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+        if entry is not None:
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if self.maxEntries <= 0:
+            return
+        self.entries[key] = (value, self.clock() + self.ttlSeconds)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+    def setGeneration(self, generation):
+        """
+        Drops every entry if the index generation has changed since the entries were cached.
+        Returns True if it had changed.
+        """
+        if generation == self.generation:
+            return False
+        self.entries.clear()
+        self.generation = generation
+        return True
+
+    def __len__(self):
+        return len(self.entries)
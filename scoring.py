@@ -0,0 +1,369 @@
+'''
+Term-at-a-time BM25 scoring.
+
+BM25.bm25 calls bm25Score for every posting of every query term, and bm25Score looks the document up in every
+query term's postings again, working out its length normalisation each time. BM25Scorer gives the same ranking
+in one pass over each postings list: the length normalisation of every document is worked out once into an
+array indexed by docID, and the scores are accumulated into arrays indexed by docID.
+
+To give exactly the same scores (and the same order for ties) as bm25, the sum for a document is built up
+in query term order, and then added once for every query term occurrence whose postings contain the
+document, the same way bm25 adds a document's bm25Score each time it comes across it.
+benchmarks.py scoring compares the two.
+
+BM25Scorer.topK finds just the best k documents with MaxScore pruning. Each term has an upper bound on what
+it can add to a document's score (kept in the collection statistics, and below 0 for the common words). Only
+documents from the strongest terms' postings are scored, best upper bound first into a heap of the k best, and
+the postings of the weak terms (usually the common words) are searched for each of them only while its bound
+could still reach the k-th best score. When pruning can't pay off it scores everything like score(). It returns
+exactly score(query)[:k].
+
+Both report their phases (tokenize, phrases, lexicon, decode, score, sort) and how many postings and documents
+they went through to instrumentation.py, which does nothing unless it is turned on.
+
+Acknowledgements:
+- Term-at-a-time evaluation with accumulators follows the query processing lecture and chapter 7.1 of
+  Introduction to Information Retrieval (Manning, Raghavan, Schutze).
+- Reference for array: https://docs.python.org/3/library/array.html
+- MaxScore is from Turtle and Flood, "Query evaluation: strategies and optimizations" (1995),
+  as described in the efficient query processing lecture.
+'''
+
+import heapq
+from array import array
+from bisect import bisect_left
+from textAnalysis import tokenize
+from phraseQuery import parsePhrases, matchingDocuments
+from instrumentation import instruments
+from collectionStats import DEFAULT_K1, DEFAULT_B
+
+# How many postings a term-at-a-time pass gets through in the time topK takes to score one document by searching
+# the postings of one other term for it. topK only prunes when that could beat scoring everything.
+PROBE_COST = 3
+
+
+def documentNorms(docLengths, avgDl, k1, b):
+    """
+    The BM25 length normalisation k1 * ((1 - b) + b * dl / avgdl) of every document, indexed by docID.
+    """
+    size = max(docLengths, default=0) + 1
+    # IDs that aren't documents get the norm of an empty document, like docLengths.get(docId, 0) in bm25Score.
+    norms = array("d", [k1 * ((1 - b) + b * (0 / avgDl))]) * size
+    for docId, dl in docLengths.items():
+        norms[docId] = k1 * ((1 - b) + b * (dl / avgDl))
+    return norms
+
+
+class BM25Scorer:
+    """
+    Scores queries against one index with fixed k1 and b. Building it precomputes the document norms,
+    so make one and reuse it for every query.
+    """
+
+    def __init__(self, lexicon, invertedIndex, docLengths, stats, k1=1.2, b=0.75):
+        """
+        Args:
+            lexicon (dict): Mapping of terms to term IDs.
+            invertedIndex: Mapping of term IDs to postings lists.
+            docLengths (dict): Mapping of document IDs to document lengths.
+            stats (CollectionStats): N, the average document length and the IDF of every term (collectionStats.py).
+            k1 (float): BM25 tuning parameter for term frequency saturation.
+            b (float): BM25 tuning parameter for document length normalization.
+        """
+        self.lexicon = lexicon
+        self.invertedIndex = invertedIndex
+        self.stats = stats
+        self.idfs = stats.idf
+        self.k1 = k1
+        self.b = b
+        if stats.norms is not None and k1 == DEFAULT_K1 and b == DEFAULT_B:
+            # Already worked out, in the index snapshot.
+            self.norms = stats.norms
+        else:
+            self.norms = documentNorms(docLengths, stats.avgDl, k1, b)
+
+    def score(self, query):
+        """
+        Scores every document that contains a query term.
+
+        Returns:
+            list: (docID, score) tuples with the highest scoring documents first, the same as BM25.bm25.
+        """
+        queryTerms, phraseMatches = self.parse(query)
+        return self.scoreTerms(queryTerms, phraseMatches)
+
+    def scoreTerms(self, queryTerms, phraseMatches=None):
+        """
+        score() for a query that is already tokenized, with the documents matching its phrases (None if it has none).
+        """
+        partials, occurrences, touched = self.accumulate(queryTerms, phraseMatches)
+
+        with instruments.phase("sort"):
+            scores = []
+            for docId in touched:
+                # Add the document's score once per query term occurrence that found it, like bm25 does.
+                partial = partials[docId]
+                score = 0.0
+                for _ in range(occurrences[docId]):
+                    score += partial
+                scores.append((docId, score))
+            # touched is in the order bm25 first scores each document, so the stable sort breaks ties the same way.
+            scores.sort(key=lambda item: item[1], reverse=True)
+        instruments.count("docsScored", len(touched))
+        return scores
+
+    def parse(self, query):
+        """
+        The query's tokens, and the documents that contain all of its quoted phrases (None if it has none).
+        """
+        with instruments.phase("tokenize"):
+            queryTerms = tokenize(query)
+            phrases = parsePhrases(query)
+        if not phrases:
+            return queryTerms, None
+        with instruments.phase("phrases"):
+            return queryTerms, matchingDocuments(phrases, self.lexicon.get, self.invertedIndex)
+
+    def accumulate(self, queryTerms, phraseMatches=None):
+        """
+        One pass over the postings of each query term.
+
+        Returns:
+            tuple: (partial score of each docID, number of query term occurrences that found each docID,
+                    docIDs in the order they were first found)
+        """
+        with instruments.phase("lexicon"):
+            termIds = [termId for termId in map(self.lexicon.get, queryTerms) if termId is not None]
+        with instruments.phase("decode"):
+            postingsByTerm = {}
+            for termId in termIds:
+                if termId not in postingsByTerm:
+                    postingsByTerm[termId] = self.invertedIndex.get(termId, [])
+
+        with instruments.phase("score"):
+            norms = self.norms
+            partials = array("d", [0.0]) * len(norms)
+            occurrences = array("I", [0]) * len(norms)
+            touched = []
+            for termId in termIds:
+                idf = self.idfs[termId]
+                for posting in postingsByTerm[termId]:
+                    docId, f_i = posting[0], posting[1]
+                    if phraseMatches is not None and docId not in phraseMatches:
+                        continue
+                    if not occurrences[docId]:
+                        touched.append(docId)
+                    occurrences[docId] += 1
+                    partials[docId] += idf * f_i / (f_i + norms[docId])
+        instruments.count("postingsScanned", sum(len(postingsByTerm[termId]) for termId in termIds))
+        return partials, occurrences, touched
+
+    def topK(self, query, k):
+        """
+        The k best documents for the query, the same as score(query)[:k], with MaxScore pruning.
+
+        A document's score is (number of query term occurrences it contains) * (sum of their contributions),
+        so a document that contains none of the strongest j terms scores at most
+        (occurrences of the other terms) * (sum of their occurrences times their upper bounds).
+        A first threshold comes from scoring the k best documents of the strongest term exactly. The terms
+        whose documents could still reach it are essential: their postings are added up term at a time. The
+        documents found are then scored exactly, highest upper bound first, by searching the postings of the other
+        (non-essential) terms for them, with a heap of the k best. A document stops being searched for as soon as
+        its bound falls below the k-th best score, and the search stops at the first document whose bound does.
+        """
+        if k <= 0:
+            return []
+        queryTerms, phraseMatches = self.parse(query)
+
+        # Distinct terms in order of first appearance, and which of them each query term occurrence is.
+        with instruments.phase("lexicon"):
+            termIndexes = {}
+            occurrenceTerms = []
+            for term in queryTerms:
+                termId = self.lexicon.get(term)
+                if termId is None:
+                    continue
+                if termId not in termIndexes:
+                    termIndexes[termId] = len(termIndexes)
+                occurrenceTerms.append(termIndexes[termId])
+        numTerms = len(termIndexes)
+        if not numTerms:
+            return []
+
+        weights = [0] * numTerms
+        for index in occurrenceTerms:
+            weights[index] += 1
+        postingsLists = [None] * numTerms
+        idfs = [0.0] * numTerms
+        bounds = [0.0] * numTerms
+        with instruments.phase("decode"):
+            for termId, index in termIndexes.items():
+                postingsLists[index] = self.invertedIndex.get(termId, [])
+                idfs[index] = self.idfs[termId]
+                # Below 0 for the common words, whose IDF is negative.
+                bounds[index] = self.stats.upperBound(termId, self.k1, self.b)
+
+        # Strongest terms first.
+        order = sorted(range(numTerms), key=lambda index: weights[index] * bounds[index], reverse=True)
+        totalPostings = sum(len(postings) for postings in postingsLists)
+        if len(postingsLists[order[0]]) * (1 + PROBE_COST * (numTerms - 1)) >= totalPostings:
+            # Even if only the strongest term were essential, looking its documents up in the other terms' postings
+            # would cost more than a term-at-a-time pass over everything (this includes every single term query).
+            return self.scoreTerms(queryTerms, phraseMatches)[:k]
+
+        # remaining[j] is the prefix sums of the bounds of the occurrences of terms j onwards, largest first (see _bound).
+        remaining = []
+        for j in range(numTerms):
+            prefixes = [0.0]
+            for bound in sorted((bounds[index] for index in order[j:] for _ in range(weights[index])), reverse=True):
+                prefixes.append(prefixes[-1] + bound)
+            remaining.append(prefixes)
+
+        norms = self.norms
+        with instruments.phase("score"):
+            # A first threshold: the k-th best exact score of the documents with the largest counts, for their
+            # length, of the strongest term.
+            strongPostings = postingsLists[order[0]]
+            if phraseMatches is not None:
+                strongPostings = [posting for posting in strongPostings if posting[0] in phraseMatches]
+            seeds = heapq.nlargest(k, strongPostings, key=lambda posting: posting[1] / (posting[1] + norms[posting[0]]))
+            threshold = float("-inf")
+            if len(seeds) == k:
+                threshold = min(self._exactScore(posting[0], postingsLists, idfs, occurrenceTerms, weights)[0] for posting in seeds)
+            # The essential terms: all those up to the first one that no document outside the terms before it can
+            # reach the threshold with.
+            split = 1
+            while split < numTerms and not _below(_bound(0, 0.0, remaining[split]), threshold):
+                split += 1
+            essentialPostings = sum(len(postingsLists[index]) for index in order[:split])
+            if split == numTerms or essentialPostings * (1 + PROBE_COST * (numTerms - split)) >= totalPostings:
+                # Too many of the postings are essential (with a common word whose IDF is negative, documents
+                # without it can win, so every term is), and a term-at-a-time pass over all of them is cheaper.
+                return self.scoreTerms(queryTerms, phraseMatches)[:k]
+
+            # Add the essential terms up in query order, like score(), so a document that none of the other terms
+            # contain already has its exact sum. first is the first term (of these) that found each document.
+            essential = set(order[:split])
+            partials = array("d", [0.0]) * len(norms)
+            occurrences = array("I", [0]) * len(norms)
+            first = array("I", [0]) * len(norms)
+            touched = []
+            for index in occurrenceTerms:
+                if index not in essential:
+                    continue
+                idf = idfs[index]
+                for posting in postingsLists[index]:
+                    docId, f_i = posting[0], posting[1]
+                    if phraseMatches is not None and docId not in phraseMatches:
+                        continue
+                    if not occurrences[docId]:
+                        touched.append(docId)
+                        first[docId] = index
+                    occurrences[docId] += 1
+                    partials[docId] += idf * f_i / (f_i + norms[docId])
+
+            # The candidates that could still beat the first threshold, highest bound first.
+            optional = order[split:]
+            optionalBounds = remaining[split:]
+            candidates = []
+            for docId in touched:
+                bound = _bound(occurrences[docId], partials[docId], optionalBounds[0])
+                if not _below(bound, threshold):
+                    candidates.append((bound, docId))
+            candidates.sort(reverse=True)
+
+            # (score, -first term index, -docID) of the k best documents, worst first. Ties are broken the way
+            # score() breaks them: by the first query term containing the document, then by docID.
+            top = []
+            threshold = float("-inf")
+            probed = scored = 0
+            for bound, docId in candidates:
+                if len(top) == k and _below(bound, threshold):
+                    # The candidates are in order of their bounds, so none of the rest can make the top k either.
+                    break
+                occurrence, partial = occurrences[docId], partials[docId]
+                norm = norms[docId]
+                found = False
+                for position, index in enumerate(optional):
+                    if position and len(top) == k and _below(_bound(occurrence, partial, optionalBounds[position]), threshold):
+                        break
+                    probed += 1
+                    f_i = _count(postingsLists[index], docId)
+                    if f_i:
+                        found = True
+                        occurrence += weights[index]
+                        partial += weights[index] * idfs[index] * f_i / (f_i + norm)
+                else:
+                    scored += 1
+                    if found:
+                        # Add up again in query order, exactly like score().
+                        entry = self._exactScore(docId, postingsLists, idfs, occurrenceTerms, weights)
+                    else:
+                        entry = (_repeat(partial, occurrence), -first[docId], -docId)
+                    if len(top) < k:
+                        heapq.heappush(top, entry)
+                    elif entry > top[0]:
+                        heapq.heapreplace(top, entry)
+                    if len(top) == k:
+                        threshold = top[0][0]
+        instruments.count("postingsScanned", essentialPostings)
+        instruments.count("postingsProbed", probed + (len(seeds) * numTerms if len(seeds) == k else 0))
+        instruments.count("docsScored", scored)
+
+        with instruments.phase("sort"):
+            return [(-negativeDocId, score) for score, _, negativeDocId in sorted(top, reverse=True)]
+
+    def _exactScore(self, docId, postingsLists, idfs, occurrenceTerms, weights):
+        """
+        (score, -first term index, -docID) of a document, worked out exactly like score() does by searching the
+        postings of the terms for it.
+        """
+        norm = self.norms[docId]
+        contributions = {}
+        for index, postings in enumerate(postingsLists):
+            f_i = _count(postings, docId)
+            if f_i:
+                contributions[index] = idfs[index] * f_i / (f_i + norm)
+        partial = 0.0
+        for index in occurrenceTerms:
+            if index in contributions:
+                partial += contributions[index]
+        return _repeat(partial, sum(weights[index] for index in contributions)), -min(contributions), -docId
+
+
+def _count(postings, docId):
+    """
+    The count of a document in a postings list sorted by docID (0 if it isn't there), by binary search.
+    """
+    position = bisect_left(postings, (docId,))
+    if position < len(postings) and postings[position][0] == docId:
+        return postings[position][1]
+    return 0
+
+
+def _repeat(partial, occurrences):
+    # The document's partial sum added once per query term occurrence, in the same order as score() adds it.
+    score = 0.0
+    for _ in range(occurrences):
+        score += partial
+    return score
+
+
+def _bound(occurrences, partial, prefixes):
+    """
+    The most a document with this many occurrences and this partial sum so far can score if it is also in some of
+    the other terms. prefixes are the sums of the largest 0, 1, 2, ... of the bounds of their occurrences: for m more
+    occurrences the sum is at most prefixes[m], and since occurrences + m is positive that gives the largest score.
+    """
+    best = occurrences * partial
+    for more in range(1, len(prefixes)):
+        bound = (occurrences + more) * (partial + prefixes[more])
+        if bound > best:
+            best = bound
+    return best
+
+
+def _below(bound, threshold):
+    # Strictly below, with some room for rounding: the bounds are added up in a different order than the scores.
+    # A document that could tie the k-th best score is always scored, since it might win the tie.
+    return bound + abs(bound) * 1e-9 + 1e-12 < threshold
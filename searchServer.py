@@ -0,0 +1,414 @@
+'''
+Long-running HTTP/JSON search service over an index that is loaded once.
+
+Usage:
+    python3 searchServer.py <indexPath> [--host 127.0.0.1] [--port 8080] [--workers N]
+
+Endpoints (GET):
+- /search?q=<query>[&k=10][&snippets=0]: the top k results, with their headline, date, DOCNO, score and snippet
+- /doc/<DOCNO>: a stored document by its DOCNO
+- /doc/id/<internal ID>: a stored document by its internal ID
+- /metrics[?format=json]: with --instrument, the per-phase timers, counters and histograms of the searches
+  (instrumentation.py) in the Prometheus text format, or as JSON
+
+The event loop only parses requests and writes responses. Queries are scored and their snippets made by a pool of
+worker processes, which are forked after the index is loaded so they share it instead of loading their own copies.
+Documents are read in a thread. Requests beyond --max-pending waiting searches are turned away with 503, and a
+search that takes longer than --timeout gets a 504, so latency stays bounded when there are many clients.
+Repeated queries are answered from the query result cache (queryCache.py). A background task checks every
+--reload-interval seconds whether segments were appended or merged. If so, the new index is loaded in a thread and
+new workers are started on it, while the old ones keep answering, and then the server switches over to them.
+
+Acknowledgements:
+- Reference for asyncio streams: https://docs.python.org/3/library/asyncio-stream.html
+- Reference for run_in_executor: https://docs.python.org/3/library/asyncio-eventloop.html#executing-code-in-thread-or-process-pools
+- Reference for ProcessPoolExecutor: https://docs.python.org/3/library/concurrent.futures.html#processpoolexecutor
+'''
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qs, unquote
+from BM25 import loadIndex, resultDetails, closeSearchers
+from docMetadata import openMetadata
+from getDoc import fetchDocument
+from postingsFile import DEFAULT_CACHE_POSTINGS
+from queryCache import QueryResultCache, queryCacheKey, DEFAULT_CACHE_ENTRIES, DEFAULT_TTL_SECONDS
+from scoring import BM25Scorer
+from segments import indexGeneration
+from sentenceStore import openSentenceStore
+from textAnalysis import tokenize
+import instrumentation
+from instrumentation import instruments
+
+DEFAULT_PORT = 8080
+DEFAULT_K = 10
+MAX_K = 1000
+DEFAULT_MAX_PENDING = 64  # searches waiting for a worker before new ones get 503
+DEFAULT_TIMEOUT_SECONDS = 10.0
+DEFAULT_RELOAD_SECONDS = 2.0  # how often to check whether segments were appended or merged
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                500: "Internal Server Error", 503: "Service Unavailable", 504: "Gateway Timeout"}
+
+
+class Searcher:
+    """
+    Everything needed to answer a search, loaded once.
+    """
+
+    def __init__(self, indexPath, cachePostings=DEFAULT_CACHE_POSTINGS):
+        self.indexPath = indexPath
+        lexicon, invertedIndex, docLengths, self.mapping, stats = loadIndex(indexPath, cachePostings)
+        self.scorer = BM25Scorer(lexicon, invertedIndex, docLengths, stats)
+        self.metadata = openMetadata(indexPath)
+        self.sentences = openSentenceStore(indexPath, lexicon, invertedIndex)
+        self.docIds = None  # {DOCNO: internal ID}
+
+    def search(self, query, k, showSnippets=True):
+        """
+        The top k results for the query as dictionaries, best first.
+        Raises ValueError for phrase queries on an index without positions.
+        """
+        queryTerms = tokenize(query)
+        results = []
+        for rank, (docId, score) in enumerate(self.scorer.topK(query, k), 1):
+            docNo, headline, year, month, day, snippet = resultDetails(
+                docId, self.mapping, self.indexPath, queryTerms, self.metadata, showSnippets, self.sentences)
+            result = {"rank": rank, "id": docId, "docno": docNo, "score": score, "headline": headline, "date": f"{year}-{month}-{day}"}
+            if showSnippets:
+                result["snippet"] = snippet
+            results.append(result)
+        return results
+
+    def document(self, docNo=None, internalId=None):
+        """
+        Returns (internal ID, DOCNO, stored document) for a DOCNO or an internal ID, or None if there is no such document.
+        """
+        if internalId is None:
+            if self.docIds is None:
+                # Only built if a document is asked for by its DOCNO.
+                self.docIds = {mappedDocNo: mappedId for mappedId, mappedDocNo in self.mapping.items()}
+            internalId = self.docIds.get(docNo)
+        docNo = self.mapping.get(internalId)
+        if docNo is None:
+            return None
+        return internalId, docNo, fetchDocument(self.indexPath, internalId, docNo)
+
+    def close(self):
+        """
+        Closes the index files, once a newer generation of the index has replaced this one, and the document
+        stores of the segments it no longer has.
+        """
+        closeSearchers(self.scorer, None, self.metadata, self.sentences, self.indexPath)
+
+
+# The searcher of a worker process.
+searcher = None
+
+def setSearcher(loaded):
+    """
+    Pool initializer with the fork start method: the workers are forked from the server after it loaded the index,
+    so they share the loaded searcher instead of loading their own copies.
+    """
+    global searcher
+    searcher = loaded
+
+def loadSearcher(indexPath, cachePostings):
+    """
+    Pool initializer for platforms that can't fork: each worker loads the index itself.
+    """
+    global searcher
+    searcher = Searcher(indexPath, cachePostings)
+
+def searchInWorker(query, k, showSnippets):
+    """
+    Runs in a worker process. Returns (results, None, measurement), or (None, error message, measurement) for a
+    query that can't be answered. The measurement (None if instrumentation is off) is added up by the server.
+    """
+    with instruments.query(aggregate=False):
+        try:
+            results, error = searcher.search(query, k, showSnippets), None
+        except ValueError as e:
+            results, error = None, str(e)
+    return results, error, instruments.lastQuery if instruments.enabled else None
+
+def loadInstrumentedSearcher(indexPath, cachePostings, instrumentSettings):
+    """
+    loadSearcher that also turns instrumentation on in the worker if the server measures its searches.
+    """
+    if instrumentSettings is not None:
+        instruments.configure(*instrumentSettings)
+    loadSearcher(indexPath, cachePostings)
+
+
+class SearchService:
+    """
+    The HTTP server. All of its methods run on the event loop.
+    """
+
+    def __init__(self, indexPath, numWorkers, cachePostings, resultCache, maxPending, timeout, reloadInterval=DEFAULT_RELOAD_SECONDS):
+        self.indexPath = indexPath
+        self.numWorkers = numWorkers
+        self.cachePostings = cachePostings
+        self.resultCache = resultCache
+        self.maxPending = maxPending
+        self.timeout = timeout
+        self.reloadInterval = reloadInterval
+        self.pending = 0
+        # The generation of the index that searcher and pool were loaded from (segments.indexGeneration).
+        self.generation = indexGeneration(indexPath)
+        self.resultCache.setGeneration(self.generation)
+        self.searcher = Searcher(indexPath, cachePostings)
+        self.pool = self.startWorkers(self.searcher)
+        # With fork all the workers start on the first job, so start them now rather than during a request.
+        self.pool.submit(int).result()
+
+    def startWorkers(self, loaded):
+        """
+        A pool of worker processes that search with the loaded searcher.
+        """
+        if "fork" in multiprocessing.get_all_start_methods():
+            return ProcessPoolExecutor(self.numWorkers, mp_context=multiprocessing.get_context("fork"), initializer=setSearcher, initargs=(loaded,))
+        instrumentSettings = (True, instruments.profiler, instruments.profileDir) if instruments.enabled else None
+        return ProcessPoolExecutor(self.numWorkers, initializer=loadInstrumentedSearcher, initargs=(self.indexPath, self.cachePostings, instrumentSettings))
+
+    async def watchIndex(self):
+        """
+        Runs as long as the server: every reloadInterval seconds, checks whether segments were appended or merged,
+        and if so reloads the index. Looking at the index files happens in a thread, so requests aren't held up.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.reloadInterval)
+            try:
+                generation = await loop.run_in_executor(None, indexGeneration, self.indexPath)
+                if generation != self.generation:
+                    await self.reload(generation)
+            except Exception:
+                # E.g. a segment that a merge deleted while it was being loaded. The loaded index keeps being
+                # searched, and the next check tries again.
+                traceback.print_exc()
+
+    async def reload(self, generation):
+        """
+        Loads the new generation of the index in a thread and starts new workers on it while the old ones keep
+        answering, then switches over to them.
+        """
+        loaded = await asyncio.get_running_loop().run_in_executor(None, Searcher, self.indexPath, self.cachePostings)
+        pool = self.startWorkers(loaded)
+        try:
+            await asyncio.wrap_future(pool.submit(int))
+        except BaseException:
+            pool.shutdown(wait=False)
+            loaded.close()
+            raise
+        oldSearcher, oldPool = self.searcher, self.pool
+        # Nothing else runs on the event loop in between, so every request sees either the old searcher, workers
+        # and cached results, or the new ones.
+        self.searcher, self.pool, self.generation = loaded, pool, generation
+        self.resultCache.setGeneration(generation)
+        # Searches already running on the old workers finish first. They have their own copies of the old
+        # searcher, so the server's can be closed now.
+        oldPool.shutdown(wait=False)
+        oldSearcher.close()
+
+    def searchDone(self, future):
+        """
+        Called when a worker has finished a search, whether or not its client was still waiting for it.
+        """
+        self.pending -= 1
+        if not future.cancelled():
+            # Marks the error of a search nobody waited for as seen, so asyncio doesn't log it.
+            future.exception()
+
+    async def search(self, query, k, showSnippets):
+        """
+        Returns (HTTP status, response dictionary).
+        """
+        start = time.perf_counter()
+        generation = self.generation
+        key = queryCacheKey(query, self.searcher.scorer.k1, self.searcher.scorer.b, k, showSnippets)
+        results = self.resultCache.get(key)
+        cached = results is not None
+        if cached:
+            instruments.count("resultCacheHits")
+        else:
+            if self.pending >= self.maxPending:
+                return 503, {"error": "Too many searches are waiting. Please try again."}
+            self.pending += 1
+            future = asyncio.get_running_loop().run_in_executor(self.pool, searchInWorker, query, k, showSnippets)
+            # A search that timed out keeps its worker busy until it ends, so it stays pending until then.
+            future.add_done_callback(self.searchDone)
+            try:
+                # shield: a timeout (or a client that goes away) doesn't cancel the search, which would leave it
+                # running in the worker without being counted.
+                results, error, measurement = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+            except asyncio.TimeoutError:
+                return 504, {"error": f"The search took longer than {self.timeout} seconds."}
+            if measurement is not None:
+                instruments.addQuery(measurement)
+            if error is not None:
+                return 400, {"error": error}
+            if generation == self.generation:
+                # Results from an index that was replaced while the search ran aren't cached.
+                self.resultCache.put(key, results)
+        took = (time.perf_counter() - start) * 1000
+        return 200, {"query": query, "k": k, "cached": cached, "took_ms": round(took, 3), "results": results}
+
+    async def document(self, docNo=None, internalId=None):
+        found = await asyncio.get_running_loop().run_in_executor(None, self.searcher.document, docNo, internalId)
+        if found is None:
+            return 404, {"error": "This document doesn't exist."}
+        foundId, foundDocNo, document = found
+        return 200, {"id": foundId, "docno": foundDocNo, "document": document}
+
+    async def route(self, method, target):
+        """
+        Returns (HTTP status, response dictionary) for a request.
+        """
+        if method != "GET":
+            return 405, {"error": "Only GET is supported."}
+        url = urlsplit(target)
+        path = url.path
+        if path == "/search":
+            params = parse_qs(url.query)
+            query = params.get("q", [""])[0]
+            if not query.strip():
+                return 400, {"error": "Missing query: /search?q=<query>"}
+            k = params.get("k", [str(DEFAULT_K)])[0]
+            if not k.isdigit() or not 1 <= int(k) <= MAX_K:
+                return 400, {"error": f"k must be a number from 1 to {MAX_K}."}
+            showSnippets = params.get("snippets", ["1"])[0].lower() not in ("0", "false", "no")
+            return await self.search(query, int(k), showSnippets)
+        if path == "/metrics":
+            if not instruments.enabled:
+                return 404, {"error": "Instrumentation is off. Start the server with --instrument."}
+            if parse_qs(url.query).get("format", [""])[0] == "json":
+                return 200, instruments.snapshot()
+            return 200, instruments.toPrometheus()
+        if path.startswith("/doc/id/"):
+            internalId = path[len("/doc/id/"):]
+            if not internalId.isdigit():
+                return 400, {"error": "The internal ID must be a number."}
+            return await self.document(internalId=int(internalId))
+        if path.startswith("/doc/") and len(path) > len("/doc/"):
+            return await self.document(docNo=unquote(path[len("/doc/"):]))
+        return 404, {"error": "Unknown path. Use /search?q=..., /doc/<DOCNO>, /doc/id/<internal ID> or /metrics."}
+
+    async def handleConnection(self, reader, writer):
+        """
+        Answers the requests of one connection, which is kept open between requests (HTTP/1.1 keep-alive).
+        """
+        try:
+            while True:
+                requestLine = await reader.readline()
+                if not requestLine:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                parts = requestLine.decode("latin-1").split()
+                if len(parts) != 3:
+                    await self.respond(writer, 400, {"error": "Malformed request line."}, False)
+                    break
+                method, target, version = parts
+                # Requests have no body, but skip one if it is sent so the next request is read correctly.
+                length = headers.get("content-length", "0")
+                if length.isdigit() and int(length):
+                    await reader.readexactly(int(length))
+                keepAlive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                try:
+                    status, response = await self.route(method, target)
+                except Exception:
+                    # A bug or a damaged index shouldn't take the connection down without an answer.
+                    traceback.print_exc()
+                    status, response = 500, {"error": "The server could not answer this request."}
+                await self.respond(writer, status, response, keepAlive)
+                if not keepAlive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            # The client went away or sent something that can't be parsed.
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, response, keepAlive):
+        # A string response is plain text (the Prometheus metrics), anything else is sent as JSON.
+        if isinstance(response, str):
+            body = response.encode("utf-8")
+            contentType = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body = json.dumps(response).encode("utf-8")
+            contentType = "application/json; charset=utf-8"
+        head = (f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                f"Content-Type: {contentType}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keepAlive else 'close'}\r\n\r\n")
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+
+async def serve(service, host, port):
+    """
+    Serves until Ctrl+C or SIGTERM.
+    """
+    server = await asyncio.start_server(service.handleConnection, host, port)
+    stop = asyncio.Event()
+    for signalNumber in (signal.SIGINT, signal.SIGTERM):
+        try:
+            asyncio.get_running_loop().add_signal_handler(signalNumber, stop.set)
+        except NotImplementedError:
+            # Windows: Ctrl+C still raises KeyboardInterrupt.
+            pass
+    print(f"Serving {service.indexPath} on http://{host}:{port} with {service.numWorkers} workers (Ctrl+C to stop).")
+    watcher = asyncio.create_task(service.watchIndex())
+    async with server:
+        await stop.wait()
+    watcher.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP/JSON search service: python3 searchServer.py <indexPath>")
+    parser.add_argument("indexPath", help="Directory containing the index files")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port to listen on (default: {DEFAULT_PORT})")
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1), help="Worker processes that score queries (default: up to 4)")
+    parser.add_argument("--max-pending", type=int, default=DEFAULT_MAX_PENDING, help=f"Searches allowed to wait for a worker before new ones are turned away (default: {DEFAULT_MAX_PENDING})")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT_SECONDS, help=f"Seconds a search may take before it gets a 504 (default: {DEFAULT_TIMEOUT_SECONDS})")
+    parser.add_argument("--postings-cache", type=int, default=DEFAULT_CACHE_POSTINGS, metavar="N", help=f"Decoded postings each worker keeps in its LRU cache (default: {DEFAULT_CACHE_POSTINGS})")
+    parser.add_argument("--result-cache", type=int, default=DEFAULT_CACHE_ENTRIES, metavar="N", help=f"Recent queries whose results are cached (default: {DEFAULT_CACHE_ENTRIES}, 0 turns it off)")
+    parser.add_argument("--result-cache-ttl", type=float, default=DEFAULT_TTL_SECONDS, metavar="SECONDS", help=f"How long cached results are kept (default: {DEFAULT_TTL_SECONDS})")
+    parser.add_argument("--reload-interval", type=float, default=DEFAULT_RELOAD_SECONDS, metavar="SECONDS", help=f"How often to check whether segments were appended or merged (default: {DEFAULT_RELOAD_SECONDS})")
+    instrumentation.addArguments(parser)
+    args = parser.parse_args()
+    if args.workers < 1 or args.max_pending < 1 or args.timeout <= 0 or args.reload_interval <= 0:
+        parser.error("--workers, --max-pending, --timeout and --reload-interval must be positive.")
+    if args.profile_dir and not args.profile:
+        parser.error("--profile-dir needs --profile.")
+    instrumentation.configureFromArguments(args)
+
+    resultCache = QueryResultCache(args.result_cache, args.result_cache_ttl)
+    service = SearchService(args.indexPath, args.workers, args.postings_cache, resultCache, args.max_pending, args.timeout, args.reload_interval)
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.pool.shutdown()
+        if args.metrics:
+            instruments.writeMetrics(args.metrics, args.metrics_format)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+'''
+Immutable index segments for incremental indexing (indexEngine.py --append).
+
+The index directory itself is the first segment. Every later batch of documents is indexed into its own
+directory under segments/, with the same files as a normal index and internal IDs that continue where the
+previous segment stopped. segments.txt lists the appended segments in order, and query code searches
+across all of them. Merging (indexEngine.py --merge, or automatically when there are too many segments)
+replaces adjacent segments with one, so the number of segments stays bounded.
+
+Acknowledgements:
+- The segment and merge policy design follows the dynamic indexing lecture and chapter 4.5 of
+  Introduction to Information Retrieval (logarithmic merging), simplified to merging adjacent segments.
+'''
+
+import os
+from postingsFile import PostingsReader, DEFAULT_CACHE_POSTINGS
+
+SEGMENTS_DIR = "segments"
+SEGMENTS_MANIFEST_FILE = "segments.txt"
+MAX_SEGMENTS = 8  # appended segments allowed before the smallest neighbours get merged
+
+
+def readManifest(indexPath):
+    """
+    Returns the names of the appended segments in order (empty for an index that was never appended to).
+    """
+    manifestPath = os.path.join(indexPath, SEGMENTS_MANIFEST_FILE)
+    if not os.path.exists(manifestPath):
+        return []
+    with open(manifestPath, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def writeManifest(indexPath, names):
+    """
+    Replaces the manifest in one step so readers never see a half written list of segments.
+    """
+    manifestPath = os.path.join(indexPath, SEGMENTS_MANIFEST_FILE)
+    with open(manifestPath + ".tmp", "w") as f:
+        for name in names:
+            f.write(name + "\n")
+    ## Reference: https://docs.python.org/3/library/os.html#os.replace
+    os.replace(manifestPath + ".tmp", manifestPath)
+
+
+def segmentPath(indexPath, name):
+    return os.path.join(indexPath, SEGMENTS_DIR, name)
+
+
+def temporarySegmentPath(indexPath, name):
+    """
+    Where a new segment is built before it is renamed to segmentPath, so a build that fails (or is killed) never
+    leaves a half written segment under its real name. newSegmentName doesn't count these as used names.
+    """
+    return segmentPath(indexPath, name + ".tmp")
+
+
+def segmentPaths(indexPath):
+    """
+    Directories of all the segments of an index, oldest (the index directory itself) first.
+    """
+    return [indexPath] + [segmentPath(indexPath, name) for name in readManifest(indexPath)]
+
+
+def indexGeneration(indexPath):
+    """
+    A value that changes whenever the index is rebuilt, appended to or merged: the segments and when
+    each of them was written. Caches of query results compare it to know when to drop their entries.
+    """
+    generation = []
+    for path in segmentPaths(indexPath):
+        # Every build writes mapping.txt, and a segment is never written again after that.
+        stat = os.stat(os.path.join(path, "mapping.txt"))
+        generation.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(generation)
+
+
+def newSegmentName(indexPath):
+    """
+    Picks a name for a new segment that hasn't been used before: seg-000001, seg-000002, ...
+    """
+    used = set(readManifest(indexPath))
+    segmentsDir = os.path.join(indexPath, SEGMENTS_DIR)
+    if os.path.isdir(segmentsDir):
+        used.update(os.listdir(segmentsDir))
+    numbers = [int(name[4:]) for name in used if name.startswith("seg-") and name[4:].isdigit()]
+    return f"seg-{max(numbers, default=0) + 1:06d}"
+
+
+def lastInternalId(indexPath):
+    """
+    The largest internal ID in the index, so appended documents can continue from the next one.
+    """
+    lastId = 0
+    for path in segmentPaths(indexPath):
+        with open(os.path.join(path, "mapping.txt"), "r") as f:
+            for line in f:
+                lastId = max(lastId, int(line.split(":")[0]))
+    return lastId
+
+
+def segmentDocNos(path):
+    """
+    The DOCNOs of the documents in a segment (or a whole index without appended segments).
+    """
+    with open(os.path.join(path, "mapping.txt"), "r") as f:
+        return [line.rstrip("\n").split(":", 1)[1] for line in f]
+
+
+def segmentSize(path):
+    """
+    Number of documents in a segment.
+    """
+    with open(os.path.join(path, "mapping.txt"), "r") as f:
+        return sum(1 for _ in f)
+
+
+def chooseSegmentsToMerge(sizes, maxSegments=MAX_SEGMENTS):
+    """
+    Merge policy. Given the sizes of the appended segments in order, returns the (start, end) slice of adjacent
+    segments to merge into one so that at most maxSegments are left, or None if there are few enough already.
+    Out of all the windows of the right length, the one with the fewest documents is picked, so small recent
+    segments get merged often and big old ones rarely get rewritten.
+    """
+    windowLength = len(sizes) - maxSegments + 1
+    if windowLength < 2:
+        return None
+    bestStart = min(range(len(sizes) - windowLength + 1), key=lambda start: sum(sizes[start:start + windowLength]))
+    return bestStart, bestStart + windowLength
+
+
+def loadSegmentPostings(path, cachePostings=DEFAULT_CACHE_POSTINGS):
+    """
+    Opens a segment's postings. Segments are written in the binary format, but the first segment could be an older text index.
+    """
+    binaryPath = os.path.join(path, "inverted_index.bin")
+    if os.path.exists(binaryPath):
+        return PostingsReader(binaryPath, cachePostings)
+    invertedIndex = {}
+    with open(os.path.join(path, "inverted_index.txt"), "r") as f:
+        for line in f:
+            termID, postings = line.strip().split(":", 1)
+            invertedIndex[int(termID)] = [tuple(int(value) for value in posting.split(":")) for posting in postings.split(",")]
+    return invertedIndex
+
+
+class MultiSegmentPostings:
+    """
+    Presents the postings of several segments as one inverted index keyed by a unified termID.
+    A term's postings list is the concatenation of its lists in each segment. Segments hold increasing ranges
+    of internal IDs, so the result is still sorted by docID.
+    """
+
+    def __init__(self, segmentPostings, localTermIDs):
+        """
+        segmentPostings: the inverted index of each segment.
+        localTermIDs: for each segment, a {unified termID: segment termID} dictionary.
+        """
+        self.segmentPostings = segmentPostings
+        self.localTermIDs = localTermIDs
+        self.numTerms = max((max(ids, default=-1) for ids in localTermIDs), default=-1) + 1
+
+    def get(self, termID, default=None):
+        postings = []
+        for invertedIndex, localIDs in zip(self.segmentPostings, self.localTermIDs):
+            localID = localIDs.get(termID)
+            if localID is not None:
+                postings.extend(invertedIndex.get(localID, []))
+        return postings if postings else default
+
+    def getPositional(self, termID, default=None):
+        postings = []
+        for invertedIndex, localIDs in zip(self.segmentPostings, self.localTermIDs):
+            localID = localIDs.get(termID)
+            if localID is not None:
+                if not hasattr(invertedIndex, "getPositional"):
+                    raise ValueError("A segment of this index has no positions. Rebuild the index with indexEngine.py --positions.")
+                postings.extend(invertedIndex.getPositional(localID, []))
+        return postings if postings else default
+
+    def cacheStats(self):
+        """
+        The postings cache counters of all the segments added up (see PostingsReader.cacheStats).
+        """
+        totals = {"hits": 0, "misses": 0, "lists": 0, "postings": 0}
+        for invertedIndex in self.segmentPostings:
+            if hasattr(invertedIndex, "cacheStats"):
+                for name, value in invertedIndex.cacheStats().items():
+                    if name in totals:
+                        totals[name] += value
+        lookups = totals["hits"] + totals["misses"]
+        totals["hitRate"] = totals["hits"] / lookups if lookups else 0.0
+        return totals
+
+    def __getitem__(self, termID):
+        postings = self.get(termID)
+        if postings is None:
+            raise KeyError(termID)
+        return postings
+
+    def documentFrequency(self, termID):
+        total = 0
+        for invertedIndex, localIDs in zip(self.segmentPostings, self.localTermIDs):
+            localID = localIDs.get(termID)
+            if localID is not None:
+                if hasattr(invertedIndex, "documentFrequency"):
+                    total += invertedIndex.documentFrequency(localID)
+                else:
+                    total += len(invertedIndex.get(localID, []))
+        return total
+
+    def __contains__(self, termID):
+        return self.documentFrequency(termID) > 0
+
+    def __len__(self):
+        return self.numTerms
+
+    def keys(self):
+        return (termID for termID in range(self.numTerms) if termID in self)
+
+    def items(self):
+        for termID in range(self.numTerms):
+            postings = self.get(termID)
+            if postings is not None:
+                yield termID, postings
+
+    def close(self):
+        for invertedIndex in self.segmentPostings:
+            if hasattr(invertedIndex, "close"):
+                invertedIndex.close()
+
+
+def loadSegmentedIndex(indexPath, cachePostings=DEFAULT_CACHE_POSTINGS):
+    """
+    Loads every segment of an index and combines them for querying.
+    The postings cache (see PostingsReader) is split evenly between the segments.
+    Returns:
+        tuple: (lexicon {term: unified termID}, inverted index, docLengths {docID: length}, mapping {docID: DOCNO})
+    """
+    lexicon = {}
+    segmentPostings = []
+    localTermIDs = []
+    docLengths = {}
+    mapping = {}
+    paths = segmentPaths(indexPath)
+    for path in paths:
+        # Unified termIDs are given out in order of first appearance across the segments.
+        localIDs = {}
+        with open(os.path.join(path, "lexicon.txt"), "r") as f:
+            for line in f:
+                termID, term = line.strip().split(":")
+                if term not in lexicon:
+                    lexicon[term] = len(lexicon)
+                localIDs[lexicon[term]] = int(termID)
+        localTermIDs.append(localIDs)
+        segmentPostings.append(loadSegmentPostings(path, cachePostings // len(paths)))
+
+        with open(os.path.join(path, "doc-lengths.txt"), "r") as f:
+            for line in f:
+                docID, length = line.strip().split(":")
+                docLengths[int(docID)] = int(length)
+        with open(os.path.join(path, "mapping.txt"), "r") as f:
+            for line in f:
+                docID, docno = line.strip().split(":")
+                mapping[int(docID)] = docno
+
+    return lexicon, MultiSegmentPostings(segmentPostings, localTermIDs), docLengths, mapping
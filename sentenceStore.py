@@ -0,0 +1,187 @@
+'''
+Sentence store for query-biased snippets, written by indexEngine.py next to the other index files.
+
+BM25.generateQueryBiasedSnippet has to read the raw document, cut out the <TEXT>, strip the tags, split it into
+sentences and tokenize every sentence for every result it shows. That work only depends on the document, so it
+is done once at indexing time instead: for every document, the sentences a snippet can be made of (the ones with
+at least 5 words, in order) are stored with the term IDs of their tokens. A snippet is then scored by comparing
+integers with the query's term IDs, and the raw document isn't read at all.
+
+The records are kept in a packed store (docStore.py) of their own, keyed by internal ID:
+- sentences.dat: zlib-compressed blocks of records (smaller blocks than the document store, since results are
+  looked up one at a time and each one decompresses a whole block)
+- sentences.idx: the offset table
+A record has the number of sentences and the UTF-8 length and number of tokens of each sentence (variable byte
+coded, see postingsFile.encodeVarByte), then the texts of all the sentences, then the term ID of every token as
+4-byte little-endian integers (UNKNOWN_TERM for a token that isn't in the lexicon, which no query term can match).
+Fixed-width term IDs are decoded all at once by array.frombytes instead of one byte at a time in Python.
+The term IDs are those of the segment the document is in.
+The store is only written for indexes built with indexEngine.py --snippet-store. Without it, snippets are made
+from the stored documents.
+
+Acknowledgements:
+- The sentence scoring is the query-biased summary pseudocode from lecture (see BM25.generateQueryBiasedSnippet).
+'''
+
+import os
+import re
+import sys
+from array import array
+from docStore import DocStoreReader, DocStoreWriter
+from postingsFile import encodeVarByte, decodeVarByte, littleEndianBytes
+from segments import segmentPaths
+
+SENTENCES_DATA_FILE = "sentences.dat"
+SENTENCES_INDEX_FILE = "sentences.idx"
+SENTENCES_BLOCK_SIZE = 4 * 1024  # uncompressed bytes per block
+MIN_SENTENCE_WORDS = 5  # shorter sentences are never used in a snippet
+UNKNOWN_TERM = 0xFFFFFFFF  # term ID stored for tokens that aren't in the lexicon
+
+
+def stripTags(text):
+    # Removing tags
+    # Reference: https://stackoverflow.com/questions/3662142/how-to-remove-tags-from-a-string-in-python-using-regular-expressions-not-in-ht
+    return re.sub(r'<[^>]+>', '', text)
+
+def getTextContent(documentContent):
+    # Extracting text between <TEXT> tags
+    textContent = ""
+    if '<TEXT>' in documentContent and '</TEXT>' in documentContent:
+        textContent = documentContent.split('<TEXT>')[1].split('</TEXT>')[0]
+    return textContent
+
+def splitIntoSentences(text):
+    # Splitting sentences
+    # Reference: https://stackoverflow.com/questions/44099714/how-to-use-re-split-for-commas-and-periods
+    sentences = re.split(r'[.!?]', text)
+    return [sentence.strip() for sentence in sentences if sentence]
+
+def snippetSentences(documentContent):
+    """
+    The sentences of a document that can be used in its snippet: those of the <TEXT> with at least 5 words.
+    """
+    sentences = splitIntoSentences(stripTags(getTextContent(documentContent)))
+    return [sentence for sentence in sentences if len(sentence.split()) >= MIN_SENTENCE_WORDS]
+
+
+def sentenceStoreWriter(dataFile):
+    """
+    A DocStoreWriter with the sentence store's block size. Records are added with addRecord(internalId, encodeSentences(...)).
+    """
+    return DocStoreWriter(dataFile, SENTENCES_BLOCK_SIZE)
+
+
+def encodeSentences(sentences):
+    """
+    Encodes [(sentence text, [term ID])] into a record. Tokens that aren't in the lexicon have the term ID UNKNOWN_TERM.
+    """
+    record = bytearray()
+    texts = bytearray()
+    termIDs = array("I")
+    encodeVarByte(len(sentences), record)
+    for text, sentenceTermIDs in sentences:
+        data = text.encode("utf-8")
+        encodeVarByte(len(data), record)
+        encodeVarByte(len(sentenceTermIDs), record)
+        texts += data
+        termIDs.extend(sentenceTermIDs)
+    return bytes(record + texts + littleEndianBytes(termIDs))
+
+
+def decodeLayout(record):
+    """
+    Decodes the start of a record. Returns ([(UTF-8 length, number of tokens)] of each sentence, where the texts
+    start, the term IDs as an array).
+    """
+    numSentences, pos = decodeVarByte(record, 0)
+    lengths = []
+    for _ in range(numSentences):
+        length, pos = decodeVarByte(record, pos)
+        numTokens, pos = decodeVarByte(record, pos)
+        lengths.append((length, numTokens))
+    termIDs = array("I")
+    termIDs.frombytes(record[pos + sum(length for length, _ in lengths):])
+    if sys.byteorder == "big":
+        termIDs.byteswap()
+    return lengths, pos, termIDs
+
+
+def remapSentences(record, newTermIDs):
+    """
+    The record with every term ID t replaced by newTermIDs[t] (UNKNOWN_TERM stays as it is). Records are written with
+    the term IDs of the batch or segment they were indexed in, and this gives them the IDs of the index they are
+    merged into without decoding the sentences.
+    """
+    lengths, pos, termIDs = decodeLayout(record)
+    remapped = array("I", [termID if termID == UNKNOWN_TERM else newTermIDs[termID] for termID in termIDs])
+    return bytes(record[:pos + sum(length for length, _ in lengths)]) + littleEndianBytes(remapped)
+
+
+def decodeSentences(record):
+    """
+    Decodes a record into [(sentence text, array of term IDs)], with UNKNOWN_TERM for tokens that aren't in the lexicon.
+    """
+    lengths, pos, termIDs = decodeLayout(record)
+    sentences = []
+    termStart = 0
+    for length, numTokens in lengths:
+        sentences.append((record[pos:pos + length].decode("utf-8"), termIDs[termStart:termStart + numTokens]))
+        pos += length
+        termStart += numTokens
+    return sentences
+
+
+class IndexSentences:
+    """
+    The sentence stores of every segment of an index.
+    """
+
+    def __init__(self, stores, lexicon, localTermIDs=None):
+        """
+        Args:
+            stores (list): A DocStoreReader of each segment's sentence store, oldest segment first.
+            lexicon (dict): Mapping of terms to (unified) term IDs.
+            localTermIDs (list): For an index with appended segments, each segment's {unified termID: segment termID}.
+        """
+        self.stores = stores
+        self.lexicon = lexicon
+        self.localTermIDs = localTermIDs
+
+    def sentences(self, internalId):
+        """
+        Returns ([(sentence text, [term ID])], segment number) for a document, or (None, None) if it isn't stored.
+        """
+        for segment, store in enumerate(self.stores):
+            if internalId in store:
+                record = store.fetchRecord(internalId)
+                return (decodeSentences(record), segment) if record is not None else (None, None)
+        return None, None
+
+    def queryTermIDs(self, queryTerms, segment):
+        """
+        The term IDs of the query terms in a segment, as a set. Terms that aren't in the segment are left out.
+        """
+        termIDs = set()
+        for term in queryTerms:
+            termID = self.lexicon.get(term)
+            if termID is not None and self.localTermIDs is not None:
+                termID = self.localTermIDs[segment].get(termID)
+            if termID is not None:
+                termIDs.add(termID)
+        return termIDs
+
+    def close(self):
+        for store in self.stores:
+            store.close()
+
+
+def openSentenceStore(indexPath, lexicon, invertedIndex):
+    """
+    Opens the sentence stores of every segment of an index, or returns None if the index (or one of its segments)
+    was built before they existed.
+    """
+    paths = segmentPaths(indexPath)
+    if not all(os.path.exists(os.path.join(path, SENTENCES_INDEX_FILE)) for path in paths):
+        return None
+    stores = [DocStoreReader(path, SENTENCES_DATA_FILE, SENTENCES_INDEX_FILE) for path in paths]
+    return IndexSentences(stores, lexicon, getattr(invertedIndex, "localTermIDs", None))
@@ -0,0 +1,411 @@
+'''
+Document-partitioned sharding: an index split into shards by document, and a coordinator that searches them all.
+
+Usage:
+    python3 indexEngine.py <path_to_latimes.gz> <indexPath> --shards N [--workers N]
+    python3 shards.py search <indexPath> [--query "..."] [--topics <topics file> --run <run file>] [--connect host:port ...]
+    python3 shards.py serve <indexPath>/shard-000 --port 9000
+
+indexEngine.py --shards deals the documents out in turn, so shard s has the documents at positions s, s + N, s + 2N, ...
+of the collection. Every shard is an ordinary index directory (shard-000, shard-001, ... listed in shards.txt) whose
+documents keep the internal IDs they would have in one index of the whole collection. Next to its own statistics,
+each shard gets global-stats.bin (collectionStats.py) with the N, average document length and df of the whole
+collection for its terms, so BM25 scores a document on its shard exactly like it would on a single index.
+
+A query is sent to every shard at once (scatter), each shard returns its own top k, and the coordinator merges them
+(gather). The best k of the whole collection are all in their shards' top k, so the merge gives exactly the top k
+of the single index, ties included: ties are broken by the first query term containing the document, then by
+docID, which is how BM25Scorer breaks them.
+
+The shard workers are either local processes, one per shard, started by the coordinator, or shard servers started
+with "shards.py serve" that the coordinator connects to over TCP (--connect). The servers are a stand-in for shards
+on other machines: they use multiprocessing.connection, which authenticates with a shared key but then exchanges
+pickles, so only run them on localhost or a trusted network.
+
+Acknowledgements:
+- Document-partitioned indexes and query processing over them are from the distributed indexing lecture and
+  chapter 20.3 of Introduction to Information Retrieval (Manning, Raghavan, Schutze).
+- Reference for multiprocessing.connection: https://docs.python.org/3/library/multiprocessing.html#module-multiprocessing.connection
+- Reference for heapq.merge: https://docs.python.org/3/library/heapq.html#heapq.merge
+'''
+
+import argparse
+import heapq
+import itertools
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from multiprocessing.connection import Client, Listener
+from BM25 import loadIndex, loadLexicon, loadDocLengths, INVERTED_INDEX_FILE
+from collectionStats import CollectionStats, readCollectionStats, computeIdf, STATS_FILE, GLOBAL_STATS_FILE, DEFAULT_K1, DEFAULT_B
+from postingsFile import PostingsReader, DEFAULT_CACHE_POSTINGS
+from scoring import BM25Scorer
+from textAnalysis import tokenize
+from topics import readTopics
+
+SHARDS_MANIFEST_FILE = "shards.txt"
+DEFAULT_PORT = 9000
+DEFAULT_AUTHKEY = "bm25-shards"
+
+
+def shardName(number):
+    return f"shard-{number:03d}"
+
+
+def readShardManifest(indexPath):
+    """
+    Returns the names of the shard directories in order (empty for an index that isn't sharded).
+    """
+    manifestPath = os.path.join(indexPath, SHARDS_MANIFEST_FILE)
+    if not os.path.exists(manifestPath):
+        return []
+    with open(manifestPath, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def writeShardManifest(indexPath, names):
+    with open(os.path.join(indexPath, SHARDS_MANIFEST_FILE), "w") as f:
+        for name in names:
+            f.write(f"{name}\n")
+
+
+def isSharded(indexPath):
+    return os.path.exists(os.path.join(indexPath, SHARDS_MANIFEST_FILE))
+
+
+def shardPaths(indexPath):
+    return [os.path.join(indexPath, name) for name in readShardManifest(indexPath)]
+
+
+def writeGlobalStats(paths):
+    """
+    Writes global-stats.bin into every shard: the statistics of the whole collection under the shard's termIDs.
+    df and cf are added up over the shards (a document is in exactly one of them), so the IDFs are the single
+    index's. maxTf and minDl stay the shard's own, which are still bounds for its postings, and maxScore is worked
+    out again from the shard's postings with the global IDF and average document length.
+    Returns:
+        int: N, the number of documents in the whole collection.
+    """
+    lexicons = [loadLexicon(path) for path in paths]
+    localStats = [readCollectionStats(os.path.join(path, STATS_FILE)) for path in paths]
+    N = sum(stats.N for stats in localStats)
+    totalTokens = sum(stats.totalTokens for stats in localStats)
+    df = {}
+    cf = {}
+    for lexicon, stats in zip(lexicons, localStats):
+        for term, termID in lexicon.items():
+            df[term] = df.get(term, 0) + stats.df[termID]
+            cf[term] = cf.get(term, 0) + stats.cf[termID]
+
+    avgDl = totalTokens / N if N else 0.0
+    for path, lexicon, stats in zip(paths, lexicons, localStats):
+        shardDf = array("I", [0]) * stats.numTerms
+        shardCf = array("Q", [0]) * stats.numTerms
+        for term, termID in lexicon.items():
+            shardDf[termID] = df[term]
+            shardCf[termID] = cf[term]
+        shardIdf = array("d", (computeIdf(N, termDf) for termDf in shardDf))
+        # The same length normalisation as CollectionStatsBuilder, but with the collection's average length.
+        norms = {docId: DEFAULT_K1 * ((1 - DEFAULT_B) + DEFAULT_B * (dl / avgDl)) for docId, dl in loadDocLengths(path).items()}
+        maxScore = array("d", [0.0]) * stats.numTerms
+        postingsReader = PostingsReader(os.path.join(path, INVERTED_INDEX_FILE))
+        for termID, postings in postingsReader.items():
+            idf = shardIdf[termID]
+            maxScore[termID] = max(idf * posting[1] / (posting[1] + norms[posting[0]]) for posting in postings)
+        postingsReader.close()
+        CollectionStats(N, totalTokens, shardDf, shardCf, stats.maxTf, stats.minDl, shardIdf, maxScore).write(os.path.join(path, GLOBAL_STATS_FILE))
+    return N
+
+
+def firstQueryTerms(scorer, query, docIds):
+    """
+    For each document, the position in the query of the first term whose postings contain it. Positions count all
+    the query's tokens, so they compare the same way across shards even when a shard lacks some of the terms.
+    """
+    postingsLists = []
+    seen = set()
+    for position, term in enumerate(tokenize(query)):
+        termId = scorer.lexicon.get(term)
+        if termId is not None and termId not in seen:
+            seen.add(termId)
+            postingsLists.append((position, scorer.invertedIndex.get(termId, [])))
+    firstTerms = []
+    for docId in docIds:
+        for position, postings in postingsLists:
+            index = bisect_left(postings, (docId,))
+            if index < len(postings) and postings[index][0] == docId:
+                firstTerms.append(position)
+                break
+        else:
+            firstTerms.append(len(postingsLists))
+    return firstTerms
+
+
+def searchShard(scorer, mapping, query, k):
+    """
+    A shard's top k as (score, first query term, docID, DOCNO), in the order the merge needs.
+    """
+    results = scorer.topK(query, k)
+    firstTerms = firstQueryTerms(scorer, query, [docId for docId, _ in results])
+    return [(score, firstTerm, docId, mapping[docId]) for (docId, score), firstTerm in zip(results, firstTerms)]
+
+
+def serveConnection(connection, scorer, mapping, lock=None):
+    """
+    Answers a coordinator's requests until it closes the connection:
+    - ("search", query, k) -> ("ok", the shard's top k) or ("error", message)
+    - ("info",) -> ("ok", {"N": ..., "numDocs": ..., "k1": ..., "b": ...})
+    """
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+        if request[0] == "close":
+            break
+        try:
+            if request[0] == "search":
+                _, query, k = request
+                if lock is not None:
+                    with lock:
+                        reply = ("ok", searchShard(scorer, mapping, query, k))
+                else:
+                    reply = ("ok", searchShard(scorer, mapping, query, k))
+            elif request[0] == "info":
+                reply = ("ok", {"N": scorer.stats.N, "numDocs": len(mapping), "k1": scorer.k1, "b": scorer.b})
+            else:
+                reply = ("error", f"Unknown request {request[0]!r}.")
+        except ValueError as e:
+            # Phrase queries on an index without positions.
+            reply = ("error", str(e))
+        connection.send(reply)
+    connection.close()
+
+
+def openShard(shardPath, cachePostings, k1, b):
+    lexicon, invertedIndex, docLengths, mapping, stats = loadIndex(shardPath, cachePostings)
+    return BM25Scorer(lexicon, invertedIndex, docLengths, stats, k1, b), mapping
+
+
+def runShardProcess(connection, shardPath, cachePostings, k1, b):
+    """
+    Target of the local shard processes the coordinator starts.
+    """
+    scorer, mapping = openShard(shardPath, cachePostings, k1, b)
+    serveConnection(connection, scorer, mapping)
+
+
+def serveShard(shardPath, host, port, authkey, cachePostings=DEFAULT_CACHE_POSTINGS, k1=DEFAULT_K1, b=DEFAULT_B):
+    """
+    Serves one shard over TCP until interrupted. Each coordinator gets its own thread, and searches take turns
+    because the postings cache isn't thread safe.
+    """
+    scorer, mapping = openShard(shardPath, cachePostings, k1, b)
+    lock = threading.Lock()
+    with Listener((host, port), authkey=authkey.encode("utf-8")) as listener:
+        print(f"Serving {shardPath} ({len(mapping)} documents) on {host}:{port}.")
+        while True:
+            try:
+                connection = listener.accept()
+            except (ConnectionError, EOFError, multiprocessing.AuthenticationError) as e:
+                print(f"Refused a connection: {e}")
+                continue
+            threading.Thread(target=serveConnection, args=(connection, scorer, mapping, lock), daemon=True).start()
+
+
+def mergeTopK(shardResults, k):
+    """
+    Merges the shards' top k lists (each already in order) into the top k of the whole collection.
+    Returns:
+        list: (docID, score, DOCNO) tuples, best first.
+    """
+    merged = heapq.merge(*shardResults, key=lambda result: (-result[0], result[1], result[2]))
+    return [(docId, score, docNo) for score, _, docId, docNo in itertools.islice(merged, k)]
+
+
+class ShardCoordinator:
+    """
+    Sends queries to one worker per shard and merges their answers.
+    """
+
+    def __init__(self, indexPath, addresses=None, authkey=DEFAULT_AUTHKEY, cachePostings=DEFAULT_CACHE_POSTINGS, k1=DEFAULT_K1, b=DEFAULT_B):
+        """
+        Args:
+            indexPath (str): The sharded index (its shards.txt says how many shards there are).
+            addresses (list): (host, port) of the shard server of each shard, in shard order.
+                If None, a local process is started for every shard.
+            authkey (str): The key the shard servers were started with.
+        """
+        paths = shardPaths(indexPath)
+        if not paths:
+            raise ValueError(f"{indexPath} is not a sharded index. Build it with indexEngine.py --shards N.")
+        self.processes = []
+        if addresses is None:
+            ## Reference: https://docs.python.org/3/library/multiprocessing.html#contexts-and-start-methods
+            context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+            self.connections = []
+            for path in paths:
+                parentEnd, childEnd = context.Pipe()
+                process = context.Process(target=runShardProcess, args=(childEnd, path, cachePostings, k1, b), daemon=True)
+                process.start()
+                childEnd.close()
+                self.connections.append(parentEnd)
+                self.processes.append(process)
+        else:
+            if len(addresses) != len(paths):
+                raise ValueError(f"{indexPath} has {len(paths)} shards but {len(addresses)} addresses were given.")
+            self.connections = [Client(address, authkey=authkey.encode("utf-8")) for address in addresses]
+
+        # Every shard must have been given the same collection statistics and BM25 parameters,
+        # or their scores can't be compared.
+        infos = self.broadcast(("info",))
+        if len({(info["N"], info["k1"], info["b"]) for info in infos}) != 1:
+            self.close()
+            raise ValueError(f"The shards don't agree on N, k1 and b: {infos}")
+        self.numDocs = sum(info["numDocs"] for info in infos)
+        self.N = infos[0]["N"]
+
+    def broadcast(self, request):
+        """
+        Sends the request to every shard before waiting for any answer, so the shards work at the same time.
+        """
+        for connection in self.connections:
+            connection.send(request)
+        replies = [connection.recv() for connection in self.connections]
+        for status, value in replies:
+            if status == "error":
+                raise ValueError(value)
+        return [value for _, value in replies]
+
+    def search(self, query, k):
+        """
+        The k best documents of the whole collection, the same as BM25Scorer.topK on a single index.
+        Returns:
+            list: (docID, score, DOCNO) tuples, best first.
+        """
+        if k <= 0:
+            return []
+        return mergeTopK(self.broadcast(("search", query, k)), k)
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(("close",))
+            except OSError:
+                pass
+            connection.close()
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def runTopics(coordinator, topicsPath, runPath, depth, runTag):
+    """
+    Batch mode: writes a TREC run file like BM25.py --topics does, so the two can be compared line for line.
+    """
+    start_time = time.time()
+    topics = readTopics(topicsPath)
+    with open(runPath, "w") as f:
+        for topicID, query in topics:
+            try:
+                results = coordinator.search(query, depth)
+            except ValueError as e:
+                print(f"Error in topic {topicID}: {e}")
+                continue
+            for rank, (_, score, docNo) in enumerate(results, 1):
+                f.write(f"{topicID} Q0 {docNo} {rank} {score} {runTag}\n")
+    print(f"Ranked {len(topics)} topics in {time.time() - start_time:.2f} seconds. The run is in {runPath}.")
+
+
+def parseAddress(text):
+    host, _, port = text.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search a sharded index (indexEngine.py --shards), or serve one of its shards")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    search = commands.add_parser("search", help="Search all the shards and merge their results")
+    search.add_argument("indexPath", help="The sharded index directory")
+    search.add_argument("--query", help="Print the top --k results of this query and exit (otherwise ask for queries)")
+    search.add_argument("--k", type=int, default=10, help="Results per query (default: 10)")
+    search.add_argument("--topics", help="Batch mode: rank every topic of this TREC topics file")
+    search.add_argument("--run", help="With --topics, the TREC run file to write")
+    search.add_argument("--depth", type=int, default=1000, help="With --topics, results per topic (default: 1000)")
+    search.add_argument("--run-tag", default="yabadeerBM25", help="With --topics, the run tag in the last column (default: yabadeerBM25)")
+    search.add_argument("--connect", nargs="+", metavar="HOST:PORT", help="Use these shard servers, one per shard in order, instead of local processes")
+
+    serve = commands.add_parser("serve", help="Serve one shard to coordinators over TCP")
+    serve.add_argument("shardPath", help="The shard directory (e.g. <indexPath>/shard-000)")
+    serve.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    serve.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port to listen on (default: {DEFAULT_PORT})")
+
+    for command in (search, serve):
+        command.add_argument("--authkey", default=DEFAULT_AUTHKEY, help="Shared key of the coordinator and the shard servers")
+        command.add_argument("--postings-cache", type=int, default=DEFAULT_CACHE_POSTINGS, metavar="N", help=f"Decoded postings each shard keeps in its LRU cache (default: {DEFAULT_CACHE_POSTINGS})")
+        command.add_argument("--k1", type=float, default=DEFAULT_K1, help=f"BM25 k1 (default: {DEFAULT_K1})")
+        command.add_argument("--b", type=float, default=DEFAULT_B, help=f"BM25 b (default: {DEFAULT_B})")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        if not os.path.exists(os.path.join(args.shardPath, GLOBAL_STATS_FILE)):
+            parser.error(f"{args.shardPath} is not a shard of a sharded index.")
+        try:
+            serveShard(args.shardPath, args.host, args.port, args.authkey, args.postings_cache, args.k1, args.b)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.topics and not args.run:
+        parser.error("--topics needs --run <output file>.")
+    if args.k < 1 or args.depth < 1:
+        parser.error("--k and --depth must be at least 1.")
+    addresses = [parseAddress(address) for address in args.connect] if args.connect else None
+    try:
+        coordinator = ShardCoordinator(args.indexPath, addresses, args.authkey, args.postings_cache, args.k1, args.b)
+    except (ValueError, OSError, EOFError, multiprocessing.AuthenticationError) as e:
+        # Not a sharded index, a shard server that isn't running or has another key, or a shard that failed to load.
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    with coordinator:
+        print(f"Searching {len(coordinator.connections)} shards of {coordinator.numDocs} documents.")
+        if args.topics:
+            runTopics(coordinator, args.topics, args.run, args.depth, args.run_tag)
+            return
+        while True:
+            if args.query is not None:
+                query = args.query
+            else:
+                try:
+                    query = input("Enter your query (or type 'Q' to quit): ")
+                except EOFError:
+                    break
+                if query.lower() == "q":
+                    break
+            start_time = time.time()
+            try:
+                results = coordinator.search(query, args.k)
+            except ValueError as e:
+                print(f"Error: {e}")
+                results = []
+            for rank, (docId, score, docNo) in enumerate(results, 1):
+                print(f"{rank}. {docNo} (internal ID {docId}) {score:.4f}")
+            print(f"Retrieval took {time.time() - start_time:.2f} seconds.")
+            if args.query is not None:
+                break
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+'''
+Static index pruning: writes a copy of an index without the postings whose BM25 contribution is too small to matter,
+for a smaller inverted_index.bin and faster queries at the cost of a little effectiveness.
+
+Usage:
+    python3 staticPruning.py <indexPath> <prunedPath> [--term-k 10 --epsilon 0.5] [--doc-fraction 0.3]
+        [--topics <topics file> --qrels <qrels file>] [--depth 1000] [--repeat 3] [--report report.json]
+
+A posting's contribution is idf * f / (f + k1 * ((1 - b) + b * dl / avgdl)) with the default k1 and b, the amount it
+adds to its document's BM25 score. Its size is what counts: terms in more than half of the documents have a
+negative IDF, and dropping a large negative contribution would change the ranking as much as a large positive one.
+- Term-centric (--term-k, --epsilon): for each term, the postings smaller than epsilon times the term's k-th largest
+  contribution are dropped, so every term keeps at least its best k documents. Terms in k documents or fewer are
+  kept whole. After Carmel et al.
+- Document-centric (--doc-fraction): each document keeps its largest contributions, the given fraction of its
+  distinct terms (at least one), and the postings of its other terms are dropped. After Buttcher and Clarke.
+With both, a posting has to pass both to be kept.
+
+The pruned index is an ordinary index directory that BM25.py, booleanAND.py, getDoc.py and searchServer.py load as
+usual. All the files apart from the postings are hard linked from the original. collection-stats.bin keeps the N,
+df and IDF of the unpruned collection, so a kept posting adds exactly what it did before, and the score bounds are
+worked out again from the kept postings. BM25Scorer takes the IDF from there. BM25.bm25 and bm25Score do too when
+they are given stats.idf, but without it they count the kept postings, which gives a larger IDF. The impact-ordered
+postings and the snapshot are not carried over (build the snapshot again with indexSnapshot.py). Phrase queries only
+find documents whose postings for all the phrase's terms were kept.
+
+With --topics and --qrels, both indexes rank every topic with BM25Scorer.topK, the rankings are scored in memory
+with evaluation.evaluateResults (like parameterSweep.py does), and the report gives the size of the postings, the
+query latency and P@10, MAP, NDCG@10 and NDCG@1000 of both, with the change.
+
+Acknowledgements:
+- Term-centric pruning is from Carmel et al., "Static index pruning for information retrieval systems" (SIGIR 2001).
+- Document-centric pruning is from Buttcher and Clarke, "A document-centric approach to static index pruning in
+  text retrieval systems" (CIKM 2006). They rank a document's terms by their contribution to its language model
+  Kullback-Leibler divergence. Here they are ranked by their BM25 contribution, which is what the engine scores.
+- Reference for os.link: https://docs.python.org/3/library/os.html#os.link
+'''
+
+import argparse
+import heapq
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+from array import array
+from BM25 import loadIndex, loadDocLengths, INVERTED_INDEX_FILE
+from benchmarks import latencySummary, directorySize
+from collectionStats import CollectionStats, readCollectionStats, STATS_FILE, GLOBAL_STATS_FILE, DEFAULT_K1, DEFAULT_B
+from evaluation import evaluateResults, meanMetrics
+from impactIndex import IMPACT_INDEX_FILE
+from indexSnapshot import SNAPSHOT_FILE
+from parsers import QrelsParser
+from postingsFile import PostingsReader, writePostingsFile
+from Results import Result, Results
+from scoring import BM25Scorer, documentNorms
+from segments import readManifest
+from topics import readTopics
+
+# Files that are written again for the pruned index, or left out of it, instead of being linked.
+NOT_LINKED = {INVERTED_INDEX_FILE, STATS_FILE, IMPACT_INDEX_FILE, SNAPSHOT_FILE}
+METRICS = ["precisionAt10", "averagePrecision", "ndcgAt10", "ndcgAt1000"]
+
+
+class PostingsPruner:
+    """
+    Decides which postings of an index to keep. Contributions are worked out with the index's own statistics.
+    """
+
+    def __init__(self, indexPath, termK=None, epsilon=None, docFraction=None):
+        self.reader = PostingsReader(os.path.join(indexPath, INVERTED_INDEX_FILE))
+        self.stats = readCollectionStats(os.path.join(indexPath, STATS_FILE))
+        self.docLengths = loadDocLengths(indexPath)
+        self.norms = documentNorms(self.docLengths, self.stats.avgDl, DEFAULT_K1, DEFAULT_B)
+        self.termK = termK
+        self.epsilon = epsilon
+        self.docThresholds = self.documentThresholds(docFraction) if docFraction is not None else None
+        # Bounds of the kept postings, filled in by prune.
+        self.maxTf = array("I", [0]) * self.stats.numTerms
+        self.minDl = array("I", [0]) * self.stats.numTerms
+        self.maxScore = array("d", [0.0]) * self.stats.numTerms
+        self.totalPostings = 0
+        self.keptPostings = 0
+
+    def contributions(self, termID, postings):
+        idf = self.stats.idf[termID]
+        norms = self.norms
+        return [idf * posting[1] / (posting[1] + norms[posting[0]]) for posting in postings]
+
+    def documentThresholds(self, docFraction):
+        """
+        The size of the smallest contribution each document keeps, from a first pass over all the postings.
+        """
+        sizes = {}
+        for termID, postings in self.reader.items():
+            for posting, contribution in zip(postings, self.contributions(termID, postings)):
+                if posting[0] not in sizes:
+                    sizes[posting[0]] = array("d")
+                sizes[posting[0]].append(abs(contribution))
+        thresholds = {}
+        for docId, values in sizes.items():
+            keep = max(1, math.ceil(docFraction * len(values)))
+            thresholds[docId] = heapq.nlargest(keep, values)[-1]
+        return thresholds
+
+    def prune(self):
+        """
+        Yields (termID, kept postings) for every term that has postings, and records the bounds of what is kept.
+        """
+        items = self.reader.positionalItems() if self.reader.positional else self.reader.items()
+        for termID, postings in items:
+            contributions = self.contributions(termID, postings)
+            sizes = [abs(contribution) for contribution in contributions]
+            termThreshold = 0.0
+            if self.termK is not None and len(postings) > self.termK:
+                termThreshold = self.epsilon * heapq.nlargest(self.termK, sizes)[-1]
+            kept = []
+            keptContributions = []
+            for posting, contribution, size in zip(postings, contributions, sizes):
+                if size < termThreshold:
+                    continue
+                if self.docThresholds is not None and size < self.docThresholds[posting[0]]:
+                    continue
+                kept.append(posting)
+                keptContributions.append(contribution)
+            self.totalPostings += len(postings)
+            self.keptPostings += len(kept)
+            if kept:
+                self.maxTf[termID] = max(posting[1] for posting in kept)
+                self.minDl[termID] = min(self.docLengths[posting[0]] for posting in kept)
+                self.maxScore[termID] = max(keptContributions)
+            yield termID, kept
+
+    def prunedStats(self):
+        """
+        The statistics for the pruned index: those of the whole collection, with the bounds of the kept postings.
+        """
+        stats = self.stats
+        return CollectionStats(stats.N, stats.totalTokens, stats.df, stats.cf, self.maxTf, self.minDl, stats.idf, self.maxScore)
+
+
+def linkIndexFiles(indexPath, prunedPath):
+    """
+    Hard links (or copies, across file systems) everything of the index except the postings and the files made from them.
+    """
+    for name in os.listdir(indexPath):
+        source = os.path.join(indexPath, name)
+        target = os.path.join(prunedPath, name)
+        if name in NOT_LINKED:
+            continue
+        try:
+            if os.path.isdir(source):
+                ## Reference: https://docs.python.org/3/library/shutil.html#shutil.copytree
+                shutil.copytree(source, target, copy_function=os.link)
+            else:
+                os.link(source, target)
+        except OSError:
+            if os.path.isdir(source):
+                shutil.copytree(source, target, dirs_exist_ok=True)
+            else:
+                shutil.copy2(source, target)
+
+
+def pruneIndex(indexPath, prunedPath, termK=None, epsilon=None, docFraction=None):
+    """
+    Writes the pruned copy of indexPath to prunedPath (which must not exist yet).
+    Returns:
+        tuple: (number of postings in the original, number kept)
+    """
+    pruner = PostingsPruner(indexPath, termK, epsilon, docFraction)
+    os.makedirs(prunedPath)
+    writePostingsFile(os.path.join(prunedPath, INVERTED_INDEX_FILE), pruner.reader.numTerms, pruner.prune(), pruner.reader.positional)
+    pruner.prunedStats().write(os.path.join(prunedPath, STATS_FILE))
+    pruner.reader.close()
+    linkIndexFiles(indexPath, prunedPath)
+    return pruner.totalPostings, pruner.keptPostings
+
+
+def rankTopics(indexPath, topics, depth, repeat, runPath, runTag="yabadeerBM25"):
+    """
+    Ranks every topic with BM25Scorer.topK and writes the run. Each topic is timed repeat times after a first,
+    untimed pass that warms up the postings cache.
+    Returns:
+        tuple: (the run as a Results object, the latency of every timed query in seconds)
+    """
+    lexicon, invertedIndex, docLengths, mapping, stats = loadIndex(indexPath, useSnapshot=False)
+    scorer = BM25Scorer(lexicon, invertedIndex, docLengths, stats)
+    results = Results()
+    with open(runPath, "w") as f:
+        for topicID, query in topics:
+            for rank, (docId, score) in enumerate(scorer.topK(query, depth), 1):
+                f.write(f"{topicID} Q0 {mapping[docId]} {rank} {score} {runTag}\n")
+                results.add_result(topicID, Result(mapping[docId], score, rank))
+    latencies = []
+    for _ in range(repeat):
+        for _, query in topics:
+            start = time.perf_counter()
+            scorer.topK(query, depth)
+            latencies.append(time.perf_counter() - start)
+    return results, latencies
+
+
+def compareIndexes(indexPath, prunedPath, topicsPath, qrelsPath, depth, repeat, runsDir):
+    """
+    Size, latency and effectiveness of the original and the pruned index.
+    Raises ValueError if none of the topics that were ranked are judged in the qrels.
+    """
+    topics = readTopics(topicsPath)
+    qrels = QrelsParser(qrelsPath).parse()
+    report = {}
+    for label, path in (("original", indexPath), ("pruned", prunedPath)):
+        runPath = os.path.join(runsDir, f"{label}.run")
+        results, latencies = rankTopics(path, topics, depth, repeat, runPath)
+        evaluationMetrics = evaluateResults(qrels, results)
+        if not evaluationMetrics and label == "original":
+            # The means would all be 0, which would look like a valid comparison.
+            raise ValueError(f"None of the topics in {topicsPath} that found documents are judged in {qrelsPath}.")
+        report[label] = {
+            "postingsBytes": os.path.getsize(os.path.join(path, INVERTED_INDEX_FILE)),
+            "indexBytes": directorySize(path),
+            "latency": latencySummary(latencies),
+            "metrics": meanMetrics(evaluationMetrics),
+        }
+    return report
+
+
+def printReport(report):
+    original, pruned = report["original"], report["pruned"]
+    print(f"{'':<22}{'original':>12}{'pruned':>12}{'change':>10}")
+    rows = [
+        ("Postings (MB)", original["postingsBytes"] / 1e6, pruned["postingsBytes"] / 1e6),
+        ("Index folder (MB)", original["indexBytes"] / 1e6, pruned["indexBytes"] / 1e6),
+        ("Mean latency (ms)", original["latency"]["meanMs"], pruned["latency"]["meanMs"]),
+        ("p95 latency (ms)", original["latency"]["p95Ms"], pruned["latency"]["p95Ms"]),
+    ]
+    for label, before, after in rows:
+        change = f"{(after - before) / before:+.1%}" if before else ""
+        print(f"{label:<22}{before:>12.3f}{after:>12.3f}{change:>10}")
+    names = {"precisionAt10": "P@10", "averagePrecision": "MAP", "ndcgAt10": "NDCG@10", "ndcgAt1000": "NDCG@1000"}
+    for metric in METRICS:
+        before, after = original["metrics"][metric], pruned["metrics"][metric]
+        print(f"{names[metric]:<22}{before:>12.4f}{after:>12.4f}{after - before:>+10.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a statically pruned copy of an index: python3 staticPruning.py <indexPath> <prunedPath>")
+    parser.add_argument("indexPath", help="The index to prune")
+    parser.add_argument("prunedPath", help="Directory to create for the pruned index")
+    parser.add_argument("--term-k", type=int, metavar="K", help="Term-centric: keep at least each term's K largest contributions (default 10 with --epsilon)")
+    parser.add_argument("--epsilon", type=float, help="Term-centric: drop postings smaller than epsilon times the term's K-th largest contribution (0 to 1)")
+    parser.add_argument("--doc-fraction", type=float, metavar="FRACTION", help="Document-centric: keep this fraction of each document's terms, those with the largest contributions (0 to 1)")
+    parser.add_argument("--topics", help="Compare the two indexes on this TREC topics file (needs --qrels)")
+    parser.add_argument("--qrels", help="The qrels for --topics")
+    parser.add_argument("--depth", type=int, default=1000, help="With --topics, results per topic (default: 1000)")
+    parser.add_argument("--repeat", type=int, default=3, help="With --topics, how many times each topic is timed (default: 3)")
+    parser.add_argument("--runs-dir", help="With --topics, keep the runs of both indexes (original.run and pruned.run) in this directory")
+    parser.add_argument("--report", help="With --topics, also write the comparison to this JSON file")
+    args = parser.parse_args()
+
+    if args.term_k is not None and args.epsilon is None:
+        parser.error("--term-k needs --epsilon.")
+    if args.epsilon is not None:
+        args.term_k = args.term_k if args.term_k is not None else 10
+        if args.term_k < 1 or not 0 <= args.epsilon <= 1:
+            parser.error("--term-k must be at least 1 and --epsilon between 0 and 1.")
+    if args.doc_fraction is not None and not 0 < args.doc_fraction <= 1:
+        parser.error("--doc-fraction must be above 0 and at most 1.")
+    if args.epsilon is None and args.doc_fraction is None:
+        parser.error("give a term-centric (--epsilon) or a document-centric (--doc-fraction) threshold, or both.")
+    if bool(args.topics) != bool(args.qrels):
+        parser.error("--topics and --qrels go together.")
+    if args.depth < 1 or args.repeat < 1:
+        parser.error("--depth and --repeat must be at least 1.")
+
+    if not os.path.exists(os.path.join(args.indexPath, INVERTED_INDEX_FILE)) or not os.path.exists(os.path.join(args.indexPath, STATS_FILE)):
+        print("Error: The index has no binary postings or collection statistics. Please rebuild it with indexEngine.py.")
+        sys.exit(1)
+    if readManifest(args.indexPath) or os.path.exists(os.path.join(args.indexPath, GLOBAL_STATS_FILE)):
+        # The statistics of each segment or shard only cover part of the collection.
+        print("Error: Only single indexes can be pruned. Merge the segments first (indexEngine.py --merge), or rebuild without --shards.")
+        sys.exit(1)
+    if os.path.exists(args.prunedPath):
+        print("Error: The specified directory already exists. Please choose something different and try again.")
+        sys.exit(1)
+
+    start_time = time.time()
+    totalPostings, keptPostings = pruneIndex(args.indexPath, args.prunedPath, args.term_k, args.epsilon, args.doc_fraction)
+    print(f"Kept {keptPostings} of {totalPostings} postings ({keptPostings / max(totalPostings, 1):.1%}) in {time.time() - start_time:.2f} seconds. The pruned index is in {args.prunedPath}.")
+    if not args.topics:
+        return
+
+    try:
+        if args.runs_dir:
+            os.makedirs(args.runs_dir, exist_ok=True)
+            report = compareIndexes(args.indexPath, args.prunedPath, args.topics, args.qrels, args.depth, args.repeat, args.runs_dir)
+        else:
+            with tempfile.TemporaryDirectory() as runsDir:
+                report = compareIndexes(args.indexPath, args.prunedPath, args.topics, args.qrels, args.depth, args.repeat, runsDir)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    report["postings"] = {"original": totalPostings, "kept": keptPostings}
+    report["settings"] = {"termK": args.term_k, "epsilon": args.epsilon, "docFraction": args.doc_fraction, "depth": args.depth, "repeat": args.repeat}
+    printReport(report)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
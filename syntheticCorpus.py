@@ -0,0 +1,186 @@
+'''
+Synthetic collections in the LA Times format, for benchmarks (benchmarks.py corpus and suite).
+
+A collection is a gzip file of <DOC> blocks like the real one:
+<DOC>
+<DOCNO> LA010189-0001 </DOCNO>
+<DOCID> 1 </DOCID>
+<DATE> ... </DATE>
+<SECTION> ... </SECTION>
+<LENGTH> ... </LENGTH>
+<HEADLINE> ... </HEADLINE>
+<TEXT> <P> ... </P> ... </TEXT>
+<GRAPHIC> ... </GRAPHIC>   (some documents)
+</DOC>
+Words are drawn from a Zipf distribution over a vocabulary that starts with common English words and news
+words and continues with made-up words, so term frequencies, postings lengths and document lengths look like
+those of a real collection. The same seed and sizes always give the same file, byte for byte, so results from
+different commits are measured on the same input.
+
+Acknowledgements:
+- Zipf's law for term frequencies is from the index compression lecture and chapter 5.1 of Introduction to
+  Information Retrieval (Manning, Raghavan, Schutze).
+- Reference for random.choices: https://docs.python.org/3/library/random.html#random.choices
+'''
+
+import gzip
+import itertools
+import random
+
+# The most frequent words of the vocabulary, in rank order. Made-up words follow them.
+COMMON_WORDS = [
+    "the", "of", "to", "and", "a", "in", "for", "that", "is", "said", "on", "he", "it", "was", "with", "at", "by",
+    "as", "his", "from", "be", "have", "has", "but", "are", "an", "they", "not", "who", "will", "i", "this", "were",
+    "had", "their", "would", "been", "which", "we", "one", "or", "more", "its", "new", "about", "there", "when",
+    "after", "up", "all", "out", "year", "two", "than", "other", "years", "also", "so", "her", "she", "can",
+    "angeles", "los", "county", "city", "state", "police", "school", "council", "court", "california", "million",
+    "people", "officials", "percent", "president", "company", "government", "today", "week", "home", "time",
+    "first", "last", "water", "fire", "judge", "music", "film", "soviet", "union", "election", "reagan", "bush",
+    "tax", "budget", "drug", "earthquake", "freeway", "traffic", "baseball", "dodgers", "lakers", "art", "museum",
+    "oil", "price", "market", "stock", "bank", "loan", "hospital", "doctor", "aids", "virus", "war", "peace",
+    "talks", "israel", "china", "japan", "trade", "orange", "valley", "beach", "board", "federal", "mayor",
+]
+SYLLABLES = ["ka", "lo", "mi", "ra", "te", "su", "no", "vi", "de", "pa", "ri", "zu", "ma", "ko", "el", "an",
+             "tor", "ben", "sha", "gre", "dal", "fin", "oru", "wex"]
+SECTIONS = ["Metro", "Part A", "Business", "Sports", "Calendar", "View", "Financial", "Orange County"]
+EDITIONS = ["Home Edition", "Valley Edition", "Orange County Edition", "San Diego County Edition"]
+MONTHS = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October",
+          "November", "December"]
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+DEFAULT_VOCABULARY = 50000
+DEFAULT_DOC_WORDS = 400  # average number of words in a document's text
+ZIPF_EXPONENT = 1.05
+
+
+def vocabulary(rng, size):
+    """
+    The vocabulary in rank order: the common words, then made-up words of 2 to 4 syllables (all different).
+    """
+    words = COMMON_WORDS[:size]
+    seen = set(words)
+    while len(words) < size:
+        word = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+class SyntheticCollection:
+    """
+    A seeded generator of LA Times style documents and of queries over the same vocabulary.
+    """
+
+    def __init__(self, seed=1, vocabularySize=DEFAULT_VOCABULARY, docWords=DEFAULT_DOC_WORDS):
+        self.seed = seed
+        self.docWords = docWords
+        self.rng = random.Random(seed)
+        self.words = vocabulary(self.rng, vocabularySize)
+        # Cumulative Zipf weights, so random.choices can draw many words at once.
+        self.cumulativeWeights = list(itertools.accumulate(1 / (rank + 1) ** ZIPF_EXPONENT for rank in range(vocabularySize)))
+
+    def draw(self, count):
+        return self.rng.choices(self.words, cum_weights=self.cumulativeWeights, k=count)
+
+    def sentence(self, words):
+        text = " ".join(words)
+        return text[:1].upper() + text[1:] + self.rng.choice([".", ".", ".", "!", "?"])
+
+    def paragraphs(self, numWords):
+        """
+        numWords words (drawn all at once, which is much faster than one at a time) cut into sentences of 5 to 30
+        words and paragraphs of 20 to 120.
+        """
+        words = self.draw(numWords)
+        paragraphs = []
+        start = 0
+        while start < numWords:
+            end = min(numWords, start + self.rng.randint(20, 120))
+            sentences = []
+            while start < end:
+                length = min(end - start, self.rng.randint(5, 30))
+                sentences.append(self.sentence(words[start:start + length]))
+                start += length
+            paragraphs.append(" ".join(sentences))
+        return paragraphs
+
+    def documents(self, numDocs):
+        """
+        Yields the text of numDocs <DOC> blocks. DOCNOs are LAmmddyy-nnnn, numbered per day like the real ones,
+        and internal DOCIDs count from 1.
+        """
+        perDay = {}
+        for docId in range(1, numDocs + 1):
+            rng = self.rng
+            year = rng.choice([89, 90])
+            month = rng.randint(1, 12)
+            day = rng.randint(1, 28)
+            perDay[(year, month, day)] = perDay.get((year, month, day), 0) + 1
+            docNo = f"LA{month:02d}{day:02d}{year:02d}-{perDay[(year, month, day)]:04d}"
+            # Document lengths vary a lot: mostly short items, some long features.
+            textWords = max(10, int(rng.expovariate(1 / self.docWords)))
+            paragraphs = self.paragraphs(textWords)
+
+            parts = [
+                "<DOC>",
+                f"<DOCNO> {docNo} </DOCNO>",
+                f"<DOCID> {docId} </DOCID>",
+                "<DATE>", "<P>",
+                f"{MONTHS[month - 1]} {day}, 19{year}, {rng.choice(WEEKDAYS)}, {rng.choice(EDITIONS)}",
+                "</P>", "</DATE>",
+                "<SECTION>", "<P>", f"{rng.choice(SECTIONS)}; Part {rng.randint(1, 12)}; Page {rng.randint(1, 40)}; Column {rng.randint(1, 6)}", "</P>", "</SECTION>",
+                "<LENGTH>", "<P>", f"{textWords} words", "</P>", "</LENGTH>",
+            ]
+            if rng.random() < 0.9:
+                parts += ["<HEADLINE>", "<P>", self.sentence(self.draw(rng.randint(3, 10))).upper(), "</P>", "</HEADLINE>"]
+            parts.append("<TEXT>")
+            for paragraph in paragraphs:
+                parts += ["<P>", paragraph, "</P>"]
+            parts.append("</TEXT>")
+            if rng.random() < 0.2:
+                parts += ["<GRAPHIC>", "<P>", "Photo, " + self.sentence(self.draw(rng.randint(4, 12))), "</P>", "</GRAPHIC>"]
+            parts.append("</DOC>")
+            yield "\n".join(parts) + "\n"
+
+    def queries(self, numQueries):
+        """
+        Queries of 1 to 4 words, mostly from the middle of the vocabulary (like topic titles) with some common words.
+        """
+        rng = self.rng
+        middle = self.words[len(COMMON_WORDS):len(COMMON_WORDS) + 5000] or self.words
+        queries = []
+        for _ in range(numQueries):
+            terms = [rng.choice(middle) for _ in range(rng.choice([1, 2, 2, 3, 3, 4]))]
+            if rng.random() < 0.3:
+                terms.insert(rng.randrange(len(terms) + 1), rng.choice(COMMON_WORDS[60:]))
+            queries.append(" ".join(terms))
+        return queries
+
+
+def writeCollection(outputPath, numDocs, seed=1, vocabularySize=DEFAULT_VOCABULARY, docWords=DEFAULT_DOC_WORDS):
+    """
+    Writes a synthetic collection of numDocs documents to a gzip file.
+    Returns:
+        int: the size of the uncompressed collection in bytes.
+    """
+    collection = SyntheticCollection(seed, vocabularySize, docWords)
+    totalBytes = 0
+    # No file name or time in the gzip header, so the file only depends on the seed and sizes.
+    ## Reference: https://docs.python.org/3/library/gzip.html#gzip.GzipFile
+    with open(outputPath, "wb") as raw, gzip.GzipFile(filename="", fileobj=raw, mode="wb", mtime=0) as f:
+        for document in collection.documents(numDocs):
+            data = document.encode("utf-8")
+            totalBytes += len(data)
+            f.write(data)
+    return totalBytes
+
+
+def collectionQueries(numQueries, seed=1, vocabularySize=DEFAULT_VOCABULARY):
+    """
+    Queries over the vocabulary of the collection with the same seed and vocabulary size.
+    They come from their own random stream, so they don't depend on how many documents were generated.
+    """
+    collection = SyntheticCollection(seed, vocabularySize)
+    collection.rng = random.Random(f"queries-{seed}")
+    return collection.queries(numQueries)
@@ -0,0 +1,40 @@
+'''
+Text analysis shared by indexing (indexEngine.py) and querying (BM25.py, booleanAND.py).
+
+The tokenizer and tag stripper used to walk the text one character at a time in Python. These versions
+do the same thing with compiled regular expressions, which run in C, and give exactly the same tokens.
+benchmarks.py has a micro-benchmark comparing them with the character loops.
+
+Acknowledgements:
+- Tokenization rules (downcase, sequences of alphanumerics are tokens) are from the lectures.
+- Reference for the regular expressions: https://docs.python.org/3/library/re.html
+'''
+
+import re
+
+# \w is the Unicode letters, digits and numerics (everything str.isalnum() accepts) plus the underscore,
+# so "not a non-word character and not an underscore" is exactly a run of str.isalnum() characters.
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+# For ASCII text (almost all of the collection) the alphanumerics are just these, which is a faster pattern to match.
+ASCII_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+# A tag runs from '<' to the next '>', or to the end of the text if it is never closed.
+TAG_PATTERN = re.compile(r"<[^>]*>?")
+
+
+def tokenize(text):
+    """
+    Tokenizes the given text by downcasing all characters and treating sequences of alphanumerics as tokens.
+    """
+    text = text.lower()
+    if text.isascii():
+        return ASCII_TOKEN_PATTERN.findall(text)
+    return TOKEN_PATTERN.findall(text)
+
+
+def removeTags(content):
+    """
+    Removes all tags (anything from a '<' to the next '>') from the content.
+    A '>' outside of a tag is dropped too, the same as the original character loop did.
+    """
+    return TAG_PATTERN.sub("", content).replace(">", "")
+
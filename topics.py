@@ -0,0 +1,37 @@
+'''
+Reads TREC topics files (e.g. topics.401-450.txt) for the batch runs of BM25.py and booleanAND.py.
+
+Each topic looks like:
+<top>
+<num> Number: 401
+<title> foreign minorities, Germany
+...
+</top>
+Only the number and the title are used; the title is the query.
+'''
+
+
+def readTopics(topicsPath):
+    """
+    Returns [(topicID, query)] in file order. A title can be on the <title> line or on the line after it,
+    and may or may not have a closing </title>.
+    """
+    topics = []
+    topicID = None
+    with open(topicsPath, "r") as f:
+        lines = f.readlines()
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if "Number:" in line:
+            topicID = line.split("Number:", 1)[1].strip()
+        elif "<title>" in line and topicID is not None:
+            title = line.split("<title>", 1)[1].split("</title>")[0].strip()
+            if not title and i + 1 < len(lines):
+                # The title is on its own line.
+                i += 1
+                title = lines[i].split("</title>")[0].strip()
+            topics.append((topicID, title))
+            topicID = None
+        i += 1
+    return topics